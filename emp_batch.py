@@ -0,0 +1,89 @@
+#!/usr/bin/env python3.12
+"""Queue uploads for several scenes at once on a running stash-empornium backend."""
+
+__author__ = "An EMP user"
+__license__ = "unlicense"
+
+# built-in
+import argparse
+import json
+import os
+import sys
+import time
+
+# external
+import requests
+
+FINISHED_STATES = ("done", "failed", "cancelled")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="queue uploads for several scenes on the stash-empornium backend")
+    parser.add_argument("scene_ids", nargs="*", help="IDs of the scenes to generate uploads for")
+    parser.add_argument("--filter", dest="scene_filter", type=json.loads,
+                        help="stash scene filter as JSON, e.g. '{\"studios\": {\"value\": [\"12\"], \"modifier\": \"INCLUDES\"}}'")
+    parser.add_argument("-a", "--announce-url", required=True, help="tracker announce URL")
+    parser.add_argument("-t", "--tracker", default="EMP", help="tracker to generate uploads for (default: EMP)")
+    parser.add_argument("--template", help="name of a file in templates/ dir")
+    parser.add_argument("--no-screens", dest="screens", action="store_false", help="do not generate screenshots")
+    parser.add_argument("--gallery", action="store_true", help="include the gallery associated with each scene")
+    parser.add_argument("-b", "--backend", default="http://localhost:9932", help="URL of the backend server")
+    parser.add_argument("-w", "--wait", action="store_true", help="wait for all jobs to finish")
+    parser.add_argument("-o", "--output", help="directory to save the result of each job to. Implies --wait")
+    args = parser.parse_args()
+    if not args.scene_ids and args.scene_filter is None:
+        parser.error("at least one scene ID or a scene filter is required")
+    return args
+
+
+def main() -> int:
+    args = parse_args()
+    body = {
+        "announce_url": args.announce_url,
+        "tracker": args.tracker,
+        "template": args.template,
+        "screens": args.screens,
+        "gallery": args.gallery,
+    }
+    if args.scene_ids:
+        body["scene_ids"] = args.scene_ids
+    if args.scene_filter is not None:
+        body["scene_filter"] = args.scene_filter
+
+    response = requests.post(f"{args.backend}/generate/batch", json=body).json()
+    if response["status"] != "success":
+        print(response["message"], file=sys.stderr)
+        return 1
+    job_ids: list[str] = response["data"]["jobs"]
+    print(response["data"]["message"])
+    if not (args.wait or args.output):
+        return 0
+
+    if args.output:
+        os.makedirs(args.output, exist_ok=True)
+    failed = 0
+    remaining = set(job_ids)
+    while remaining:
+        time.sleep(2)
+        for job_id in sorted(remaining):
+            status = requests.get(f"{args.backend}/jobs/{job_id}").json()
+            if "state" not in status:
+                # The job expired before it could be checked
+                remaining.discard(job_id)
+                failed += 1
+                print(f"Job {job_id}: {status['message']}", file=sys.stderr)
+                continue
+            if status["state"] not in FINISHED_STATES:
+                continue
+            remaining.discard(job_id)
+            print(f"Scene {status['scene_id']}: {status['state']} - {status['message']}")
+            if status["state"] != "done":
+                failed += 1
+            elif args.output:
+                with open(os.path.join(args.output, f"{status['scene_id']}.json"), "w") as f:
+                    json.dump(status["result"], f, indent=2)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -7,8 +7,6 @@ __version__ = "0.25.0"
 # built-in
 import json
 import os
-import time
-from concurrent.futures import Future
 
 # external
 from flask import (Flask, Response, redirect, request, stream_with_context,
@@ -21,6 +19,9 @@ from loguru import logger
 # included
 from utils import db, generator, taghandler
 from utils.confighandler import ConfigHandler
+from utils.maintenance import maintenance
+from utils.torrentindex import torrent_index
+from utils.urlcache import url_cache
 from webui.webui import settings_page
 
 #############
@@ -56,6 +57,10 @@ migrate = Migrate(app, db.db)
 with app.app_context():
     db.upgrade()
 taghandler.setup(app)
+torrent_index.setup(app, config.torrent_dirs, config.get("backend", "torrent_scan_interval", 60))  # type: ignore
+url_cache.setup(app)
+maintenance.setup(app)
+generator.resume_jobs(app)
 bootstrap = Bootstrap5(app)
 csrf = CSRFProtect(app)
 
@@ -64,19 +69,14 @@ csrf = CSRFProtect(app)
 def generate():
     j = request.get_json()
     try:
-        future: Future = generator.jobs[j["id"]]
+        job = generator.job_store.get(j["id"])
     except KeyError:
         yield generator.error("Error getting job. Is your userscript updated?")
         return
-    except ValueError:
-        yield generator.error("Invalid job ID")
-        return
-    except IndexError:
+    if job is None:
         yield generator.error("Job does not exist")
         return
-    for msg in future.result():
-        yield msg
-        time.sleep(0.1)
+    yield from job.stream()
 
 
 @app.route("/submit", methods=["POST"])
@@ -111,6 +111,7 @@ def process_suggestions():
             ignored_tags.append(tag)
     taghandler.accept_suggestions(accepted_tags, j["tracker"])
     taghandler.reject_suggestions(ignored_tags)
+    taghandler.reload_index()
     return json.dumps({"status": "success", "data": {"message": "Tags saved"}})
 
 
@@ -128,6 +129,53 @@ def submit_job():
     return json.dumps({"id": job_id})
 
 
+@app.route("/generate/batch", methods=["POST"])
+@csrf.exempt
+def submit_batch():
+    j = request.get_json()
+    if "announce_url" not in j or ("scene_ids" not in j and "scene_filter" not in j):
+        return json.dumps({"status": "error", "message": "Batch requires an announce URL and scene IDs or a scene filter"}), 400
+    try:
+        job_ids = generator.add_batch(j)
+    except Exception as e:
+        logger.error(f"Failed to queue batch: {e}")
+        return json.dumps({"status": "error", "message": "Failed to find scenes in stash"}), 500
+    return json.dumps({"status": "success", "data": {"message": f"Queued {len(job_ids)} jobs", "jobs": job_ids}})
+
+
+@app.route("/jobs", methods=["GET"])
+@csrf.exempt
+def list_jobs():
+    return json.dumps([job.status() for job in generator.job_store.all()])
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+@csrf.exempt
+def job_status(job_id: str):
+    job = generator.job_store.get(job_id)
+    if job is None:
+        return json.dumps({"status": "error", "message": "Job does not exist"}), 404
+    return json.dumps(job.status())
+
+
+@app.route("/jobs/<job_id>/cancel", methods=["POST"])
+@csrf.exempt
+def cancel_job(job_id: str):
+    if generator.cancel_job(job_id):
+        logger.info(f"Cancelled job {job_id}")
+        return json.dumps({"status": "success", "data": {"message": "Job cancelled"}})
+    return json.dumps({"status": "error", "message": "Job does not exist or has already finished"}), 404
+
+
+@app.route("/jobs/<job_id>/retry", methods=["POST"])
+@csrf.exempt
+def retry_job(job_id: str):
+    if generator.retry_job(job_id):
+        logger.info(f"Retrying job {job_id}")
+        return json.dumps({"id": job_id})
+    return json.dumps({"status": "error", "message": "Job does not exist or has not failed"}), 404
+
+
 @app.route("/torrent/<path:filename>", methods=["GET"])
 @csrf.exempt
 def get_torrent(filename: str):
@@ -1,7 +1,7 @@
 // ==UserScript==
 // @name         Stash upload helper
 // @namespace    http://tampermonkey.net/
-// @version      1.2.1
+// @version      1.2.2
 // @description  This script helps create an upload for empornium based on a scene from your local stash instance.
 // @author       bdbenim
 // @match        https://www.empornium.sx/upload.php*
@@ -30,6 +30,8 @@
 // ==/UserScript==
 
 // Changelog:
+// v1.2.2
+//  - Read progress messages line by line so that several messages arriving at once are all processed
 // v1.2.1
 //  - Fix error when uploading torrent file from script
 // v1.2.0
@@ -400,324 +402,321 @@ function attachFile(blob, filename) {
                 onreadystatechange: async function (response) {
                     if (response.readyState === 2 && response.status === 200) {
                         const reader = response.response.getReader();
+                        const decoder = new TextDecoder();
+                        let buffer = "";
+                        let failed = false;
                         while (true) {
                             const {done, value} = await reader.read(); // value is Uint8Array
                             if (value) {
-                                let text = new TextDecoder().decode(value);
-                                let j;
-                                try {
-                                    j = JSON.parse(text);
-                                } catch (e) {
-                                    if (text.includes('"message": "Done"')) {
-                                        console.debug("The response stream was incomplete, reading until end of stream.");
-                                        const stashData = [];
-                                        stashData.push(text);
-                                        while (true) {
-                                            let {done, value} = await reader.read();
-                                            stashData.push(new TextDecoder().decode(value));
-                                            if (done) break;
-                                        }
-                                        text = stashData.join("");
+                                // Messages are newline-delimited and may be split or combined across chunks
+                                buffer += decoder.decode(value, {stream: true});
+                                const messages = buffer.split("\n");
+                                buffer = messages.pop();
+                                for (const text of messages) {
+                                    if (text.trim().length === 0) continue;
+                                    let j;
+                                    try {
                                         j = JSON.parse(text);
-                                    } else {
+                                    } catch (e) {
                                         console.warn("Unexpected failure to read stream data.");
                                     }
-                                }
-                                if (j) {
-                                    if (j.status === "success") {
-                                        if ("message" in j.data) {
-                                            this.context.statusArea.innerText = j.data.message;
-                                        }
-                                        if ("fill" in j.data) {
-                                            this.context.description.value = j.data.fill.description;
-                                            this.context.tags.value = j.data.fill.tags;
-                                            this.context.cover.value = j.data.fill.cover;
-                                            this.context.title.value = j.data.fill.title;
-
-                                            let torrentPath = j.data.fill.torrent_path;
-                                            let torrentName = torrentPath.split("/");
-                                            torrentName = torrentName[torrentName.length - 1];
-                                            if (!torrentPath.startsWith("/")) {
-                                                torrentPath = "/" + torrentPath;
+                                    if (j) {
+                                        if (j.status === "success") {
+                                            if ("message" in j.data) {
+                                                this.context.statusArea.innerText = j.data.message;
                                             }
-                                            let torrentUrl = new URL("/torrent" + torrentPath, BACKEND).href;
-
-                                            let instructions = "";
-                                            instructions += "Instructions:<ol>";
-                                            instructions += "<li>Set a category for the upload and double-check everything for correctness</li>";
-                                            instructions += '<li>Make sure the generated torrent is in your torrent client, and attach it to the upload form manually as usual:<div><a href="' + torrentUrl + '">' + j.data.fill.torrent_path + '</a></div></li>';
-                                            instructions += '<li>Make sure the media file is in the torrents path of your torrent client:<div><input type="text" value="' + j.data.fill.file_path + '" disabled></div></li>';
-                                            instructions += "</ol>";
-                                            this.context.instructions.innerHTML = instructions;
-
-                                            if ("anon" in j.data.fill) {
-                                                let radios = [];
-                                                for (const el of document.getElementsByTagName("input")) {
-                                                    if (el.type === "radio") {
-                                                        radios.push(el);
-                                                    }
+                                            if ("fill" in j.data) {
+                                                this.context.description.value = j.data.fill.description;
+                                                this.context.tags.value = j.data.fill.tags;
+                                                this.context.cover.value = j.data.fill.cover;
+                                                this.context.title.value = j.data.fill.title;
+
+                                                let torrentPath = j.data.fill.torrent_path;
+                                                let torrentName = torrentPath.split("/");
+                                                torrentName = torrentName[torrentName.length - 1];
+                                                if (!torrentPath.startsWith("/")) {
+                                                    torrentPath = "/" + torrentPath;
                                                 }
-                                                if (radios.length === 2) {
-                                                    if (j.data.fill.anon) {
-                                                        radios[1].checked = true;
-                                                    } else {
-                                                        radios[0].checked = true;
+                                                let torrentUrl = new URL("/torrent" + torrentPath, BACKEND).href;
+
+                                                let instructions = "";
+                                                instructions += "Instructions:<ol>";
+                                                instructions += "<li>Set a category for the upload and double-check everything for correctness</li>";
+                                                instructions += '<li>Make sure the generated torrent is in your torrent client, and attach it to the upload form manually as usual:<div><a href="' + torrentUrl + '">' + j.data.fill.torrent_path + '</a></div></li>';
+                                                instructions += '<li>Make sure the media file is in the torrents path of your torrent client:<div><input type="text" value="' + j.data.fill.file_path + '" disabled></div></li>';
+                                                instructions += "</ol>";
+                                                this.context.instructions.innerHTML = instructions;
+
+                                                if ("anon" in j.data.fill) {
+                                                    let radios = [];
+                                                    for (const el of document.getElementsByTagName("input")) {
+                                                        if (el.type === "radio") {
+                                                            radios.push(el);
+                                                        }
                                                     }
-                                                }
-                                            }
-                                            if ("suggestions" in j.data) {
-                                                let parent = document.getElementsByClassName("thin")[0];
-
-                                                let head = document.createElement("div");
-                                                head.classList.add("head");
-                                                head.id = "suggestions-head";
-                                                head.innerHTML = "Tag Suggestions";
-
-                                                let body = document.createElement("div");
-                                                body.classList.add("box", "pad");
-                                                body.id = "suggestions-body";
-
-                                                let table = document.createElement("table");
-                                                table.id = "tagsuggestions";
-                                                table.style.width = "1%";
-                                                table.style.marginLeft = "12pt";
-                                                let header = document.createElement("tr");
-                                                let stashTagHeader = document.createElement("th");
-                                                stashTagHeader.setAttribute("scope", "col");
-                                                stashTagHeader.style.marginLeft = "12pt";
-                                                stashTagHeader.style.marginRight = "auto";
-                                                stashTagHeader.innerText = "Stash Tag";
-
-                                                let empTagHeader = document.createElement("th");
-                                                empTagHeader.setAttribute("scope", "col");
-                                                empTagHeader.style.marginLeft = "12pt";
-                                                empTagHeader.style.marginRight = "auto";
-                                                empTagHeader.innerText = "EMP Tag";
-
-                                                let ignoreTagHeader = document.createElement("th");
-                                                ignoreTagHeader.setAttribute("scope", "col");
-                                                ignoreTagHeader.style.marginLeft = "12pt";
-                                                ignoreTagHeader.style.marginRight = "auto";
-                                                ignoreTagHeader.innerText = "Ignore? ";
-
-                                                let ignoreAll = document.createElement("input");
-                                                ignoreAll.type = "checkbox";
-                                                ignoreAll.addEventListener("change", function () {
-                                                    for (let checkbox of document.getElementsByClassName("tag-ignore")) {
-                                                        checkbox.checked = this.checked;
+                                                    if (radios.length === 2) {
+                                                        if (j.data.fill.anon) {
+                                                            radios[1].checked = true;
+                                                        } else {
+                                                            radios[0].checked = true;
+                                                        }
                                                     }
-                                                });
-                                                ignoreTagHeader.appendChild(ignoreAll);
-
-                                                header.appendChild(stashTagHeader);
-                                                header.appendChild(empTagHeader);
-                                                header.appendChild(ignoreTagHeader);
-
-                                                table.appendChild(header);
-
-                                                for (var key in j.data.suggestions) {
-                                                    if (j.data.suggestions.hasOwnProperty(key)) {
-                                                        let row = document.createElement("tr");
-
-                                                        let stashTagBox = document.createElement("td");
-                                                        stashTagBox.style.marginRight = "auto";
-                                                        stashTagBox.style.whiteSpace = "nowrap";
-                                                        let empTagBox = document.createElement("td");
-                                                        empTagBox.style.marginLeft = "12pt";
-                                                        empTagBox.style.marginRight = "auto";
-                                                        empTagBox.style.whiteSpace = "nowrap";
-                                                        let ignoreTagBox = document.createElement("td");
-                                                        ignoreTagBox.style.marginLeft = "12pt";
-                                                        ignoreTagBox.style.marginRight = "auto";
-                                                        ignoreTagBox.style.whiteSpace = "nowrap";
-                                                        ignoreTagBox.style.textAlign = "center";
-                                                        let acceptTagBox = document.createElement("td");
-                                                        acceptTagBox.style.marginLeft = "12pt";
-                                                        acceptTagBox.style.marginRight = "auto";
-                                                        acceptTagBox.style.whiteSpace = "nowrap";
-
-                                                        let tagDisplay = document.createElement("input");
-                                                        tagDisplay.setAttribute("type", "text");
-                                                        tagDisplay.setAttribute("disabled", true);
-                                                        tagDisplay.setAttribute("size", 30);
-                                                        tagDisplay.value = key;
-
-                                                        stashTagBox.appendChild(tagDisplay);
-                                                        row.appendChild(stashTagBox);
-
-                                                        let tagInput = document.createElement("input");
-                                                        tagInput.setAttribute("size", 30);
-                                                        tagInput.setAttribute("type", "text");
-                                                        tagInput.autocomplete = "on";
-                                                        tagInput.value = j.data.suggestions[key];
-                                                        if (unsafeWindow.AutoComplete) {
-                                                            unsafeWindow.AutoComplete.addInput(tagInput, "/tags.php");
+                                                }
+                                                if ("suggestions" in j.data) {
+                                                    let parent = document.getElementsByClassName("thin")[0];
+
+                                                    let head = document.createElement("div");
+                                                    head.classList.add("head");
+                                                    head.id = "suggestions-head";
+                                                    head.innerHTML = "Tag Suggestions";
+
+                                                    let body = document.createElement("div");
+                                                    body.classList.add("box", "pad");
+                                                    body.id = "suggestions-body";
+
+                                                    let table = document.createElement("table");
+                                                    table.id = "tagsuggestions";
+                                                    table.style.width = "1%";
+                                                    table.style.marginLeft = "12pt";
+                                                    let header = document.createElement("tr");
+                                                    let stashTagHeader = document.createElement("th");
+                                                    stashTagHeader.setAttribute("scope", "col");
+                                                    stashTagHeader.style.marginLeft = "12pt";
+                                                    stashTagHeader.style.marginRight = "auto";
+                                                    stashTagHeader.innerText = "Stash Tag";
+
+                                                    let empTagHeader = document.createElement("th");
+                                                    empTagHeader.setAttribute("scope", "col");
+                                                    empTagHeader.style.marginLeft = "12pt";
+                                                    empTagHeader.style.marginRight = "auto";
+                                                    empTagHeader.innerText = "EMP Tag";
+
+                                                    let ignoreTagHeader = document.createElement("th");
+                                                    ignoreTagHeader.setAttribute("scope", "col");
+                                                    ignoreTagHeader.style.marginLeft = "12pt";
+                                                    ignoreTagHeader.style.marginRight = "auto";
+                                                    ignoreTagHeader.innerText = "Ignore? ";
+
+                                                    let ignoreAll = document.createElement("input");
+                                                    ignoreAll.type = "checkbox";
+                                                    ignoreAll.addEventListener("change", function () {
+                                                        for (let checkbox of document.getElementsByClassName("tag-ignore")) {
+                                                            checkbox.checked = this.checked;
                                                         }
-
-                                                        empTagBox.appendChild(tagInput);
-                                                        row.appendChild(empTagBox);
-
-                                                        let ignoreInput = document.createElement("input");
-                                                        ignoreInput.setAttribute("type", "checkbox");
-                                                        ignoreInput.classList.add("tag-ignore");
-
-                                                        ignoreTagBox.appendChild(ignoreInput);
-                                                        row.appendChild(ignoreTagBox);
-
-                                                        let acceptTagButton = document.createElement("input");
-                                                        acceptTagButton.type = "submit";
-                                                        acceptTagButton.value = "Accept/Ignore Suggestion";
-                                                        acceptTagButton.addEventListener("click", function () {
-                                                            let acceptTags = [];
-                                                            let ignoreTags = [];
-                                                            if (ignoreInput.checked) {
-                                                                ignoreTags.push(tagDisplay.value);
-                                                            } else {
-                                                                acceptTags.push({
-                                                                    name: tagDisplay.value, emp: tagInput.value,
-                                                                });
-                                                                tag_form_input.value += " " + tagInput.value;
+                                                    });
+                                                    ignoreTagHeader.appendChild(ignoreAll);
+
+                                                    header.appendChild(stashTagHeader);
+                                                    header.appendChild(empTagHeader);
+                                                    header.appendChild(ignoreTagHeader);
+
+                                                    table.appendChild(header);
+
+                                                    for (var key in j.data.suggestions) {
+                                                        if (j.data.suggestions.hasOwnProperty(key)) {
+                                                            let row = document.createElement("tr");
+
+                                                            let stashTagBox = document.createElement("td");
+                                                            stashTagBox.style.marginRight = "auto";
+                                                            stashTagBox.style.whiteSpace = "nowrap";
+                                                            let empTagBox = document.createElement("td");
+                                                            empTagBox.style.marginLeft = "12pt";
+                                                            empTagBox.style.marginRight = "auto";
+                                                            empTagBox.style.whiteSpace = "nowrap";
+                                                            let ignoreTagBox = document.createElement("td");
+                                                            ignoreTagBox.style.marginLeft = "12pt";
+                                                            ignoreTagBox.style.marginRight = "auto";
+                                                            ignoreTagBox.style.whiteSpace = "nowrap";
+                                                            ignoreTagBox.style.textAlign = "center";
+                                                            let acceptTagBox = document.createElement("td");
+                                                            acceptTagBox.style.marginLeft = "12pt";
+                                                            acceptTagBox.style.marginRight = "auto";
+                                                            acceptTagBox.style.whiteSpace = "nowrap";
+
+                                                            let tagDisplay = document.createElement("input");
+                                                            tagDisplay.setAttribute("type", "text");
+                                                            tagDisplay.setAttribute("disabled", true);
+                                                            tagDisplay.setAttribute("size", 30);
+                                                            tagDisplay.value = key;
+
+                                                            stashTagBox.appendChild(tagDisplay);
+                                                            row.appendChild(stashTagBox);
+
+                                                            let tagInput = document.createElement("input");
+                                                            tagInput.setAttribute("size", 30);
+                                                            tagInput.setAttribute("type", "text");
+                                                            tagInput.autocomplete = "on";
+                                                            tagInput.value = j.data.suggestions[key];
+                                                            if (unsafeWindow.AutoComplete) {
+                                                                unsafeWindow.AutoComplete.addInput(tagInput, "/tags.php");
                                                             }
-                                                            GM_xmlhttpRequest({
-                                                                method: "POST",
-                                                                headers: {"Content-Type": "application/json"},
-                                                                url: new URL("/suggestions", BACKEND).href,
-                                                                responseType: "json",
-                                                                data: JSON.stringify({
-                                                                    accept: acceptTags,
-                                                                    ignore: ignoreTags,
-                                                                    tracker: getTracker(),
-                                                                }),
-                                                                context: {
-                                                                    statusArea: statusArea,
-                                                                },
-                                                                onload: function (response) {
-                                                                    try {
-                                                                        let j = JSON.parse(response.responseText);
-                                                                        if (j.status === "success") {
-                                                                            if ("message" in j.data) {
-                                                                                this.context.statusArea.innerText = j.data.message;
+
+                                                            empTagBox.appendChild(tagInput);
+                                                            row.appendChild(empTagBox);
+
+                                                            let ignoreInput = document.createElement("input");
+                                                            ignoreInput.setAttribute("type", "checkbox");
+                                                            ignoreInput.classList.add("tag-ignore");
+
+                                                            ignoreTagBox.appendChild(ignoreInput);
+                                                            row.appendChild(ignoreTagBox);
+
+                                                            let acceptTagButton = document.createElement("input");
+                                                            acceptTagButton.type = "submit";
+                                                            acceptTagButton.value = "Accept/Ignore Suggestion";
+                                                            acceptTagButton.addEventListener("click", function () {
+                                                                let acceptTags = [];
+                                                                let ignoreTags = [];
+                                                                if (ignoreInput.checked) {
+                                                                    ignoreTags.push(tagDisplay.value);
+                                                                } else {
+                                                                    acceptTags.push({
+                                                                        name: tagDisplay.value, emp: tagInput.value,
+                                                                    });
+                                                                    tag_form_input.value += " " + tagInput.value;
+                                                                }
+                                                                GM_xmlhttpRequest({
+                                                                    method: "POST",
+                                                                    headers: {"Content-Type": "application/json"},
+                                                                    url: new URL("/suggestions", BACKEND).href,
+                                                                    responseType: "json",
+                                                                    data: JSON.stringify({
+                                                                        accept: acceptTags,
+                                                                        ignore: ignoreTags,
+                                                                        tracker: getTracker(),
+                                                                    }),
+                                                                    context: {
+                                                                        statusArea: statusArea,
+                                                                    },
+                                                                    onload: function (response) {
+                                                                        try {
+                                                                            let j = JSON.parse(response.responseText);
+                                                                            if (j.status === "success") {
+                                                                                if ("message" in j.data) {
+                                                                                    this.context.statusArea.innerText = j.data.message;
+                                                                                }
+                                                                            } else if (j.status === "error") {
+                                                                                this.context.statusArea.innerHTML = "<span style='color: red;'>" + j.message + "</span>";
                                                                             }
-                                                                        } else if (j.status === "error") {
-                                                                            this.context.statusArea.innerHTML = "<span style='color: red;'>" + j.message + "</span>";
+                                                                        } catch (e) {
+                                                                            console.warn("Unexpected failure to parse text: " + response.responseText);
                                                                         }
-                                                                    } catch (e) {
-                                                                        console.warn("Unexpected failure to parse text: " + response.responseText);
-                                                                    }
-                                                                },
+                                                                    },
+                                                                });
+                                                                row.remove();
                                                             });
-                                                            row.remove();
-                                                        });
 
-                                                        acceptTagBox.appendChild(acceptTagButton);
-                                                        row.appendChild(acceptTagBox);
+                                                            acceptTagBox.appendChild(acceptTagButton);
+                                                            row.appendChild(acceptTagBox);
 
-                                                        table.appendChild(row);
+                                                            table.appendChild(row);
+                                                        }
                                                     }
-                                                }
 
-                                                let tagSubmitButton = document.createElement("input");
-                                                tagSubmitButton.setAttribute("type", "submit");
-                                                tagSubmitButton.value = "Accept/Ignore All Suggestions";
-                                                tagSubmitButton.style.marginLeft = "12pt";
-
-                                                body.appendChild(table);
-                                                body.appendChild(tagSubmitButton);
-
-                                                tagSubmitButton.addEventListener("click", () => {
-                                                    console.log("Accepting tag suggestions");
-                                                    let acceptTags = [];
-                                                    let ignoreTags = [];
-                                                    for (const row of Array.from(table.rows).slice(1)) {
-                                                        let stashTag = row.cells[0].childNodes[0].value;
-                                                        let empTag = row.cells[1].childNodes[0].value;
-                                                        let ignore = row.cells[2].childNodes[0].checked;
-                                                        if (ignore) {
-                                                            ignoreTags.push(stashTag);
-                                                        } else {
-                                                            acceptTags.push({name: stashTag, emp: empTag});
-                                                            tag_form_input.value += " " + empTag;
+                                                    let tagSubmitButton = document.createElement("input");
+                                                    tagSubmitButton.setAttribute("type", "submit");
+                                                    tagSubmitButton.value = "Accept/Ignore All Suggestions";
+                                                    tagSubmitButton.style.marginLeft = "12pt";
+
+                                                    body.appendChild(table);
+                                                    body.appendChild(tagSubmitButton);
+
+                                                    tagSubmitButton.addEventListener("click", () => {
+                                                        console.log("Accepting tag suggestions");
+                                                        let acceptTags = [];
+                                                        let ignoreTags = [];
+                                                        for (const row of Array.from(table.rows).slice(1)) {
+                                                            let stashTag = row.cells[0].childNodes[0].value;
+                                                            let empTag = row.cells[1].childNodes[0].value;
+                                                            let ignore = row.cells[2].childNodes[0].checked;
+                                                            if (ignore) {
+                                                                ignoreTags.push(stashTag);
+                                                            } else {
+                                                                acceptTags.push({name: stashTag, emp: empTag});
+                                                                tag_form_input.value += " " + empTag;
+                                                            }
                                                         }
-                                                    }
-                                                    head.remove();
-                                                    body.remove();
-                                                    GM_xmlhttpRequest({
-                                                        method: "POST",
-                                                        headers: {"Content-Type": "application/json"},
-                                                        url: new URL("/suggestions", BACKEND).href,
-                                                        responseType: "json",
-                                                        data: JSON.stringify({
-                                                            accept: acceptTags,
-                                                            ignore: ignoreTags,
-                                                            tracker: getTracker(),
-                                                        }),
-                                                        context: {
-                                                            statusArea: statusArea,
-                                                        },
-                                                        onload: function (response) {
-                                                            try {
-                                                                let j = JSON.parse(response.responseText);
-                                                                if (j.status === "success") {
-                                                                    if ("message" in j.data) {
-                                                                        this.context.statusArea.innerText = j.data.message;
+                                                        head.remove();
+                                                        body.remove();
+                                                        GM_xmlhttpRequest({
+                                                            method: "POST",
+                                                            headers: {"Content-Type": "application/json"},
+                                                            url: new URL("/suggestions", BACKEND).href,
+                                                            responseType: "json",
+                                                            data: JSON.stringify({
+                                                                accept: acceptTags,
+                                                                ignore: ignoreTags,
+                                                                tracker: getTracker(),
+                                                            }),
+                                                            context: {
+                                                                statusArea: statusArea,
+                                                            },
+                                                            onload: function (response) {
+                                                                try {
+                                                                    let j = JSON.parse(response.responseText);
+                                                                    if (j.status === "success") {
+                                                                        if ("message" in j.data) {
+                                                                            this.context.statusArea.innerText = j.data.message;
+                                                                        }
+                                                                    } else if (j.status === "error") {
+                                                                        this.context.statusArea.innerHTML = "<span style='color: red;'>" + j.message + "</span>";
                                                                     }
-                                                                } else if (j.status === "error") {
-                                                                    this.context.statusArea.innerHTML = "<span style='color: red;'>" + j.message + "</span>";
+                                                                } catch (e) {
+                                                                    console.warn("Unexpected failure to parse text: " + response.responseText);
                                                                 }
-                                                            } catch (e) {
-                                                                console.warn("Unexpected failure to parse text: " + response.responseText);
-                                                            }
-                                                        },
+                                                            },
+                                                        });
                                                     });
-                                                });
 
-                                                let tagCloseButton = document.createElement("input");
-                                                tagCloseButton.setAttribute("type", "submit");
-                                                tagCloseButton.value = "Close Suggestions";
-                                                tagCloseButton.style.marginLeft = "12pt";
-                                                tagCloseButton.addEventListener("click", function () {
-                                                    head.remove();
-                                                    body.remove();
-                                                });
+                                                    let tagCloseButton = document.createElement("input");
+                                                    tagCloseButton.setAttribute("type", "submit");
+                                                    tagCloseButton.value = "Close Suggestions";
+                                                    tagCloseButton.style.marginLeft = "12pt";
+                                                    tagCloseButton.addEventListener("click", function () {
+                                                        head.remove();
+                                                        body.remove();
+                                                    });
 
-                                                body.appendChild(tagCloseButton);
+                                                    body.appendChild(tagCloseButton);
 
-                                                parent.insertBefore(body, parent.children[7]);
-                                                parent.insertBefore(head, body);
-                                            }
+                                                    parent.insertBefore(body, parent.children[7]);
+                                                    parent.insertBefore(head, body);
+                                                }
 
-                                            // Download the torrent file:
-                                            GM_xmlhttpRequest({
-                                                method: "GET",
-                                                url: torrentUrl,
-                                                fetch: true,
-                                                responseType: "blob",
-                                                onreadystatechange: function (response) {
-                                                    if (response.readyState === XMLHttpRequest.DONE) {
-                                                        if (response.status === 200) {
-                                                            let blob = response.response;
-                                                            attachFile(blob, torrentName);
+                                                // Download the torrent file:
+                                                GM_xmlhttpRequest({
+                                                    method: "GET",
+                                                    url: torrentUrl,
+                                                    fetch: true,
+                                                    responseType: "blob",
+                                                    onreadystatechange: function (response) {
+                                                        if (response.readyState === XMLHttpRequest.DONE) {
+                                                            if (response.status === 200) {
+                                                                let blob = response.response;
+                                                                attachFile(blob, torrentName);
+                                                            }
                                                         }
                                                     }
-                                                }
-                                            })
+                                                })
 
+                                            }
+                                            if ("file" in j.data) {
+                                                // Deprecated. Maintains compatibility with stash-empornium v
+                                                let blob = b64toBlob(j.data.file.content, "application/x-bittorrent");
+                                                attachFile(blob, j.data.file.name);
+                                            }
+                                        } else if (j.status === "error") {
+                                            this.context.statusArea.innerHTML = "<span style='color: red;'>" + j.message + "</span>";
+                                            failed = true;
+                                            break;
                                         }
-                                        if ("file" in j.data) {
-                                            // Deprecated. Maintains compatibility with stash-empornium v
-                                            let blob = b64toBlob(j.data.file.content, "application/x-bittorrent");
-                                            attachFile(blob, j.data.file.name);
-                                        }
-                                    } else if (j.status === "error") {
-                                        this.context.statusArea.innerHTML = "<span style='color: red;'>" + j.message + "</span>";
-                                        break;
+                                    } else {
+                                        console.warn("The response was not read or not converted to JSON.");
+                                        console.debug(text);
                                     }
-                                } else {
-                                    console.warn("The response was not read or not converted to JSON.");
-                                    console.debug(text);
                                 }
                             }
-                            if (done) break;
+                            if (done || failed) break;
                         }
                     }
                 }
@@ -0,0 +1,27 @@
+"""Track when piece hashes were last used
+
+Revision ID: 2b7f5c3d8e16
+Revises: 6e4a2f9b1c57
+Create Date: 2026-10-17 10:12:44.360128
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '2b7f5c3d8e16'
+down_revision = '6e4a2f9b1c57'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('piece_hashes', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('used', sa.Float(), server_default='0', nullable=False))
+        batch_op.create_index(batch_op.f('ix_piece_hashes_used'), ['used'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('piece_hashes', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_piece_hashes_used'))
+        batch_op.drop_column('used')
@@ -0,0 +1,48 @@
+"""Add local image URL cache
+
+Revision ID: 3f6b1c8e9a24
+Revises: c4e9d2b7a613
+Create Date: 2026-10-16 22:41:09.184337
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '3f6b1c8e9a24'
+down_revision = 'c4e9d2b7a613'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('image_urls',
+                    sa.Column('host', sa.String(length=16), nullable=False),
+                    sa.Column('digest', sa.String(), nullable=False),
+                    sa.Column('url', sa.String(), nullable=False),
+                    sa.Column('created', sa.Float(), nullable=False),
+                    sa.PrimaryKeyConstraint('host', 'digest', name=op.f('pk_image_urls'))
+                    )
+    with op.batch_alter_table('image_urls', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_image_urls_created'), ['created'], unique=False)
+
+    op.create_table('scene_images',
+                    sa.Column('scene_id', sa.String(), nullable=False),
+                    sa.Column('kind', sa.String(length=16), nullable=False),
+                    sa.Column('digests', sa.String(), nullable=False),
+                    sa.Column('created', sa.Float(), nullable=False),
+                    sa.PrimaryKeyConstraint('scene_id', 'kind', name=op.f('pk_scene_images'))
+                    )
+    with op.batch_alter_table('scene_images', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_scene_images_created'), ['created'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('scene_images', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_scene_images_created'))
+
+    op.drop_table('scene_images')
+    with op.batch_alter_table('image_urls', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_image_urls_created'))
+
+    op.drop_table('image_urls')
@@ -0,0 +1,39 @@
+"""Add job queue
+
+Revision ID: 5d2a8c4e1f37
+Revises: feb7b60bf53f
+Create Date: 2026-10-16 09:12:40.518263
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '5d2a8c4e1f37'
+down_revision = 'feb7b60bf53f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('jobs',
+                    sa.Column('id', sa.String(length=32), nullable=False),
+                    sa.Column('data', sa.JSON(), nullable=False),
+                    sa.Column('state', sa.String(length=16), nullable=False),
+                    sa.Column('created', sa.Float(), nullable=False),
+                    sa.Column('finished', sa.Float(), nullable=True),
+                    sa.PrimaryKeyConstraint('id', name=op.f('pk_jobs'))
+                    )
+    op.create_table('job_stages',
+                    sa.Column('job_id', sa.String(length=32), nullable=False),
+                    sa.Column('stage', sa.String(), nullable=False),
+                    sa.Column('outputs', sa.JSON(), nullable=False),
+                    sa.ForeignKeyConstraint(['job_id'], ['jobs.id'],
+                                            name=op.f('fk_job_stages_job_id_jobs'), ondelete='CASCADE'),
+                    sa.PrimaryKeyConstraint('job_id', 'stage', name=op.f('pk_job_stages'))
+                    )
+
+
+def downgrade():
+    op.drop_table('job_stages')
+    op.drop_table('jobs')
@@ -0,0 +1,67 @@
+"""Merge tracker tag maps into one table
+
+Revision ID: 6e4a2f9b1c57
+Revises: 9c2d5e7f1a38
+Create Date: 2026-10-17 00:38:12.904613
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '6e4a2f9b1c57'
+down_revision = '9c2d5e7f1a38'
+branch_labels = None
+depends_on = None
+
+# The tables that are merged, the name of their gazelle tag column, and the tracker they were for
+TAG_MAPS = [
+    ('emp_tags', 'emptag_id', 'EMP'),
+    ('hf_tags', 'hftag_id', 'HF'),
+    ('fc_tags', 'fctag_id', 'FC'),
+    ('pb_tags', 'pbtag_id', 'PB'),
+    ('ent_tags', 'enttag_id', 'ENT'),
+    ('def_tags', 'gazelletag_id', 'DEFAULT'),
+]
+
+
+def upgrade():
+    op.create_table('tag_mappings',
+                    sa.Column('stashtag_id', sa.Integer(), nullable=False),
+                    sa.Column('tracker', sa.String(length=16), nullable=False),
+                    sa.Column('gazelletag_id', sa.Integer(), nullable=False),
+                    sa.ForeignKeyConstraint(['gazelletag_id'], ['gazelle_tags.id'],
+                                            name=op.f('fk_tag_mappings_gazelletag_id_gazelle_tags'),
+                                            ondelete='CASCADE'),
+                    sa.ForeignKeyConstraint(['stashtag_id'], ['stash_tag.id'],
+                                            name=op.f('fk_tag_mappings_stashtag_id_stash_tag'), ondelete='CASCADE'),
+                    sa.PrimaryKeyConstraint('stashtag_id', 'tracker', 'gazelletag_id', name=op.f('pk_tag_mappings'))
+                    )
+    with op.batch_alter_table('tag_mappings', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_tag_mappings_gazelletag_id'), ['gazelletag_id'], unique=False)
+
+    for table, column, tracker in TAG_MAPS:
+        op.execute(sa.text(f"INSERT OR IGNORE INTO tag_mappings (stashtag_id, tracker, gazelletag_id) "
+                           f"SELECT stashtag_id, '{tracker}', {column} FROM {table} "
+                           f"WHERE stashtag_id IS NOT NULL AND {column} IS NOT NULL"))
+        op.drop_table(table)
+
+
+def downgrade():
+    for table, column, tracker in TAG_MAPS:
+        op.create_table(table,
+                        sa.Column('stashtag_id', sa.Integer(), nullable=False),
+                        sa.Column(column, sa.Integer(), nullable=False),
+                        sa.ForeignKeyConstraint([column], ['gazelle_tags.id'],
+                                                name=op.f(f'fk_{table}_{column}_gazelle_tags'), ondelete='CASCADE'),
+                        sa.ForeignKeyConstraint(['stashtag_id'], ['stash_tag.id'],
+                                                name=op.f(f'fk_{table}_stashtag_id_stash_tag'), ondelete='CASCADE'),
+                        sa.PrimaryKeyConstraint('stashtag_id', column, name=op.f(f'pk_{table}'))
+                        )
+        op.execute(sa.text(f"INSERT INTO {table} (stashtag_id, {column}) "
+                           f"SELECT stashtag_id, gazelletag_id FROM tag_mappings WHERE tracker = '{tracker}'"))
+
+    with op.batch_alter_table('tag_mappings', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_tag_mappings_gazelletag_id'))
+
+    op.drop_table('tag_mappings')
@@ -0,0 +1,27 @@
+"""Add settings table
+
+Revision ID: 9c2d5e7f1a38
+Revises: 3f6b1c8e9a24
+Create Date: 2026-10-16 23:52:37.518204
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '9c2d5e7f1a38'
+down_revision = '3f6b1c8e9a24'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('settings',
+                    sa.Column('key', sa.String(), nullable=False),
+                    sa.Column('value', sa.String(), nullable=False),
+                    sa.PrimaryKeyConstraint('key', name=op.f('pk_settings'))
+                    )
+
+
+def downgrade():
+    op.drop_table('settings')
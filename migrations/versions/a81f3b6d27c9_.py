@@ -0,0 +1,32 @@
+"""Add piece hash cache
+
+Revision ID: a81f3b6d27c9
+Revises: 5d2a8c4e1f37
+Create Date: 2026-10-16 11:47:05.182930
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'a81f3b6d27c9'
+down_revision = '5d2a8c4e1f37'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('piece_hashes',
+                    sa.Column('device', sa.Integer(), nullable=False),
+                    sa.Column('inode', sa.Integer(), nullable=False),
+                    sa.Column('size', sa.Integer(), nullable=False),
+                    sa.Column('mtime', sa.Integer(), nullable=False),
+                    sa.Column('piece_length', sa.Integer(), nullable=False),
+                    sa.Column('pieces', sa.LargeBinary(), nullable=False),
+                    sa.PrimaryKeyConstraint('device', 'inode', 'size', 'mtime', 'piece_length',
+                                            name=op.f('pk_piece_hashes'))
+                    )
+
+
+def downgrade():
+    op.drop_table('piece_hashes')
@@ -0,0 +1,38 @@
+"""Add torrent index
+
+Revision ID: c4e9d2b7a613
+Revises: a81f3b6d27c9
+Create Date: 2026-10-16 14:05:51.730412
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'c4e9d2b7a613'
+down_revision = 'a81f3b6d27c9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('torrents',
+                    sa.Column('path', sa.String(), nullable=False),
+                    sa.Column('infohash', sa.String(length=40), nullable=False),
+                    sa.Column('name', sa.String(), nullable=False),
+                    sa.Column('size', sa.Integer(), nullable=False),
+                    sa.Column('files', sa.JSON(), nullable=False),
+                    sa.Column('tracker', sa.String(), nullable=True),
+                    sa.Column('source_path', sa.String(), nullable=True),
+                    sa.Column('mtime', sa.Float(), nullable=False),
+                    sa.PrimaryKeyConstraint('path', name=op.f('pk_torrents'))
+                    )
+    with op.batch_alter_table('torrents', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_torrents_infohash'), ['infohash'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('torrents', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_torrents_infohash'))
+
+    op.drop_table('torrents')
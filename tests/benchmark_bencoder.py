@@ -0,0 +1,39 @@
+"""Times decoding and infohash calculation for large torrents.
+
+Run from the repository root with `python -m tests.benchmark_bencoder`."""
+
+import hashlib
+import os
+import timeit
+
+from utils import bencoder
+
+
+def make_torrent(pieces: int, files: int) -> bytes:
+    return bencoder.encode({
+        b"announce": b"https://tracker/announce",
+        b"creation date": 1700000000,
+        b"info": {
+            b"files": [{b"length": 2 ** 20, b"path": [b"screens", f"{i}.jpg".encode()]} for i in range(files)],
+            b"name": b"scene",
+            b"piece length": 2 ** 23,
+            b"pieces": os.urandom(20 * pieces),
+            b"private": 1,
+            b"source": b"Emp",
+        },
+    })
+
+
+def reencoded_infohash(data: bytes) -> str:
+    return hashlib.sha1(bencoder.encode(bencoder.decode(data)[b"info"])).hexdigest()
+
+
+if __name__ == "__main__":
+    for pieces, files in [(1_000, 1), (10_000, 100), (50_000, 1_000)]:
+        data = make_torrent(pieces, files)
+        assert bencoder.infohash(data) == reencoded_infohash(data)
+        print(f"{pieces} pieces, {files} files ({len(data) // 1024} KiB)")
+        for name, func in [("decode", bencoder.decode), ("infohash", bencoder.infohash),
+                           ("decode + re-encode info", reencoded_infohash)]:
+            runs, total = timeit.Timer(lambda: func(data)).autorange()
+            print(f"  {name:<24}{total / runs * 1000:8.3f} ms")
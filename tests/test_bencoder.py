@@ -0,0 +1,43 @@
+import hashlib
+import os
+import unittest
+
+from utils import bencoder
+
+
+class MyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.torrent = {
+            b"announce": b"https://tracker/announce",
+            b"info": {
+                b"files": [{b"length": 100, b"path": [b"screens", b"1.jpg"]}, {b"length": 2 ** 40, b"path": [b"a.mp4"]}],
+                b"name": b"scene",
+                b"piece length": 2 ** 23,
+                b"pieces": os.urandom(20 * 12_000),
+                b"private": 1,
+            },
+            b"z": [-1, 0, b""],
+        }
+
+    def test_round_trip(self):
+        encoded = bencoder.encode(self.torrent)
+        self.assertEqual(self.torrent, bencoder.decode(encoded))
+        self.assertEqual(self.torrent, bencoder.decode(bytearray(encoded)))
+
+    def test_infohash(self):
+        encoded = bencoder.encode(self.torrent)
+        self.assertEqual(hashlib.sha1(bencoder.encode(self.torrent[b"info"])).hexdigest(), bencoder.infohash(encoded))
+        self.assertEqual("", bencoder.infohash(bencoder.encode({b"announce": b"x"})))
+        self.assertEqual("", bencoder.infohash(encoded[:-100]))
+
+    def test_deep_nesting(self):
+        self.assertEqual(1, len(bencoder.decode(b"l" * 10_000 + b"e" * 10_000)))
+
+    def test_malformed(self):
+        for data in [b"", b"i12", b"5:ab", b"l", b"x", b"d1:ae", b"die1:ae", b"i1ei2e", b"ie", b"i-e"]:
+            with self.assertRaises(ValueError, msg=data):
+                bencoder.decode(data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,25 @@
+import io
+import unittest
+
+from PIL import Image
+
+from utils.frames import frame_times, split_jpegs
+
+
+class MyTestCase(unittest.TestCase):
+    def test_split_jpegs(self):
+        images = []
+        for color in ["red", "green", "blue"]:
+            buffer = io.BytesIO()
+            Image.new("RGB", (64, 48), color).save(buffer, "JPEG")
+            images.append(buffer.getvalue())
+        self.assertEqual(images, split_jpegs(b"".join(images)))
+        self.assertEqual(images[:2], split_jpegs(b"".join(images)[:-1]))
+
+    def test_frame_times(self):
+        self.assertEqual([5.0, 50.0, 95.0], frame_times(100, 3))
+        self.assertEqual([50.0], frame_times(100, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import threading
+import time
+import unittest
+
+from utils import jobs
+from utils.jobs import Job, JobCancelled, JobStore, current_job
+
+
+class MyTestCase(unittest.TestCase):
+    def test_stream_replay(self):
+        job = Job({})
+        job.publish("a\n")
+        job.publish("b\n")
+        job.finish("done")
+        self.assertEqual(["a\n", "b\n"], list(job.stream()))
+        self.assertEqual(["a\n", "b\n"], list(job.stream()))
+        self.assertEqual(["b\n"], list(job.stream(1)))
+
+    def test_ttl_eviction(self):
+        store = JobStore(ttl=0)
+        job = Job({})
+        store.add(job)
+        self.assertIs(job, store.get(job.id))
+        job.finish("done")
+        time.sleep(0.01)
+        self.assertIsNone(store.get(job.id))
+
+    def test_max_finished(self):
+        store = JobStore(max_finished=2)
+        finished = [Job({}) for _ in range(3)]
+        running = Job({})
+        for job in finished + [running]:
+            store.add(job)
+        for job in finished:
+            job.finish("done")
+        self.assertEqual([finished[1], finished[2], running], sorted(store.all(), key=lambda j: j.created))
+
+    def test_cancel_kills_process(self):
+        job = Job({})
+        result = []
+
+        def target():
+            current_job.set(job)
+            try:
+                jobs.run(["sleep", "30"])
+            except JobCancelled:
+                result.append("cancelled")
+
+        thread = threading.Thread(target=target)
+        thread.start()
+        time.sleep(0.2)
+        self.assertTrue(job.cancel())
+        thread.join(timeout=5)
+        self.assertEqual(["cancelled"], result)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import time
+import unittest
+
+from utils.pipeline import Pipeline, Stage, StageError
+
+
+class MyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+
+        def double(x):
+            self.calls.append("double")
+            return {"y": x * 2}
+
+        def increment(y):
+            self.calls.append("increment")
+            return {"z": y + 1}
+
+        def unused(x):
+            self.calls.append("unused")
+            return {"w": x}
+
+        def result(z):
+            self.calls.append("result")
+            return {"result": z}
+
+        self.pipeline = Pipeline([Stage(double, ("y",)), Stage(increment, ("z",), persist=True),
+                                  Stage(unused, ("w",)), Stage(result, ("result",))])
+
+    def test_run_all(self):
+        values = self.pipeline.run({"x": 1})
+        self.assertEqual(3, values["result"])
+        self.assertCountEqual(["double", "increment", "unused", "result"], self.calls)
+
+    def test_resume(self):
+        values = self.pipeline.run({"x": 1, "z": 10}, targets=("result",))
+        self.assertEqual(10, values["result"])
+        self.assertEqual(["result"], self.calls)
+
+    def test_on_stage_done(self):
+        done = {}
+        self.pipeline.run({"x": 1}, targets=("result",), on_stage_done=lambda s, o: done.update({s.name: o}))
+        self.assertEqual({"double": {"y": 2}, "increment": {"z": 3}, "result": {"result": 3}}, done)
+
+    def test_error_waits_for_running_stages(self):
+        def slow(x):
+            time.sleep(0.2)
+            self.calls.append("slow")
+            return {"s": x}
+
+        def fail(x):
+            raise StageError("failed")
+
+        pipeline = Pipeline([Stage(slow, ("s",), "io"), Stage(fail, ("f",), "network")])
+        with self.assertRaises(StageError):
+            pipeline.run({"x": 1})
+        self.assertEqual(["slow"], self.calls)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from flask import Flask
+
+# The config is read when a TagHandler is made, so use an empty directory rather than ./config
+sys.argv = [sys.argv[0], "--configdir", tempfile.mkdtemp()]
+
+from utils import taghandler  # noqa: E402
+from utils.db import DEFAULT_TRACKER, TRACKERS, Category, GazelleTag, StashTag, TagMapping, db  # noqa: E402
+
+
+class MyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+        db.init_app(self.app)
+        context = self.app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+        db.create_all()
+
+        gazelle = {name: GazelleTag(tagname=name) for name in
+                   ["blowjob", "oral", "anal", "big.tits", "ignored.tag"]}
+        tits = Category(name="tits")
+        db.session.add_all([
+            # Mapped for one tracker and by default
+            StashTag(tagname="Blowjob", mappings=[TagMapping(tracker="EMP", gazelle_tag=gazelle["blowjob"]),
+                                                  TagMapping(tracker=DEFAULT_TRACKER, gazelle_tag=gazelle["oral"])]),
+            # Only mapped by default
+            StashTag(tagname="Anal", mappings=[TagMapping(tracker=DEFAULT_TRACKER, gazelle_tag=gazelle["anal"])]),
+            StashTag(tagname="Big Tits", display="Big Boobs", categories=[tits],
+                     mappings=[TagMapping(tracker=DEFAULT_TRACKER, gazelle_tag=gazelle["big.tits"])]),
+            StashTag(tagname="Hidden", ignored=True,
+                     mappings=[TagMapping(tracker=DEFAULT_TRACKER, gazelle_tag=gazelle["ignored.tag"])]),
+            StashTag(tagname="Unmapped"),
+        ])
+        db.session.commit()
+        self.index = taghandler.build_index()
+
+    @staticmethod
+    def query_tags(tag: str, tracker: str) -> list[str]:
+        """Look up the tags of a stash tag with the database, the way it was done before the index."""
+        s_tag = db.session.execute(db.select(StashTag).filter_by(tagname=tag)).scalar_one()
+        tags = s_tag.gazelle_tags(tracker) or s_tag.gazelle_tags()
+        return sorted(t.tagname for t in tags)
+
+    def test_matches_database(self):
+        for s_tag in db.session.execute(db.select(StashTag)).scalars():
+            entry = self.index.get(s_tag.tagname)
+            self.assertIsNotNone(entry)
+            self.assertEqual(s_tag.ignored, entry.ignored)
+            self.assertEqual(s_tag.display, entry.display)
+            self.assertEqual([c.name for c in s_tag.categories], list(entry.categories))
+            for tracker in TRACKERS:
+                self.assertEqual(self.query_tags(s_tag.tagname, tracker), sorted(entry.gazelle_tags(tracker)))
+
+    def test_lookup(self):
+        self.assertEqual(("blowjob",), self.index.get("BLOWJOB").gazelle_tags("EMP"))
+        self.assertEqual(("oral",), self.index.get("blowjob").gazelle_tags("PB"))
+        self.assertEqual((), self.index.get("Unmapped").gazelle_tags("EMP"))
+        self.assertIsNone(self.index.get("Unknown"))
+        self.assertEqual(("tits",), self.index.categories)
+
+    def test_process_tags(self):
+        with patch.object(taghandler, "tag_index", self.index):
+            handler = taghandler.TagHandler()
+        for tag in ["blowjob", "Anal", "Big Tits", "Hidden", "Unmapped", "Unknown"]:
+            handler.process_tag(tag, "EMP")
+        self.assertEqual({"blowjob", "anal", "big.tits"}, handler.tags)
+        self.assertEqual({"Unmapped", "Unknown"}, set(handler.tag_suggestions))
+        self.assertEqual({"tits": {"Big Boobs"}}, handler.tag_sets)
+        with self.assertRaises(ValueError):
+            handler.process_tag("Anal", "Unknown tracker")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+import hashlib
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from utils import bencoder, torrent, torrentclients
+from utils.torrentindex import TorrentIndex
+
+
+class MyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        os.mkdir(os.path.join(self.dir.name, "screens"))
+        self.contents = {
+            "video.mp4": os.urandom(100_000),
+            os.path.join("screens", "1.jpg"): os.urandom(3_000),
+            os.path.join("screens", "2.jpg"): b"",
+            "cover.jpg": os.urandom(40_000),
+        }
+        for name, data in self.contents.items():
+            with open(os.path.join(self.dir.name, name), "wb") as f:
+                f.write(data)
+
+    def expected_pieces(self, files: list[str], length: int) -> bytes:
+        data = b"".join(self.contents[f] for f in files)
+        return b"".join(hashlib.sha1(data[i:i + length]).digest() for i in range(0, len(data), length))
+
+    def test_single_file(self):
+        path = os.path.join(self.dir.name, "video.mp4")
+        data = bencoder.decode(torrent.make_torrent(path, "https://tracker/announce", "Emp"))
+        info = data[b"info"]
+        self.assertEqual(b"video.mp4", info[b"name"])
+        self.assertEqual(100_000, info[b"length"])
+        self.assertEqual(self.expected_pieces(["video.mp4"], info[b"piece length"]), info[b"pieces"])
+
+    def test_directory(self):
+        torrent.BLOCK_SIZE = 1  # Hash one piece per block so that blocks span files
+        self.addCleanup(setattr, torrent, "BLOCK_SIZE", 32 * 1024 * 1024)
+        data = bencoder.decode(torrent.make_torrent(self.dir.name, "https://tracker/announce", "Emp"))
+        info = data[b"info"]
+        order = ["cover.jpg", os.path.join("screens", "1.jpg"), os.path.join("screens", "2.jpg"), "video.mp4"]
+        self.assertEqual([[p.encode() for p in f.split(os.sep)] for f in order], [f[b"path"] for f in info[b"files"]])
+        self.assertEqual(self.expected_pieces(order, info[b"piece length"]), info[b"pieces"])
+
+    def test_directory_with_one_file(self):
+        path = os.path.join(self.dir.name, "screens", "1.jpg")
+        os.remove(os.path.join(self.dir.name, "screens", "2.jpg"))
+        data = bencoder.decode(torrent.make_torrent(os.path.dirname(path), "https://tracker/announce", "Emp"))
+        info = data[b"info"]
+        self.assertEqual(b"screens", info[b"name"])
+        self.assertNotIn(b"length", info)
+        self.assertEqual([{b"length": 3_000, b"path": [b"1.jpg"]}], info[b"files"])
+
+    def test_cached_pieces(self):
+        class Cache(dict):
+            def set(self, key, pieces):
+                self[key] = pieces
+
+        cache = Cache()
+        path = os.path.join(self.dir.name, "video.mp4")
+        emp = bencoder.decode(torrent.make_torrent(path, "https://emp/announce", "Emp", cache=cache))
+        self.assertEqual(1, len(cache))
+        key = next(iter(cache))
+        cache[key] = b"x" * len(cache[key])
+        pb = bencoder.decode(torrent.make_torrent(path, "https://pb/announce", "PBay", cache=cache))
+        self.assertEqual(b"x" * len(emp[b"info"][b"pieces"]), pb[b"info"][b"pieces"])
+        self.assertEqual(b"PBay", pb[b"info"][b"source"])
+
+
+    def make_torrent_file(self) -> str:
+        path = os.path.join(self.dir.name, "..", os.path.basename(self.dir.name) + ".torrent")
+        with open(path, "wb") as f:
+            f.write(torrent.make_torrent(self.dir.name, "https://tracker/announce", "Emp"))
+        self.addCleanup(os.remove, path)
+        return path
+
+    def test_fast_resume(self):
+        path = self.make_torrent_file()
+        with open(path, "rb") as f:
+            data = f.read()
+        order = ["cover.jpg", os.path.join("screens", "1.jpg"), os.path.join("screens", "2.jpg"), "video.mp4"]
+        resume = bencoder.decode(torrentclients.add_fast_resume(data, [os.path.join(self.dir.name, f) for f in order]))
+        self.assertEqual(32 * 1024, resume[b"info"][b"piece length"])
+        # 143,000 bytes in 32 KiB pieces: the cover fills pieces 0-1, 1.jpg falls within piece 1,
+        # 2.jpg is empty, and the video starts in piece 1 and ends in piece 4
+        self.assertEqual(5, resume[b"libtorrent_resume"][b"bitfield"])
+        self.assertEqual([2, 1, 0, 4], [f[b"completed"] for f in resume[b"libtorrent_resume"][b"files"]])
+        self.assertEqual([int(os.path.getmtime(os.path.join(self.dir.name, f))) for f in order],
+                         [f[b"mtime"] for f in resume[b"libtorrent_resume"][b"files"]])
+
+    def test_fast_resume_single_file(self):
+        path = os.path.join(self.dir.name, "video.mp4")
+        data = torrent.make_torrent(path, "https://tracker/announce", "Emp")
+        resume = bencoder.decode(torrentclients.add_fast_resume(data, [path]))
+        self.assertEqual([4], [f[b"completed"] for f in resume[b"libtorrent_resume"][b"files"]])
+
+    def test_verified(self):
+        index = TorrentIndex()
+        self.addCleanup(patch.stopall)
+        patch.object(torrentclients, "torrent_index", index).start()
+        client = torrentclients.TorrentClient({})
+        path = self.make_torrent_file()
+        self.assertFalse(client.verified(path))
+
+        index.add(path, self.dir.name)
+        self.assertTrue(client.verified(path))
+
+        video = os.path.join(self.dir.name, "video.mp4")
+        mtime = os.path.getmtime(path)
+        os.utime(video, (mtime + 10, mtime + 10))
+        self.assertFalse(client.verified(path))
+
+        os.utime(video, (mtime - 10, mtime - 10))
+        self.assertTrue(client.verified(path))
+        with open(video, "ab") as f:
+            f.write(b"x")
+        os.utime(video, (mtime - 10, mtime - 10))
+        self.assertFalse(client.verified(path))
+
+        os.remove(video)
+        self.assertFalse(client.verified(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
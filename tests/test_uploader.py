@@ -0,0 +1,101 @@
+import asyncio
+import sys
+import tempfile
+import unittest
+
+# The config is read on import, so use an empty directory rather than ./config
+sys.argv = [sys.argv[0], "--configdir", tempfile.mkdtemp()]
+
+from utils import uploader  # noqa: E402
+from utils.uploader import Upload, Uploader  # noqa: E402
+
+HEDGE_DELAY = 0.05
+
+
+class MyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.uploader = Uploader()
+        self.uploader.hedge_delay = lambda host: HEDGE_DELAY
+        self.uploads: list[str] = []
+        self.hosts = {"hamster": self.fast, "imgbox": self.fast}
+
+        async def hamster(upload):
+            return await self.hosts["hamster"]("hamster", upload)
+
+        async def imgbox(upload, gallery):
+            return await self.hosts["imgbox"]("imgbox", upload)
+
+        self.uploader._hamster_upload = hamster
+        self.uploader._imgbox_upload = imgbox
+        self.addCleanup(self.stop_loop)
+
+    def stop_loop(self):
+        if self.uploader.loop is not None:
+            self.uploader.loop.call_soon_threadsafe(self.uploader.loop.stop)
+
+    async def fast(self, host, upload):
+        self.uploads.append(host)
+        return f"https://{host}/{upload.path}"
+
+    async def slow(self, host, upload):
+        self.uploads.append(host)
+        await asyncio.sleep(10)
+        return f"https://{host}/{upload.path}"
+
+    async def failing(self, host, upload):
+        self.uploads.append(host)
+        raise RuntimeError("Host is down")
+
+    def upload(self, *hosts):
+        return self.uploader.upload([[(host, Upload("image.jpg", "image/jpeg", "jpg")) for host in hosts]])[0]
+
+    def test_fast_host(self):
+        prepared = []
+
+        def prepare():
+            prepared.append("imgbox")
+            return Upload("image.jpg", "image/jpeg", "jpg")
+
+        result = self.uploader.upload([[("hamster", Upload("image.jpg", "image/jpeg", "jpg")), ("imgbox", prepare)]])
+        self.assertEqual([("https://hamster/image.jpg", "hamster")], result)
+        self.assertEqual(["hamster"], self.uploads)
+        self.assertEqual([], prepared)
+
+    def test_slow_host_is_hedged(self):
+        self.hosts["hamster"] = self.slow
+        self.assertEqual(("https://imgbox/image.jpg", "imgbox"), self.upload("hamster", "imgbox"))
+        self.assertEqual(["hamster", "imgbox"], self.uploads)
+        # The abandoned upload still counts towards the hedge delay
+        health = self.uploader.health["hamster"]
+        self.assertEqual([], list(health.outcomes))
+        self.assertEqual(1, len(health.latencies))
+        self.assertGreaterEqual(health.latencies[0], HEDGE_DELAY)
+
+    def test_failing_host(self):
+        self.hosts["hamster"] = self.failing
+        self.assertEqual(("https://imgbox/image.jpg", "imgbox"), self.upload("hamster", "imgbox"))
+        self.assertEqual([False], list(self.uploader.health["hamster"].outcomes))
+        self.assertEqual([True], list(self.uploader.health["imgbox"].outcomes))
+
+    def test_every_host_fails(self):
+        self.hosts = {"hamster": self.failing, "imgbox": self.failing}
+        self.assertEqual((None, None), self.upload("hamster", "imgbox"))
+
+    def test_unhealthy_host_is_tried_last(self):
+        for _ in range(uploader.HEALTH_MIN_SAMPLES):
+            self.uploader._health("hamster").record(1, False)
+        self.assertEqual(("https://imgbox/image.jpg", "imgbox"), self.upload("hamster", "imgbox"))
+        self.assertEqual(["imgbox"], self.uploads)
+
+    def test_preparation_error(self):
+        def prepare():
+            raise OSError("cannot identify image file")
+
+        result = self.uploader.upload([[("hamster", prepare), ("imgbox", Upload("image.jpg", "image/jpeg", "jpg"))]])
+        self.assertEqual([("https://imgbox/image.jpg", "imgbox")], result)
+        # Failing to prepare the file says nothing about the host
+        self.assertEqual([], list(self.uploader.health["hamster"].outcomes))
+
+
+if __name__ == '__main__':
+    unittest.main()
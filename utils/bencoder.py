@@ -1,7 +1,8 @@
-import re
-import string
 import itertools as it
 import hashlib
+from typing import Any
+
+_INT, _LIST, _DICT, _END, _COLON, _ZERO, _NINE = b"ilde:09"
 
 
 def encode(obj):
@@ -51,47 +52,104 @@ def decode(s):
     >>> decode(b'd3:bar4:spam3:fooi42ee') == {b'bar': b'spam', b'foo': 42}
     True
     """
+    if isinstance(s, str):
+        s = s.encode("ascii")
+    data = memoryview(s).cast("B")
+    ret, end = _decode(data, 0)
+    if end != len(data):
+        raise ValueError("Malformed input.")
+    return ret
+
+
+def _read_int(data: memoryview, index: int, terminator: int) -> tuple[int, int]:
+    """Parse the digits starting at `index` up to `terminator`, returning the value and the index after it."""
+    end = index
+    while end < len(data) and data[end] != terminator:
+        end += 1
+    if end == len(data) or end == index:
+        raise ValueError("Malformed input.")
+    try:
+        value = int(str(data[index:end], "ascii"))
+    except (UnicodeDecodeError, ValueError):
+        raise ValueError("Malformed input.")
+    return value, end + 1
+
 
-    def decode_first(s):
-        if s.startswith(b"i"):
-            match = re.match(b"i(-?\\d+)e", s)
-            assert match is not None
-            return int(match.group(1)), s[match.span()[1] :]
-        elif s.startswith(b"l") or s.startswith(b"d"):
-            l = []
-            rest = s[1:]
-            while not rest.startswith(b"e"):
-                elem, rest = decode_first(rest)
-                l.append(elem)
-            rest = rest[1:]
-            if s.startswith(b"l"):
-                return l, rest
-            else:
-                return {i: j for i, j in zip(l[::2], l[1::2])}, rest
-        elif any(s.startswith(i.encode()) for i in string.digits):
-            m = re.match(b"(\\d+):", s)
-            assert m is not None
-            length = int(m.group(1))
-            rest_i = m.span()[1]
-            start = rest_i
-            end = rest_i + length
-            return s[start:end], s[end:]
+def _decode(data: memoryview, index: int, build: bool = True) -> tuple[Any, int]:
+    """
+    Decode the value starting at `index` without recursion or copying the
+    input. When `build` is false the value is only skipped over.
+    :return: The value, and the index just past its end
+    """
+    # Each frame holds a container being filled and, for dicts, the key waiting for its value
+    stack: list[list] = []
+    while True:
+        if index >= len(data):
+            raise ValueError("Malformed input.")
+        c = data[index]
+        if c == _LIST or c == _DICT:
+            stack.append([[] if c == _LIST else {}, None] if build else [None, None])
+            index += 1
+            continue
+        if c == _END:
+            if not stack:
+                raise ValueError("Malformed input.")
+            container, key = stack.pop()
+            if key is not None:
+                raise ValueError("Malformed input.")
+            value = container
+            index += 1
+        elif c == _INT:
+            value, index = _read_int(data, index + 1, _END)
+        elif _ZERO <= c <= _NINE:
+            length, start = _read_int(data, index, _COLON)
+            index = start + length
+            if index > len(data):
+                raise ValueError("Malformed input.")
+            value = data[start:index].tobytes() if build else None
         else:
             raise ValueError("Malformed input.")
 
-    if isinstance(s, str):
-        s = s.encode("ascii")
+        if not stack:
+            return value, index
+        frame = stack[-1]
+        if not build:
+            continue
+        if isinstance(frame[0], list):
+            frame[0].append(value)
+        elif frame[1] is None:
+            if not isinstance(value, bytes):
+                raise ValueError("dict keys should be bytes")
+            frame[1] = value
+        else:
+            frame[0][frame[1]] = value
+            frame[1] = None
 
-    ret, rest = decode_first(s)
-    if rest:
+
+def info_span(f: bytes) -> tuple[int, int]:
+    """
+    Find the bytes of the info dict of a torrent, so that it can be hashed
+    exactly as it was encoded.
+
+    >>> info_span(b'd8:announce3:url4:infod4:name1:aee')
+    (22, 33)
+    """
+    data = memoryview(f).cast("B")
+    if not data or data[0] != _DICT:
         raise ValueError("Malformed input.")
-    return ret
+    index = 1
+    while index < len(data) and data[index] != _END:
+        key, index = _decode(data, index)
+        start = index
+        _, index = _decode(data, index, build=False)
+        if key == b"info":
+            return start, index
+    raise ValueError("Torrent has no info dict")
 
 
 def infohash(f: bytes) -> str:
-    data = decode(f)
     try:
-        assert isinstance(data, dict) and b"info" in data
-        return hashlib.sha1(encode(data[b"info"])).hexdigest()
-    except:
+        start, end = info_span(f)
+        return hashlib.sha1(memoryview(f)[start:end]).hexdigest()
+    except ValueError:
         return ""
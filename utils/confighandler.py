@@ -68,6 +68,8 @@ findScene(id: "{}") {{
         screenshot
         preview
         webp
+        sprite
+        vtt
     }}
     files {{
         id
@@ -86,6 +88,16 @@ findScene(id: "{}") {{
 }}
 """
 
+find_scenes_query = """
+query FindScenes($scene_filter: SceneFilterType) {
+    findScenes(scene_filter: $scene_filter, filter: {per_page: -1}) {
+        scenes {
+            id
+        }
+    }
+}
+"""
+
 
 def logging_init(log: str, level: int = 0) -> None:
     def level_filter(level_name):
@@ -1,14 +1,20 @@
+import time
 from loguru import logger
 from typing import Any
 
 import sqlalchemy.exc
+from alembic.script import ScriptDirectory
+from flask import current_app
 from flask_migrate import upgrade as fm_upgrade
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import MetaData, String, Integer, ForeignKey, Column, Boolean, text
+from sqlalchemy import MetaData, String, Integer, ForeignKey, Column, Boolean, Float, JSON, LargeBinary, text
 from sqlalchemy.orm import DeclarativeBase, mapped_column, Mapped
 
 __schema__ = 2
 
+# The setting holding the hash of the tag config that was last seeded into the database. See `utils.taghandler`.
+TAG_SEED_KEY = "tag_seed_hash"
+
 
 class Base(DeclarativeBase):
     metadata = MetaData(
@@ -26,17 +32,20 @@ db = SQLAlchemy(model_class=Base)
 
 
 def upgrade():
+    """Migrate the database to the latest revision, unless it is already there."""
     base_rev = '7990cc760362'
     t = text(f"INSERT INTO alembic_version VALUES('{base_rev}')")
+    revision = None
     with db.engine.connect() as con:
         with con.begin():
             # con.execute(text("PRAGMA foreign_keys = ON"))  # sqlite ignores foreign keys otherwise
             try:
                 stmt = text("SELECT version_num FROM alembic_version")
-                result = con.execute(stmt).first()[0]
-                logger.debug(f"DB revision: {result}")
+                revision = con.execute(stmt).first()[0]
+                logger.debug(f"DB revision: {revision}")
             except TypeError:
                 con.execute(t)
+                revision = base_rev
             except sqlalchemy.exc.OperationalError:
                 try:
                     con.execute(text("SELECT COUNT(*) FROM stash_tag")).first()  # Confirm that DB is not empty
@@ -46,61 +55,53 @@ def upgrade():
                 CONSTRAINT alembic_version_pkc PRIMARY KEY (version_num)
         )"""))
                     con.execute(t)
+                    revision = base_rev
                 except sqlalchemy.exc.OperationalError:
                     pass  # DB was empty, so allow Alembic to create
-        fm_upgrade()
-        con.execute(text("VACUUM"))
-        con.commit()
+    if revision in migration_heads():
+        logger.debug("DB is up to date")
+        return
+    logger.info("Upgrading DB")
+    fm_upgrade()
 
 
-emp_tag_map = db.Table(
-    "emp_tags",
-    Column("stashtag_id",
-           ForeignKey("stash_tag.id", ondelete="CASCADE"), primary_key=True),
-    Column("emptag_id",
-           ForeignKey("gazelle_tags.id", ondelete="CASCADE"), primary_key=True)
-)
+def migration_heads() -> set[str]:
+    """The latest revisions in the migrations directory, read without connecting to the database."""
+    migrate = current_app.extensions["migrate"]
+    config = migrate.migrate.get_config(migrate.directory)
+    return set(ScriptDirectory.from_config(config).get_heads())
 
-hf_tag_map = db.Table(
-    "hf_tags",
-    Column("stashtag_id",
-           ForeignKey("stash_tag.id", ondelete="CASCADE"), primary_key=True),
-    Column("hftag_id",
-           ForeignKey("gazelle_tags.id", ondelete="CASCADE"), primary_key=True)
-)
 
-fc_tag_map = db.Table(
-    "fc_tags",
-    Column("stashtag_id",
-           ForeignKey("stash_tag.id", ondelete="CASCADE"), primary_key=True),
-    Column("fctag_id",
-           ForeignKey("gazelle_tags.id", ondelete="CASCADE"), primary_key=True)
-)
+def database_stats() -> tuple[int, float]:
+    """The size of the database file in bytes, and the fraction of it that is unused pages."""
+    with db.engine.connect() as con:
+        page_size = con.execute(text("PRAGMA page_size")).scalar()
+        page_count = con.execute(text("PRAGMA page_count")).scalar()
+        free = con.execute(text("PRAGMA freelist_count")).scalar()
+    return page_size * page_count, free / page_count if page_count else 0.0
 
-pb_tag_map = db.Table(
-    "pb_tags",
-    Column("stashtag_id",
-           ForeignKey("stash_tag.id", ondelete="CASCADE"), primary_key=True),
-    Column("pbtag_id",
-           ForeignKey("gazelle_tags.id", ondelete="CASCADE"), primary_key=True)
-)
 
-ent_tag_map = db.Table(
-    "ent_tags",
-    Column("stashtag_id",
-           ForeignKey("stash_tag.id", ondelete="CASCADE"), primary_key=True),
-    Column("enttag_id",
-           ForeignKey("gazelle_tags.id", ondelete="CASCADE"), primary_key=True)
-)
+def vacuum() -> None:
+    with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as con:
+        con.execute(text("VACUUM"))
 
-# Default tag maps to be used if tracker-specific maps are unavailable
-def_tag_map = db.Table(
-    "def_tags",
-    Column("stashtag_id",
-           ForeignKey("stash_tag.id", ondelete="CASCADE"), primary_key=True),
-    Column("gazelletag_id",
-           ForeignKey("gazelle_tags.id", ondelete="CASCADE"), primary_key=True)
-)
+
+def analyze() -> None:
+    """Update the query planner statistics of the tables that need it."""
+    with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as con:
+        con.execute(text("PRAGMA optimize"))
+
+
+# Trackers that stash tags can be mapped for, by the code used in requests, with their full names
+TRACKERS = {
+    "EMP": "Empornium",
+    "PB": "Pornbay",
+    "FC": "Femdom Cult",
+    "HF": "Happy Fappy",
+    "ENT": "Enthralled",
+}
+# Tag maps to be used if tracker-specific maps are unavailable are stored under this tracker
+DEFAULT_TRACKER = "DEFAULT"
 
 list_tags = db.Table(
     "tag_categories",
@@ -113,24 +114,17 @@ class GazelleTag(db.Model):
     __tablename__ = "gazelle_tags"
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     tagname: Mapped[str] = mapped_column(String(32), unique=True, nullable=False)
-    emp_stash_tags: Mapped[list["StashTag"]] = db.relationship(secondary=emp_tag_map,
-                                                               back_populates="emp_tags",
-                                                               passive_deletes=True)  # type: ignore
-    hf_stash_tags: Mapped[list["StashTag"]] = db.relationship(secondary=hf_tag_map,
-                                                              back_populates="hf_tags",
-                                                              passive_deletes=True)  # type: ignore
-    fc_stash_tags: Mapped[list["StashTag"]] = db.relationship(secondary=fc_tag_map,
-                                                              back_populates="fc_tags",
-                                                              passive_deletes=True)  # type: ignore
-    pb_stash_tags: Mapped[list["StashTag"]] = db.relationship(secondary=pb_tag_map,
-                                                              back_populates="pb_tags",
-                                                              passive_deletes=True)  # type: ignore
-    ent_stash_tags: Mapped[list["StashTag"]] = db.relationship(secondary=ent_tag_map,
-                                                               back_populates="ent_tags",
-                                                               passive_deletes=True)  # type: ignore
-    def_stash_tags: Mapped[list["StashTag"]] = db.relationship(secondary=def_tag_map,
-                                                               back_populates="def_tags",
-                                                               passive_deletes=True)  # type: ignore
+
+
+class TagMapping(db.Model):
+    """A gazelle tag that a stash tag corresponds to on a tracker. The primary key also covers looking up
+    the tags of several stash tags for one tracker and the defaults at once."""
+    __tablename__ = "tag_mappings"
+    stashtag_id: Mapped[int] = mapped_column(ForeignKey("stash_tag.id", ondelete="CASCADE"), primary_key=True)
+    tracker: Mapped[str] = mapped_column(String(16), primary_key=True)
+    gazelletag_id: Mapped[int] = mapped_column(ForeignKey("gazelle_tags.id", ondelete="CASCADE"), primary_key=True,
+                                               index=True)
+    gazelle_tag: Mapped[GazelleTag] = db.relationship(lazy="joined")  # type: ignore
 
 
 class StashTag(db.Model):
@@ -139,28 +133,23 @@ class StashTag(db.Model):
     tagname: Mapped[str] = mapped_column(String(collation="NOCASE"), unique=True, nullable=False)
     display: Mapped[str] = mapped_column(String, nullable=True)
     ignored: Mapped[bool] = mapped_column(Boolean, nullable=False, default=False)
-    emp_tags: Mapped[list[GazelleTag]] = db.relationship("GazelleTag", secondary=emp_tag_map,
-                                                         back_populates="emp_stash_tags",
-                                                         passive_deletes=True)  # type: ignore
-    hf_tags: Mapped[list[GazelleTag]] = db.relationship("GazelleTag", secondary=hf_tag_map,
-                                                        back_populates="hf_stash_tags",
-                                                        passive_deletes=True)  # type: ignore
-    fc_tags: Mapped[list[GazelleTag]] = db.relationship("GazelleTag", secondary=fc_tag_map,
-                                                        back_populates="fc_stash_tags",
-                                                        passive_deletes=True)  # type: ignore
-    pb_tags: Mapped[list[GazelleTag]] = db.relationship("GazelleTag", secondary=pb_tag_map,
-                                                        back_populates="pb_stash_tags",
-                                                        passive_deletes=True)  # type: ignore
-    ent_tags: Mapped[list[GazelleTag]] = db.relationship("GazelleTag", secondary=ent_tag_map,
-                                                         back_populates="ent_stash_tags",
-                                                         passive_deletes=True)  # type: ignore
-    def_tags: Mapped[list[GazelleTag]] = db.relationship("GazelleTag", secondary=def_tag_map,
-                                                         back_populates="def_stash_tags",
+    mappings: Mapped[list[TagMapping]] = db.relationship(cascade="all, delete-orphan",
                                                          passive_deletes=True)  # type: ignore
     categories: Mapped[list["Category"]] = db.relationship("Category", secondary=list_tags,
                                                            back_populates="tags",
                                                            passive_deletes=True)  # type: ignore
 
+    def gazelle_tags(self, tracker: str = DEFAULT_TRACKER) -> list[GazelleTag]:
+        """The tags that this corresponds to on a tracker, without falling back to the default tags."""
+        return [mapping.gazelle_tag for mapping in self.mappings if mapping.tracker == tracker]
+
+    def set_gazelle_tags(self, tracker: str, tags: list[GazelleTag]) -> None:
+        current = {mapping.gazelle_tag: mapping for mapping in self.mappings if mapping.tracker == tracker}
+        self.mappings = [mapping for mapping in self.mappings if mapping.tracker != tracker] + [
+            current.get(tag) or TagMapping(tracker=tracker, gazelle_tag=tag)  # type: ignore
+            for tag in dict.fromkeys(tags)
+        ]
+
 
 class Category(db.Model):
     __tablename__ = "category"
@@ -170,6 +159,120 @@ class Category(db.Model):
                                                    passive_deletes=True)  # type: ignore
 
 
+class JobRecord(db.Model):
+    """A generation job that has not finished successfully, kept so that it can be resumed after a restart."""
+    __tablename__ = "jobs"
+    id: Mapped[str] = mapped_column(String(32), primary_key=True)
+    data: Mapped[dict[str, Any]] = mapped_column(JSON, nullable=False)
+    state: Mapped[str] = mapped_column(String(16), nullable=False)
+    created: Mapped[float] = mapped_column(Float, nullable=False)
+    finished: Mapped[float] = mapped_column(Float, nullable=True)
+    stages: Mapped[list["JobStage"]] = db.relationship(back_populates="job",
+                                                       cascade="all, delete-orphan")  # type: ignore
+
+
+class JobStage(db.Model):
+    """The outputs of a completed stage of a job."""
+    __tablename__ = "job_stages"
+    job_id: Mapped[str] = mapped_column(ForeignKey("jobs.id", ondelete="CASCADE"), primary_key=True)
+    stage: Mapped[str] = mapped_column(String, primary_key=True)
+    outputs: Mapped[dict[str, Any]] = mapped_column(JSON, nullable=False)
+    job: Mapped[JobRecord] = db.relationship(back_populates="stages")  # type: ignore
+
+
+class PieceHashes(db.Model):
+    """The piece hashes of a file, which are the same for every tracker's torrent of that file."""
+    __tablename__ = "piece_hashes"
+    device: Mapped[int] = mapped_column(Integer, primary_key=True)
+    inode: Mapped[int] = mapped_column(Integer, primary_key=True)
+    size: Mapped[int] = mapped_column(Integer, primary_key=True)
+    mtime: Mapped[int] = mapped_column(Integer, primary_key=True)
+    piece_length: Mapped[int] = mapped_column(Integer, primary_key=True)
+    pieces: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+    used: Mapped[float] = mapped_column(Float, nullable=False, index=True, server_default="0")
+
+
+class TorrentRecord(db.Model):
+    """A torrent in one of the torrent directories. See `utils.torrentindex`."""
+    __tablename__ = "torrents"
+    path: Mapped[str] = mapped_column(String, primary_key=True)
+    infohash: Mapped[str] = mapped_column(String(40), nullable=False, index=True)
+    name: Mapped[str] = mapped_column(String, nullable=False)
+    size: Mapped[int] = mapped_column(Integer, nullable=False)
+    files: Mapped[list[dict[str, Any]]] = mapped_column(JSON, nullable=False)
+    tracker: Mapped[str] = mapped_column(String, nullable=True)
+    source_path: Mapped[str] = mapped_column(String, nullable=True)
+    mtime: Mapped[float] = mapped_column(Float, nullable=False)
+
+
+class ImageUrl(db.Model):
+    """The URL of an uploaded image, cached locally when Redis is not configured. See `utils.urlcache`."""
+    __tablename__ = "image_urls"
+    host: Mapped[str] = mapped_column(String(16), primary_key=True)
+    digest: Mapped[str] = mapped_column(String, primary_key=True)
+    url: Mapped[str] = mapped_column(String, nullable=False)
+    created: Mapped[float] = mapped_column(Float, nullable=False, index=True)
+
+
+class SceneImages(db.Model):
+    """The digests of the images of one type uploaded for a scene, separated by colons."""
+    __tablename__ = "scene_images"
+    scene_id: Mapped[str] = mapped_column(String, primary_key=True)
+    kind: Mapped[str] = mapped_column(String(16), primary_key=True)
+    digests: Mapped[str] = mapped_column(String, nullable=False)
+    created: Mapped[float] = mapped_column(Float, nullable=False, index=True)
+
+
+class Setting(db.Model):
+    """A value kept by the application itself rather than set by the user, such as the hash of the last seeded tag
+    config."""
+    __tablename__ = "settings"
+    key: Mapped[str] = mapped_column(String, primary_key=True)
+    value: Mapped[str] = mapped_column(String, nullable=False)
+
+
+def get_setting(key: str) -> str | None:
+    record = db.session.get(Setting, key)
+    return record.value if record is not None else None
+
+
+def set_setting(key: str, value: str | None) -> None:
+    """Store a setting, or delete it if `value` is ``None``. Does not commit."""
+    if value is None:
+        Setting.query.filter_by(key=key).delete()
+    else:
+        db.session.merge(Setting(key=key, value=value))  # type: ignore
+
+
+class PieceHashCache:
+    """Stores piece hashes in the database so that they can be reused by `utils.torrent.make_torrent`."""
+
+    def get(self, key: tuple[int, int, int, int, int]) -> bytes | None:
+        record = db.session.get(PieceHashes, key)
+        if record is None:
+            return None
+        record.used = time.time()
+        db.session.commit()
+        return record.pieces
+
+    def set(self, key: tuple[int, int, int, int, int], pieces: bytes) -> None:
+        device, inode, size, mtime, piece_length = key
+        db.session.merge(PieceHashes(device=device, inode=inode, size=size, mtime=mtime, piece_length=piece_length,
+                                     pieces=pieces, used=time.time()))  # type: ignore
+        db.session.commit()
+
+    @staticmethod
+    def evict(size: int) -> int:
+        """Delete the least recently used piece hashes beyond the first `size`. Does not commit.
+        :return: The number of entries deleted
+        """
+        excess = PieceHashes.query.count() - size
+        if excess <= 0:
+            return 0
+        oldest = db.session.query(PieceHashes.used).order_by(PieceHashes.used).offset(excess - 1).limit(1).scalar()
+        return PieceHashes.query.filter(PieceHashes.used <= oldest).delete()
+
+
 def get_or_create[T](model: type[T], **kwargs) -> T:
     session = db.session
     with session.no_autoflush:
@@ -207,12 +310,8 @@ def to_dict() -> dict[str, Any]:
             "name": tag.tagname,
             "display": tag.display,
             "ignored": tag.ignored,
-            "defaults": [e.id for e in tag.def_tags],
-            "emp_tags": [e.id for e in tag.emp_tags],
-            "hf_tags": [h.id for h in tag.hf_tags],
-            "fc_tags": [h.id for h in tag.fc_tags],
-            "pb_tags": [h.id for h in tag.pb_tags],
-            "ent_tags": [h.id for h in tag.ent_tags],
+            "defaults": [e.id for e in tag.gazelle_tags()],
+            **{f"{tracker.lower()}_tags": [e.id for e in tag.gazelle_tags(tracker)] for tracker in TRACKERS},
             "categories": [c.id for c in tag.categories],
         }
         data["stash_tags"].append(stag)
@@ -237,7 +336,8 @@ def from_dict(data: dict[str, Any]) -> None:
         raise ValueError("Schema version mismatch")
 
     with db.session.begin():
-        # 1. Delete existing records
+        # 1. Delete existing records, and make sure that the tag config is seeded again on the next start
+        set_setting(TAG_SEED_KEY, None)
         Category.query.delete()
         StashTag.query.delete()
         GazelleTag.query.delete()
@@ -262,27 +362,8 @@ def from_dict(data: dict[str, Any]) -> None:
                 cat = Category.query.filter_by(id=tag_id).first()
                 assert cat is not None
                 stag.categories.append(cat)
-            for tag_id in tag["defaults"]:
-                etag = GazelleTag.query.filter_by(id=tag_id).first()
-                assert etag is not None
-                stag.def_tags.append(etag)
-            for tag_id in tag["emp_tags"]:
-                etag = GazelleTag.query.filter_by(id=tag_id).first()
-                assert etag is not None
-                stag.emp_tags.append(etag)
-            for tag_id in tag["hf_tags"]:
-                etag = GazelleTag.query.filter_by(id=tag_id).first()
-                assert etag is not None
-                stag.hf_tags.append(etag)
-            for tag_id in tag["fc_tags"]:
-                etag = GazelleTag.query.filter_by(id=tag_id).first()
-                assert etag is not None
-                stag.fc_tags.append(etag)
-            for tag_id in tag["pb_tags"]:
-                etag = GazelleTag.query.filter_by(id=tag_id).first()
-                assert etag is not None
-                stag.pb_tags.append(etag)
-            for tag_id in tag["ent_tags"]:
-                etag = GazelleTag.query.filter_by(id=tag_id).first()
-                assert etag is not None
-                stag.ent_tags.append(etag)
+            for tracker, key in [(DEFAULT_TRACKER, "defaults")] + [(t, f"{t.lower()}_tags") for t in TRACKERS]:
+                for tag_id in tag.get(key, []):
+                    etag = GazelleTag.query.filter_by(id=tag_id).first()
+                    assert etag is not None
+                    stag.mappings.append(TagMapping(tracker=tracker, gazelle_tag=etag))  # type: ignore
@@ -0,0 +1,75 @@
+"""This module extracts frames from videos. All frames for a job are taken by
+a single ffmpeg process that seeks to the nearest keyframe before each
+timestamp, and the frames are returned as in-memory JPEG images."""
+
+import re
+import subprocess
+
+from loguru import logger
+
+from utils import jobs
+
+JPEG_START = b"\xff\xd8"
+JPEG_END = b"\xff\xd9"
+SHOWINFO = re.compile(r"Parsed_showinfo_(\d+) .*? n: *0 .*?pts_time:(-?[\d.]+)")
+
+
+def frame_times(duration: float, count: int) -> list[float]:
+    """Spread `count` timestamps evenly over the middle 90% of a video."""
+    if count == 1:
+        return [duration / 2]
+    return [duration * (0.05 + i / (count - 1) * 0.9) for i in range(count)]
+
+
+def extract_frames(path: str, timestamps: list[float], width: int | None = None,
+                   quality: int = 2) -> list[tuple[float, bytes]]:
+    """
+    Decode one frame at each timestamp in a single ffmpeg process. Only
+    keyframes are decoded, so frames may come from slightly before each
+    timestamp.
+    :param width: Scale frames to this width, keeping their aspect ratio
+    :param quality: JPEG quality from 2 (best) to 31 (worst)
+    :return: The actual timestamp of each frame and the frame as a JPEG image,
+        in the same order as `timestamps`
+    """
+    if not timestamps:
+        return []
+    cmd = ["ffmpeg", "-hide_banner", "-nostdin"]
+    for seek in timestamps:
+        cmd += ["-skip_frame", "nokey", "-ss", f"{seek:.3f}", "-noaccurate_seek", "-i", path]
+    scale = f",scale={width}:-2" if width else ""
+    graph = "".join(f"[{i}:v:0]trim=end_frame=1,showinfo,setpts=PTS-STARTPTS{scale},setsar=1[f{i}];"
+                    for i in range(len(timestamps)))
+    # Give each frame its own timestamp so that none are dropped as duplicates
+    graph += "".join(f"[f{i}]" for i in range(len(timestamps)))
+    graph += f"concat=n={len(timestamps)}:v=1:a=0,setpts=N/TB,format=yuvj420p[out]"
+    cmd += ["-filter_complex", graph, "-map", "[out]", "-fps_mode", "passthrough", "-f", "image2pipe", "-c:v", "mjpeg",
+            "-q:v", str(quality), "pipe:1"]
+    process = jobs.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if process.returncode != 0:
+        logger.error(f"ffmpeg failed to extract frames from {path}")
+        logger.debug(process.stderr.decode("utf-8", "replace"))
+        return []
+    frames = split_jpegs(process.stdout)
+    if len(frames) != len(timestamps):
+        logger.warning(f"Expected {len(timestamps)} frames from {path} but got {len(frames)}")
+    # showinfo logs the time of each frame relative to where its input was seeked to
+    offsets = [float(t) for _, t in sorted(SHOWINFO.findall(process.stderr.decode("utf-8", "replace")),
+                                           key=lambda m: int(m[0]))]
+    if len(offsets) != len(frames):
+        offsets = [0.0] * len(frames)
+    return [(round(max(seek + offset, 0.0), 3), frame) for seek, offset, frame in zip(timestamps, offsets, frames)]
+
+
+def split_jpegs(data: bytes) -> list[bytes]:
+    """Split a stream of concatenated JPEG images. The end marker can't occur
+    inside the compressed data because JPEG escapes every 0xFF byte there."""
+    frames = []
+    start = data.find(JPEG_START)
+    while start != -1:
+        end = data.find(JPEG_END, start + 2)
+        if end == -1:
+            break
+        frames.append(data[start:end + 2])
+        start = data.find(JPEG_START, end + 2)
+    return frames
@@ -1,42 +1,156 @@
 import datetime
 import json
-import math
-import multiprocessing as mp
 import os
 import shutil
-import string
 import subprocess
 import tempfile
+import time
 import urllib.parse
-from collections.abc import Generator
-from concurrent.futures import Future, ThreadPoolExecutor
-from multiprocessing.connection import Connection
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
 
 import requests
 from cairosvg import svg2png
-from flask import render_template, render_template_string
+from flask import Flask, current_app, render_template, render_template_string
 from loguru import logger
-
-from utils import imagehandler, taghandler
-from utils.confighandler import ConfigHandler, stash_headers, stash_query
-from utils.packs import link, read_gallery, get_torrent_directory
+from sqlalchemy.exc import SQLAlchemyError
+
+from utils import imagehandler, jobs, taghandler
+from utils.frames import frame_times
+from utils.db import JobRecord, JobStage, PieceHashCache, db
+from utils.confighandler import ConfigHandler, find_scenes_query, stash_headers, stash_query
+from utils.jobs import Job, JobCancelled, JobState, JobStore, current_job
+from utils.torrent import make_torrent
+from utils.torrentindex import torrent_index
+from utils.uploader import uploader
+from utils.pipeline import DEFAULT_LIMITS, Pipeline, Stage, StageError, set_resource_limit
+from utils.packs import link, prep_dir, read_gallery, get_torrent_directory
 from utils.paths import remap_path, delete_temp_file, verify_scene
 
 MEDIA_INFO = shutil.which("mediainfo")
-FILENAME_VALID_CHARS = "-_.() %s%s" % (string.ascii_letters, string.digits)
 config = ConfigHandler()
 
-jobs: list[Future] = []
-job_pool = ThreadPoolExecutor(max_workers=4)
-jobs_lock = mp.Lock()
+job_store = JobStore(ttl=config.get("backend", "job_ttl", 3600))  # type: ignore
+job_pool = ThreadPoolExecutor(max_workers=config.get("backend", "max_jobs", 4))  # type: ignore
+for resource, limit in DEFAULT_LIMITS.items():
+    set_resource_limit(resource, config.get("backend", f"{resource}_stages", limit))  # type: ignore
+
+
+def add_job(j: dict) -> str:
+    job = Job(j)
+    db.session.add(JobRecord(id=job.id, data=j, state=job.state, created=job.created))  # type: ignore
+    db.session.commit()
+    submit_job(job)
+    return job.id
+
+
+def submit_job(job: Job) -> None:
+    job_store.add(job)
+    # Jobs run outside of the request that created them, so they need their own app context
+    app: Flask = current_app._get_current_object()  # type: ignore
+    job.future = job_pool.submit(run_job, job, app)
+
 
+def run_job(job: Job, app: Flask) -> None:
+    """Run a job to completion, publishing each progress message as it is generated."""
+    job.start()
+    current_job.set(job)
+    state: JobState = "failed"
+    with app.app_context():
+        save_state(job.id, job.state)
+        try:
+            state = generate(job)
+        except Exception as e:
+            logger.exception(e)
+            job.publish(error("An unexpected error occurred during generation"))
+        finally:
+            job.finish(state)
+            save_state(job.id, state, job.finished)
+
+
+def cancel_job(job_id: str) -> bool:
+    job = job_store.get(job_id)
+    if job is None or not job.cancel():
+        return False
+    # Jobs cancelled before they started never reach run_job
+    if job.state == "cancelled":
+        save_state(job_id, "cancelled")
+    return True
+
+
+def retry_job(job_id: str) -> bool:
+    """
+    Run a failed job again, reusing the outputs of every stage that completed.
+    :return: `False` if the job does not exist or did not fail
+    """
+    old_job = job_store.get(job_id)
+    if old_job is None or old_job.state != "failed":
+        return False
+    job = Job(old_job.data, job_id)
+    save_state(job_id, job.state)
+    submit_job(job)
+    return True
+
+
+def resume_jobs(app: Flask) -> None:
+    """Restart jobs that were interrupted by a shutdown, and restore failed jobs so that they can be retried."""
+    with app.app_context():
+        ttl: int = config.get("backend", "job_ttl", 3600)  # type: ignore
+        for record in JobRecord.query.order_by(JobRecord.created).all():
+            job = Job(record.data, record.id)
+            job.created = record.created
+            if record.state == "failed":
+                if time.time() - record.finished > ttl:
+                    db.session.delete(record)
+                    continue
+                job.finish("failed")
+                job.finished = record.finished
+                job_store.add(job)
+            else:
+                logger.info(f"Resuming job for scene {record.data['scene_id']}")
+                submit_job(job)
+        db.session.commit()
+
+
+def save_state(job_id: str, state: JobState, finished: float | None = None) -> None:
+    """Update the saved state of a job. Jobs that will never be resumed are deleted along with their stages."""
+    record = db.session.get(JobRecord, job_id)
+    if record is None:
+        return
+    if state in ("done", "cancelled"):
+        db.session.delete(record)
+    else:
+        record.state = state
+        record.finished = finished
+    db.session.commit()
 
-def add_job(j: dict) -> int:
-    future = job_pool.submit(generate, j)
-    with jobs_lock:
-        job_id = len(jobs)
-        jobs.append(future)
-    return job_id
+
+def save_stage(job_id: str, stage: Stage, outputs: dict[str, Any]) -> None:
+    if not stage.persist:
+        return
+    try:
+        db.session.merge(JobStage(job_id=job_id, stage=stage.name, outputs=outputs))  # type: ignore
+        db.session.commit()
+    except SQLAlchemyError as e:
+        # The job can still finish, it just won't be able to skip this stage if it is resumed
+        db.session.rollback()
+        logger.warning(f"Failed to save results of stage {stage.name}")
+        logger.debug(e)
+
+
+def load_stages(job_id: str) -> dict[str, Any]:
+    """Return the saved outputs of every completed stage of a job."""
+    stages = {s.stage: s.outputs for s in JobStage.query.filter_by(job_id=job_id).all()}
+    # Torrents need to be remade if they were deleted since the job was interrupted
+    if "torrent" in stages and not all(os.path.isfile(p) for p in stages["torrent"]["torrent_paths"]):
+        del stages["torrent"]
+    values = {}
+    for outputs in stages.values():
+        values.update(outputs)
+    if stages:
+        logger.info(f"Reusing results of {len(stages)} completed stages")
+    return values
 
 
 def error(message: str, alt_message: str | None = None) -> str:
@@ -59,37 +173,85 @@ def success(message: str, alt_message: str | None = None) -> str:
     return json.dumps({"status": "success", "data": {"message": alt_message if alt_message else message}}) + '\n'
 
 
-def generate(j: dict) -> Generator[str, None, str | None]:
-    scene_id = j["scene_id"]
-    file_id = j["file_id"]
-    announce_url = j["announce_url"]
-    gen_screens = j["screens"]
-    include_gallery = j["gallery"]
-    tracker = j["tracker"]  # 'EMP', 'PB', 'FC', 'HF' or 'ENT'
-    include_screens = tracker == 'FC'  # TODO user customization
-    img_host = "hamster"
+def add_batch(j: dict) -> list[str]:
+    """
+    Queue a job for each scene in a batch request. Scenes can be given as a
+    list of `scene_ids`, or as a Stash `scene_filter`.
+    :return: The IDs of the new jobs
+    """
+    scene_ids = [str(scene_id) for scene_id in j.get("scene_ids", [])]
+    if "scene_filter" in j:
+        scene_ids.extend(find_scenes(j["scene_filter"]))
+    logger.info(f"Queueing {len(scene_ids)} scenes")
+    return [add_job({
+        "scene_id": scene_id,
+        "file_id": None,
+        "announce_url": j["announce_url"],
+        "tracker": j.get("tracker", "EMP"),
+        "template": j.get("template"),
+        "screens": j.get("screens", True),
+        "gallery": j.get("gallery", False),
+    }) for scene_id in dict.fromkeys(scene_ids)]
+
+
+def find_scenes(scene_filter: dict) -> list[str]:
+    """Return the IDs of all Stash scenes matching a filter."""
+    stash_request_body = {"query": find_scenes_query, "variables": {"scene_filter": scene_filter}}
+    stash_response = requests.post(
+        urllib.parse.urljoin(config.get("stash", "url", "http://localhost:9999"), "/graphql"),  # type: ignore
+        json=stash_request_body,
+        headers=stash_headers,
+    )
+    stash_response.raise_for_status()
+    return [scene["id"] for scene in stash_response.json()["data"]["findScenes"]["scenes"]]
 
-    yield info("Starting generation")
 
+def generate(job: Job) -> JobState:
+    """Run every stage of a generation job and publish the result."""
+    j = job.data
+    publish = job.publish
+    publish(info("Starting generation"))
     logger.info(
-        f"Generating submission for scene ID {j['scene_id']} {'in' if gen_screens else 'ex'}cluding screens{' and including gallery' if include_gallery else ''}.")
+        f"Generating submission for scene ID {j['scene_id']} {'in' if j['screens'] else 'ex'}cluding screens{' and including gallery' if j['gallery'] else ''}.")
 
-    template = (j["template"] if "template" in j and j["template"] in config.template_names else config.get("backend",
-                                                                                                            "default_template"))
-    assert template is not None
+    pipeline = Pipeline(STAGES, current_app._get_current_object())  # type: ignore
+    values = load_stages(job.id)
+    values.update({"job": j, "publish": publish, "img_host": "hamster"})
+    try:
+        values = pipeline.run(values, job.cancel_event, ("result",),
+                              lambda stage, outputs: save_stage(job.id, stage, outputs))
+    except StageError as e:
+        publish(error(e.message, e.alt_message))
+        return "failed"
+    except JobCancelled:
+        publish(warning("Job cancelled"))
+        return "cancelled"
+    finally:
+        uploader.close_gallery(job.id)
+
+    logger.debug(f"Sending {len(values['result']['data'].get('suggestions', {}))} suggestions")
+    job.result = values["result"]
+    publish(json.dumps(values["result"]) + '\n')
 
-    performers = {}
-    screens_urls = []
-    studio_tag = ""
+    for client in config.torrent_clients:
+        try:
+            path = values["new_dir"] if values["new_dir"] else values["stash_file"]["path"]
+            client.add(values["torrent_paths"][0], path)
+        except Exception as e:
+            logger.error(f"Error attempting to add torrent to {client.name}")
+            logger.debug(e)
 
-    tags = taghandler.TagHandler()
+    logger.success("Done")
+    return "done"
 
-    #################
-    # STASH REQUEST #
-    #################
 
+##########
+# STAGES #
+##########
+
+def query_stash(job: dict) -> dict[str, Any]:
     logger.info("Querying stash")
-    stash_request_body = {"query": "{" + stash_query.format(scene_id) + "}"}
+    stash_request_body = {"query": "{" + stash_query.format(job["scene_id"]) + "}"}
     stash_response = requests.post(
         urllib.parse.urljoin(config.get("stash", "url", "http://localhost:9999"), "/graphql"),  # type: ignore
         json=stash_request_body,
@@ -99,8 +261,7 @@ def generate(j: dict) -> Generator[str, None, str | None]:
     stash_response_body = stash_response.json()
     scene = stash_response_body["data"]["findScene"]
     if scene is None:
-        yield error(f"Scene {scene_id} does not exist")
-        return
+        raise StageError(f"Scene {job['scene_id']} does not exist")
 
     # Ensure that all expected string keys are present
     str_keys = ["title", "details", "date"]
@@ -109,35 +270,44 @@ def generate(j: dict) -> Generator[str, None, str | None]:
             scene[key] = ""
         elif scene[key] is None:
             scene[key] = ""
+    return {"scene": scene}
 
-    new_dir = get_torrent_directory(scene) if include_screens else None
-    image_dir = None
-    image_temp = False
-    gallery_contact = None
-    gallery_proc = None
-    image_count = 0
-    if include_gallery:
+
+def gallery(job: dict, scene: dict) -> dict[str, Any]:
+    result = None
+    if job["gallery"]:
         try:
-            new_dir, image_dir, image_temp = read_gallery(scene)  # type: ignore
+            gallery_dir, image_dir, image_temp = read_gallery(scene)  # type: ignore
             gallery_contact = tempfile.mkstemp("-gallery_contact.jpg")[1]
             files = [os.path.join(image_dir, file) for file in os.listdir(image_dir)]
-            image_count = len(files)
-            gallery_proc = mp.Process(target=imagehandler.createContactSheet, args=(files, 800, 200, gallery_contact))
-            gallery_proc.start()
+            imagehandler.createContactSheet(files, 800, 200, gallery_contact)
+            result = {
+                "dir": gallery_dir,
+                "image_dir": image_dir,
+                "temp": image_temp,
+                "count": len(files),
+                "contact": gallery_contact,
+            }
         except ValueError as ve:
-            yield error(str(ve))
-            return
+            raise StageError(str(ve))
         except TypeError:
             logger.warning("Unable to include gallery in torrent")
         except Exception as e:
             logger.debug(e)
-            yield error("An unexpected error occurred while processing the gallery")
-            return
+            raise StageError("An unexpected error occurred while processing the gallery")
+    return {"gallery": result}
+
+
+def select_file(job: dict, scene: dict, gallery: dict | None) -> dict[str, Any]:
+    include_screens = job["tracker"] == "FC"  # TODO user customization
+    new_dir = get_torrent_directory(scene) if include_screens else None
+    if gallery is not None:
+        new_dir = gallery["dir"]
 
     stash_file = None
     for f in scene["files"]:
         logger.debug(f"Checking path {f['path']}")
-        if f["id"] == file_id:
+        if f["id"] == job["file_id"]:
             stash_file = f
             maps = config.get("stash", "pathmaps", {})
             stash_file["path"] = remap_path(stash_file["path"], maps)  # type: ignore
@@ -146,8 +316,7 @@ def generate(j: dict) -> Generator[str, None, str | None]:
     if stash_file is None:
         tmp_file = scene["files"][0]
         if tmp_file is None:
-            yield error("No file exists")
-            return
+            raise StageError("No file exists")
         stash_file = tmp_file
         maps = config.items("file.maps")
         if not maps:
@@ -157,13 +326,7 @@ def generate(j: dict) -> Generator[str, None, str | None]:
 
     verified, err = verify_scene(stash_file)
     if not verified:
-        yield error(err)
-        return
-
-    # Warn user if file size reported by stash doesn't match actual file size
-    file_size = os.path.getsize(stash_file["path"])
-    if file_size != stash_file["size"]:
-        logger.warning(f"File size mismatch: {file_size} != {stash_file['size']}")
+        raise StageError(err)
 
     if new_dir:
         link(stash_file["path"], new_dir)
@@ -171,66 +334,50 @@ def generate(j: dict) -> Generator[str, None, str | None]:
     if len(scene["title"]) == 0:
         scene["title"] = stash_file["basename"]
 
-    ht = stash_file["height"]
-    resolution = None
-    # these are stash's heuristics, see pkg/models/resolution.go
-    if 144 <= ht < 240:
-        resolution = "144p"
-    elif 240 <= ht < 360:
-        resolution = "240p"
-    elif 360 <= ht < 480:
-        resolution = "360p"
-    elif 480 <= ht < 540:
-        resolution = "480p"
-    elif 540 <= ht < 720:
-        resolution = "540p"
-    elif 720 <= ht < 1080:
-        resolution = "720p"
-    elif 1080 <= ht < 1440:
-        resolution = "1080p"
-    elif 1440 <= ht < 1920:
-        resolution = "1440p"
-    elif 1920 <= ht < 2560:
-        resolution = "2160p"
-    elif 2560 <= ht < 3000:
-        resolution = "5K"
-    elif 3000 <= ht < 3584:
-        resolution = "6K"
-    elif 3584 <= ht < 3840:
-        resolution = "7K"
-    elif 3840 <= ht < 6143:
-        resolution = "8K"
-    elif ht >= 6143:
-        resolution = "8K+"
+    screens_dir = os.path.join(get_torrent_directory(scene), 'screens') if include_screens else None
 
-    if resolution is not None and config.get("metadata", "tag_resolution"):
-        tags.add(resolution)
+    return {
+        "stash_file": stash_file,
+        "new_dir": new_dir,
+        "screens_dir": screens_dir,
+        "resolution": get_resolution(stash_file["height"]),
+    }
 
-    yield info("Uploading images")
+
+def image_handler(publish: Callable[[str], None]) -> dict[str, Any]:
+    publish(info("Uploading images"))
     try:
         images = imagehandler.ImageHandler()
     except KeyboardInterrupt:
         raise
     except Exception:
-        yield error("Failed to initialize image handler")
-        return
+        raise StageError("Failed to initialize image handler")
     if config.args.flush:
         images.clear()
+    return {"images": images}
+
 
-    #################
-    # CONTACT SHEET #
-    #################
+def frames(job: dict, stash_file: dict) -> dict[str, Any]:
+    # Plan every frame needed by the screens and the contact sheet so that they are sampled in one pass
+    planned = []
+    if not config.get("images", "contact_sheet_sprites", False):
+        columns, rows = imagehandler.contact_sheet_grid()
+        planned += frame_times(stash_file["duration"], columns * rows)
+    if job["screens"]:
+        planned += frame_times(stash_file["duration"], config.get("images", "num_screens", 10))  # type: ignore
+    return {"frames": imagehandler.FrameSet(stash_file["path"], stash_file["duration"], planned)}
 
+
+def contact_sheet(scene: dict, stash_file: dict, images: imagehandler.ImageHandler, img_host: str,
+                  screens_dir: str | None, frames: imagehandler.FrameSet) -> dict[str, Any]:
     # Generate contact sheet and include it in the torrent directory if include_screens is True
-    screens_dir = os.path.join(get_torrent_directory(scene), 'screens') if include_screens else None
-    contact_sheet_remote_url = images.generate_contact_sheet(stash_file, img_host, screens_dir)
+    contact_sheet_remote_url = images.generate_contact_sheet(stash_file, img_host, screens_dir, frames, scene)
     if contact_sheet_remote_url is None:
-        yield error("Failed to generate contact sheet")
-        return
+        raise StageError("Failed to generate contact sheet")
+    return {"contact_sheet_url": contact_sheet_remote_url}
 
-    #########
-    # COVER #
-    #########
+
+def cover(scene: dict, stash_file: dict, screens_dir: str | None) -> dict[str, Any]:
     # TODO Move this into image handler
     cover_response = requests.get(scene["paths"]["screenshot"], headers=stash_headers)
     cover_mime_type = cover_response.headers["Content-Type"]
@@ -263,87 +410,82 @@ def generate(j: dict) -> Generator[str, None, str | None]:
             cover_file[1],
             "-y",
         ]
-        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        proc = jobs.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
         logger.debug(f"ffmpeg output:\n{proc.stdout}")
     else:
         with open(cover_file[1], "wb") as fp:
             fp.write(cover_response.content)
     if screens_dir:
+        prep_dir(screens_dir)
         os.chmod(cover_file[1], 0o666)  # Ensures torrent client can read the file
         shutil.copy(cover_file[1], os.path.join(screens_dir, f"cover.{cover_ext}"))
+    return {"cover": {"path": cover_file[1], "mime_type": cover_mime_type, "ext": cover_ext}}
 
-    ###########
-    # TORRENT #
-    ###########
-
-    yield info("Making torrent")
-    receive_pipe: Connection
-    send_pipe: Connection
-    receive_pipe, send_pipe = mp.Pipe(False)
-    torrent_proc = mp.Process(target=gen_torrent, args=(send_pipe, stash_file, announce_url, new_dir))
-    torrent_proc.start()
 
-    cover_remote_url = images.get_url(cover_file[1], cover_mime_type, cover_ext, img_host)[0]
+def upload_cover(cover: dict, images: imagehandler.ImageHandler, img_host: str) -> dict[str, Any]:
+    # Both sizes are rendered from a single decode, and only if one of them isn't cached
+    (cover_remote_url, _), (cover_resized_url, _) = images.get_renditions(
+        cover["path"], cover["mime_type"], cover["ext"], img_host, [0, 800]
+    )
     if cover_remote_url is None:
-        yield error("Failed to upload cover")
-        return
-    cover_resized_url = images.get_url(cover_file[1], cover_mime_type, cover_ext, img_host, width=800)[0]
-    os.remove(cover_file[1])
-
-    ###########
-    # PREVIEW #
-    ###########
-    preview_recv: Connection
-    preview_send: Connection
-    preview_recv, preview_send = mp.Pipe(False)
-    preview_proc = mp.Process(target=images.process_preview, args=(preview_send, scene, img_host))
-    if config.get("images", "use_preview", False):
-        preview_proc.start()
-    # del preview_send  # Ensures connection can be automatically closed if garbage collected
-
-    ###############
-    # STUDIO LOGO #
-    ###############
-
-    studio_img_ext = ""
-    studio_img_mime_type = ""
-    studio_img_file = None
-    if scene["studio"] is not None and "default=true" not in scene["studio"]["image_path"]:
-        logger.debug(f'Downloading studio image from {scene["studio"]["image_path"]}')
-        studio_img_response = requests.get(scene["studio"]["image_path"], headers=stash_headers)
-        studio_img_mime_type = studio_img_response.headers["Content-Type"]
-        match studio_img_mime_type:
-            case "image/jpeg":
-                studio_img_ext = "jpg"
-            case "image/png":
-                studio_img_ext = "png"
-            case "image/svg+xml":
-                studio_img_ext = "svg"
-            case "image/webp":
-                studio_img_ext = "webp"
-            case _:
-                studio_img_ext = "unk"
-                yield (warning(f"Unknown studio logo file type: {studio_img_mime_type}",
-                               "Unrecognized studio image file type"))
-        studio_img_file = tempfile.mkstemp(suffix="-studio." + studio_img_ext)
-        with open(studio_img_file[1], "wb") as fp:
-            fp.write(studio_img_response.content)
-        if studio_img_ext == "svg":
-            png_file = tempfile.mkstemp(suffix="-studio.png")
-            svg2png(url=studio_img_file[1], write_to=png_file[1])
-            os.remove(studio_img_file[1])
-            studio_img_file = png_file
-            studio_img_mime_type = "image/png"
-            studio_img_ext = "png"
+        raise StageError("Failed to upload cover")
+    os.remove(cover["path"])
+    return {"cover_url": cover_remote_url, "cover_resized_url": cover_resized_url}
 
-    ##############
-    # PERFORMERS #
-    ##############
 
-    for performer in scene["performers"]:
-        performer_tag = tags.process_performer(performer, tracker)
+def torrent(job: dict, stash_file: dict, new_dir: str | None, publish: Callable[[str], None],
+            contact_sheet_url: str, cover: dict) -> dict[str, Any]:
+    # The contact sheet and cover are only taken so that they have been copied into new_dir before it is hashed
+    publish(info("Making torrent"))
+    torrent_paths = gen_torrent(stash_file, job["announce_url"], new_dir, publish)
+    if torrent_paths is None:
+        raise StageError("Failed to save torrent")
+    return {"torrent_paths": torrent_paths}
 
-        # image
+
+def preview(scene: dict, images: imagehandler.ImageHandler, img_host: str) -> dict[str, Any]:
+    preview_url = None
+    if config.get("images", "use_preview", False):
+        preview_url = images.process_preview(scene, img_host)
+        if preview_url is None:
+            error("Unable to upload preview GIF")
+    return {"preview_url": preview_url}
+
+
+def studio_logo(scene: dict, publish: Callable[[str], None]) -> dict[str, Any]:
+    if scene["studio"] is None or "default=true" in scene["studio"]["image_path"]:
+        return {"studio_logo": None}
+    logger.debug(f'Downloading studio image from {scene["studio"]["image_path"]}')
+    studio_img_response = requests.get(scene["studio"]["image_path"], headers=stash_headers)
+    studio_img_mime_type = studio_img_response.headers["Content-Type"]
+    match studio_img_mime_type:
+        case "image/jpeg":
+            studio_img_ext = "jpg"
+        case "image/png":
+            studio_img_ext = "png"
+        case "image/svg+xml":
+            studio_img_ext = "svg"
+        case "image/webp":
+            studio_img_ext = "webp"
+        case _:
+            studio_img_ext = "unk"
+            publish(warning(f"Unknown studio logo file type: {studio_img_mime_type}",
+                            "Unrecognized studio image file type"))
+    studio_img_file = tempfile.mkstemp(suffix="-studio." + studio_img_ext)[1]
+    with open(studio_img_file, "wb") as fp:
+        fp.write(studio_img_response.content)
+    if studio_img_ext == "svg":
+        png_file = tempfile.mkstemp(suffix="-studio.png")[1]
+        svg2png(url=studio_img_file, write_to=png_file)
+        os.remove(studio_img_file)
+        studio_img_file = png_file
+        studio_img_mime_type = "image/png"
+        studio_img_ext = "png"
+    return {"studio_logo": {"path": studio_img_file, "mime_type": studio_img_mime_type, "ext": studio_img_ext}}
+
+
+def performer_images(scene: dict) -> dict[str, Any]:
+    def download(performer: dict) -> dict[str, str]:
         logger.debug(f'Downloading performer image from {performer["image_path"]}')
         performer_image_response = requests.get(performer["image_path"], headers=stash_headers)
         performer_image_mime_type = performer_image_response.headers["Content-Type"]
@@ -356,32 +498,29 @@ def generate(j: dict) -> Generator[str, None, str | None]:
             case "image/webp":
                 performer_image_ext = "webp"
             case _:
-                yield (error(f"Unrecognized performer image mime type: {performer_image_mime_type}",
-                             "Unrecognized performer image format", ))
-                return
+                raise StageError(f"Unrecognized performer image mime type: {performer_image_mime_type}",
+                                 "Unrecognized performer image format")
         performer_image_file = tempfile.mkstemp(suffix="-performer." + performer_image_ext)
         with open(performer_image_file[1], "wb") as fp:
             fp.write(performer_image_response.content)
+        return {"path": performer_image_file[1], "mime_type": performer_image_mime_type, "ext": performer_image_ext}
 
-        # store data
-        performers[performer["name"]] = {
-            "image_path": performer_image_file[1],
-            "image_mime_type": performer_image_mime_type,
-            "image_ext": performer_image_ext,
-            "image_remote_url": None,
-            "tag": performer_tag,
-        }
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        downloads = list(pool.map(download, scene["performers"]))
+    return {"performer_images": {p["name"]: d for p, d in zip(scene["performers"], downloads)}}
 
-    ###########
-    # SCREENS #
-    ###########
 
-    if gen_screens:
-        screens_urls = images.generate_screens(stash_file=stash_file, host=img_host)
+def screens(job: dict, stash_file: dict, images: imagehandler.ImageHandler, img_host: str,
+            frames: imagehandler.FrameSet) -> dict[str, Any]:
+    screens_urls = []
+    if job["screens"]:
+        screens_urls = images.generate_screens(stash_file=stash_file, host=img_host, frames=frames)
         if screens_urls is None or None in screens_urls:
-            yield error("Failed to generate screens")
-            return
+            raise StageError("Failed to generate screens")
+    return {"screens_urls": screens_urls}
 
+
+def audio_bitrate(stash_file: dict) -> dict[str, Any]:
     cmd = [
         "ffprobe",
         "-v",
@@ -395,31 +534,26 @@ def generate(j: dict) -> Generator[str, None, str | None]:
         stash_file["path"],
     ]
     try:
-        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, check=True)
-        audio_bitrate = f"{int(proc.stdout.split('|')[0].strip()) // 1000} kbps"
-
+        proc = jobs.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, check=True)
+        bitrate = f"{int(proc.stdout.split('|')[0].strip()) // 1000} kbps"
     except subprocess.CalledProcessError:
         logger.warning("Unable to determine audio bitrate")
-        audio_bitrate = "UNK"
+        bitrate = "UNK"
+    return {"audio_bitrate": bitrate}
 
-    #############
-    # MEDIAINFO #
-    #############
 
+def media_info(stash_file: dict) -> dict[str, Any]:
     mediainfo = ""
-    info_proc = None
-    info_recv: Connection
-    info_send: Connection
     if MEDIA_INFO:
-        info_recv, info_send = mp.Pipe(False)
-        info_proc = mp.Process(target=gen_media_info, args=(info_send, stash_file["path"]))
-        info_proc.start()
+        try:
+            mediainfo = gen_media_info(stash_file["path"])
+        except subprocess.CalledProcessError:
+            error("Failed to generate media info")
+    return {"media_info": mediainfo}
 
-    #########
-    # TITLE #
-    #########
 
-    title = render_template_string(
+def title(scene: dict, stash_file: dict, resolution: str | None) -> dict[str, Any]:
+    rendered = render_template_string(
         config.get("backend", "title_template", ""),  # type: ignore
         **{
             "studio": scene["studio"]["name"] if scene["studio"] else "",
@@ -432,78 +566,104 @@ def generate(j: dict) -> Generator[str, None, str | None]:
             "framerate": stash_file["frame_rate"],
         },
     )
+    return {"title": rendered}
+
 
-    ########
-    # TAGS #
-    ########
+def tags(job: dict, scene: dict, stash_file: dict, resolution: str | None) -> dict[str, Any]:
+    tracker = job["tracker"]  # 'EMP', 'PB', 'FC', 'HF' or 'ENT'
+    handler = taghandler.TagHandler()
+
+    if resolution is not None and config.get("metadata", "tag_resolution"):
+        handler.add(resolution)
+
+    performer_tags = {}
+    for performer in scene["performers"]:
+        performer_tags[performer["name"]] = handler.process_performer(performer, tracker)
 
     for tag in scene["tags"]:
-        tags.process_tag(tag["name"], tracker)
+        handler.process_tag(tag["name"], tracker)
         for parent in tag["parents"]:
-            tags.process_tag(parent["name"], tracker)
+            handler.process_tag(parent["name"], tracker)
 
     if config.get("metadata", "tag_codec") and stash_file["video_codec"] is not None:
-        tags.add(stash_file["video_codec"])
+        handler.add(stash_file["video_codec"])
 
     if config.get("metadata", "tag_date") and scene["date"] is not None and len(scene["date"]) > 0:
         year, month, day = scene["date"].split("-")
-        tags.add(year)
-        tags.add(f"{year}.{month}")
-        tags.add(f"{year}.{month}.{day}")
+        handler.add(year)
+        handler.add(f"{year}.{month}")
+        handler.add(f"{year}.{month}.{day}")
 
     if config.get("metadata", "tag_framerate"):
-        tags.add(str(round(stash_file["frame_rate"])) + ".fps")
+        handler.add(str(round(stash_file["frame_rate"])) + ".fps")
 
+    studio_tag = ""
     if scene["studio"] and scene["studio"]["url"] is not None:
         studio_tag = urllib.parse.urlparse(scene["studio"]["url"]).netloc.removeprefix("www.")
-        tags.add(studio_tag)
+        handler.add(studio_tag)
     if (scene["studio"] is not None
         and scene["studio"]["parent_studio"] is not None
         and scene["studio"]["parent_studio"]["url"] is not None):
-        tags.add(urllib.parse.urlparse(scene["studio"]["parent_studio"]["url"]).netloc.removeprefix("www."))
+        handler.add(urllib.parse.urlparse(scene["studio"]["parent_studio"]["url"]).netloc.removeprefix("www."))
+
+    return {
+        "tags": " ".join(handler.tags),
+        "tag_lists": handler.sort_tag_lists(),
+        "tag_suggestions": dict(handler.tag_suggestions),
+        "performer_tags": performer_tags,
+        "studio_tag": studio_tag,
+    }
 
-    ##########
-    # UPLOAD #
-    ##########
 
+def upload_performers(performer_images: dict, images: imagehandler.ImageHandler, img_host: str) -> dict[str, Any]:
     logger.info("Uploading performer images")
-    for performer_name in performers:
-        performers[performer_name]["image_remote_url"] = images.get_url(
-            performers[performer_name]["image_path"],
-            performers[performer_name]["image_mime_type"],
-            performers[performer_name]["image_ext"],
-            img_host,
-            default=imagehandler.DEFAULT_IMAGES["performer"][img_host],
-        )[0]
-        os.remove(performers[performer_name]["image_path"])
-        if performers[performer_name]["image_remote_url"] is None:
-            performers[performer_name]["image_remote_url"] = imagehandler.DEFAULT_IMAGES["performer"][img_host]
+    urls = {}
+    uploaded = images.get_urls(
+        [(image["path"], image["mime_type"], image["ext"]) for image in performer_images.values()],
+        img_host,
+        default=imagehandler.DEFAULT_IMAGES["performer"][img_host],
+    )
+    for (performer_name, image), (url, _) in zip(performer_images.items(), uploaded):
+        urls[performer_name] = url
+        os.remove(image["path"])
+        if urls[performer_name] is None:
+            urls[performer_name] = imagehandler.DEFAULT_IMAGES["performer"][img_host]
             logger.warning(f"Unable to upload image for performer {performer_name}")
+    return {"performer_urls": urls}
+
 
+def upload_logo(studio_logo: dict | None, images: imagehandler.ImageHandler, img_host: str) -> dict[str, Any]:
     logo_url = imagehandler.DEFAULT_IMAGES["studio"][img_host]
-    if studio_img_file is not None and studio_img_ext != "":
+    if studio_logo is not None and studio_logo["ext"] != "":
         logger.info("Uploading studio logo")
-        logo_url = images.get_url(studio_img_file[1], studio_img_mime_type, studio_img_ext, img_host, )[0]
+        logo_url = images.get_url(studio_logo["path"], studio_logo["mime_type"], studio_logo["ext"], img_host, )[0]
         if logo_url is None:
             logo_url = imagehandler.DEFAULT_IMAGES["studio"][img_host]
             logger.warning("Unable to upload studio image")
-        delete_temp_file(studio_img_file[1])
+        delete_temp_file(studio_logo["path"])
+    return {"logo_url": logo_url}
 
-    if image_temp:
-        shutil.rmtree(image_dir)  # type: ignore
-        logger.debug(f"Deleted {image_dir}")
 
+def upload_gallery(gallery: dict | None, images: imagehandler.ImageHandler, img_host: str) -> dict[str, Any]:
     gallery_contact_url = None
-    if gallery_proc:
-        gallery_proc.join(timeout=60)
-        gallery_contact_url = images.get_url(gallery_contact, "image/jpeg", "jpg", img_host)[0]  # type: ignore
-        os.remove(gallery_contact)  # type: ignore
-
-    ############
-    # TEMPLATE #
-    ############
-
-    tmp_tag_lists = tags.sort_tag_lists()
+    if gallery is not None:
+        if gallery["temp"]:
+            shutil.rmtree(gallery["image_dir"])
+            logger.debug(f"Deleted {gallery['image_dir']}")
+        gallery_contact_url = images.get_url(gallery["contact"], "image/jpeg", "jpg", img_host)[0]
+        os.remove(gallery["contact"])
+    return {"gallery_contact_url": gallery_contact_url}
+
+
+def render(job: dict, publish: Callable[[str], None], img_host: str, scene: dict, stash_file: dict, title: str,
+           tags: str, tag_lists: dict[str, list[str]], tag_suggestions: dict[str, str], performer_tags: dict[str, str],
+           studio_tag: str, audio_bitrate: str, media_info: str, screens_urls: list[str], contact_sheet_url: str,
+           cover_url: str, cover_resized_url: str, preview_url: str | None, performer_urls: dict[str, str],
+           logo_url: str, gallery: dict | None, gallery_contact_url: str | None,
+           torrent_paths: list[str]) -> dict[str, Any]:
+    template = (job["template"] if "template" in job and job["template"] in config.template_names
+                else config.get("backend", "default_template"))
+    assert template is not None
 
     # Prevent error in case date is missing
     date = scene["date"]
@@ -511,16 +671,14 @@ def generate(j: dict) -> Generator[str, None, str | None]:
         date = datetime.datetime.fromisoformat(date).strftime(
             config.get("backend", "date_format", "%B %-d, %Y"))  # type: ignore
 
-    yield info("Rendering template")
+    publish(info("Rendering template"))
 
-    if info_proc is not None:
-        info_proc.join(timeout=60)
-        info_proc.close()
-        try:
-            info_send.close()
-            mediainfo = info_recv.recv()  # type: ignore
-        except EOFError:
-            error("Failed to generate media info")
+    performers = {}
+    for performer in scene["performers"]:
+        performers[performer["name"]] = {
+            "image_remote_url": performer_urls[performer["name"]],
+            "tag": performer_tags[performer["name"]],
+        }
 
     template_context = {
         "studio": scene["studio"]["name"] if scene["studio"] else "",
@@ -539,44 +697,23 @@ def generate(j: dict) -> Generator[str, None, str | None]:
         "bitrate": "{:.2f} Mb/s".format(stash_file["bit_rate"] / 2 ** 20),
         "framerate": "{} fps".format(stash_file["frame_rate"]),
         "screens": screens_urls if len(screens_urls) else None,
-        "contact_sheet": contact_sheet_remote_url,
+        "contact_sheet": contact_sheet_url,
         "performers": performers,
         "cover": cover_resized_url,
-        "image_count": image_count,
+        "image_count": gallery["count"] if gallery else 0,
         "gallery_contact": gallery_contact_url,
-        "media_info": mediainfo,
-        "pad":  imagehandler.DEFAULT_IMAGES["pad"][img_host],
+        "media_info": media_info,
+        "pad": imagehandler.DEFAULT_IMAGES["pad"][img_host],
     }
 
-    preview_url = None
     if config.get("images", "use_preview", False):
-        preview_proc.join(timeout=60)
-        try:
-            preview_proc.close()
-            preview_send.close()
-            preview_url = preview_recv.recv()
-        except EOFError:
-            error("Unable to upload preview GIF")
-        except ValueError:
-            error("Unable to generate preview GIF (too long)")
         template_context["preview"] = preview_url
 
-    for key in tmp_tag_lists:
-        template_context[key] = ", ".join(tmp_tag_lists[key])
+    for key in tag_lists:
+        template_context[key] = ", ".join(tag_lists[key])
 
     description = render_template(template, **template_context)  # type: ignore
 
-    tag_suggestions = tags.tag_suggestions
-
-    yield info("Waiting for torrent generation to complete")
-    torrent_proc.join(timeout=60)
-    send_pipe.close()
-    try:
-        torrent_paths = receive_pipe.recv()
-    except EOFError:
-        yield error("Failed to save torrent")
-        return
-
     result = {
         "status": "success",
         "data": {
@@ -585,8 +722,8 @@ def generate(j: dict) -> Generator[str, None, str | None]:
                 "title": title,
                 "cover": preview_url
                 if preview_url and config.get("images", "animated_cover", False)
-                else cover_remote_url,
-                "tags": " ".join(tags.tags),
+                else cover_url,
+                "tags": tags,
                 "description": description,
                 "torrent_path": torrent_paths[0],
                 "file_path": stash_file["path"],
@@ -595,93 +732,108 @@ def generate(j: dict) -> Generator[str, None, str | None]:
         },
     }
 
-    logger.debug(f"Sending {len(tag_suggestions)} suggestions")
     if len(tag_suggestions) > 0:
-        result["data"]["suggestions"] = dict(tag_suggestions)
-
-    yield json.dumps(result) + '\n'
-
-    for client in config.torrent_clients:
-        try:
-            path = new_dir if new_dir else stash_file["path"]
-            client.add(torrent_paths[0], path)
-        except Exception as e:
-            logger.error(f"Error attempting to add torrent to {client.name}")
-            logger.debug(e)
-
-    logger.success("Done")
-
-
-def gen_torrent(
-        pipe: Connection, stash_file: dict, announce_url: str, directory: str | None = None
-) -> list[str] | None:
-    torrent_path = stash_file["path"]
-    max_piece_size = int(math.log(8 * 1024 * 1024, 2))  # = 23, corresponding to 8MB (2^23 bytes)
-    piece_size = min(int(math.log(stash_file["size"] / 2 ** 10, 2)), max_piece_size)
-    tempdir = tempfile.TemporaryDirectory()
-    basename = "".join(c for c in stash_file["basename"] if c in FILENAME_VALID_CHARS)
+        result["data"]["suggestions"] = tag_suggestions
+
+    return {"result": result}
+
+
+STAGES = [
+    Stage(query_stash, ("scene",), "network"),
+    Stage(gallery, ("gallery",), "io"),
+    Stage(select_file, ("stash_file", "new_dir", "screens_dir", "resolution"), "io"),
+    Stage(image_handler, ("images",), "network"),
+    Stage(frames, ("frames",), "io"),
+    Stage(contact_sheet, ("contact_sheet_url",), "cpu", persist=True),
+    Stage(cover, ("cover",), "network"),
+    Stage(upload_cover, ("cover_url", "cover_resized_url"), "network", persist=True),
+    Stage(torrent, ("torrent_paths",), "io", persist=True),
+    Stage(preview, ("preview_url",), "network", persist=True),
+    Stage(studio_logo, ("studio_logo",), "network"),
+    Stage(performer_images, ("performer_images",), "network"),
+    Stage(screens, ("screens_urls",), "cpu", persist=True),
+    Stage(audio_bitrate, ("audio_bitrate",), "io", persist=True),
+    Stage(media_info, ("media_info",), "io", persist=True),
+    Stage(title, ("title",), "cpu"),
+    Stage(tags, ("tags", "tag_lists", "tag_suggestions", "performer_tags", "studio_tag"), "io"),
+    Stage(upload_performers, ("performer_urls",), "network", persist=True),
+    Stage(upload_logo, ("logo_url",), "network", persist=True),
+    Stage(upload_gallery, ("gallery_contact_url",), "network", persist=True),
+    Stage(render, ("result",), "cpu"),
+]
+
+
+def get_resolution(ht: int) -> str | None:
+    resolution = None
+    # these are stash's heuristics, see pkg/models/resolution.go
+    if 144 <= ht < 240:
+        resolution = "144p"
+    elif 240 <= ht < 360:
+        resolution = "240p"
+    elif 360 <= ht < 480:
+        resolution = "360p"
+    elif 480 <= ht < 540:
+        resolution = "480p"
+    elif 540 <= ht < 720:
+        resolution = "540p"
+    elif 720 <= ht < 1080:
+        resolution = "720p"
+    elif 1080 <= ht < 1440:
+        resolution = "1080p"
+    elif 1440 <= ht < 1920:
+        resolution = "1440p"
+    elif 1920 <= ht < 2560:
+        resolution = "2160p"
+    elif 2560 <= ht < 3000:
+        resolution = "5K"
+    elif 3000 <= ht < 3584:
+        resolution = "6K"
+    elif 3584 <= ht < 3840:
+        resolution = "7K"
+    elif 3840 <= ht < 6143:
+        resolution = "8K"
+    elif ht >= 6143:
+        resolution = "8K+"
+    return resolution
 
-    target = directory if directory else torrent_path
 
-    temp_path = os.path.join(tempdir.name, basename + ".torrent")
+def gen_torrent(stash_file: dict, announce_url: str, directory: str | None = None,
+                publish: Callable[[str], None] | None = None) -> list[str] | None:
+    target = directory if directory else stash_file["path"]
     torrent_paths = [os.path.join(d, stash_file["basename"] + ".torrent") for d in config.torrent_dirs]
-    logger.debug(f"Saving torrent to {temp_path}")
-
-    if shutil.which("mkbrr") is None:
-        cmd = [
-            "mktorrent",
-            "-l",
-            str(piece_size),
-            "-s",
-            source_for_announce(announce_url),
-            "-a",
-            announce_url,
-            "-p",
-            "-v",
-            "-o",
-            temp_path,
-            target,
-        ]
-    else:
-        cmd = [
-            "mkbrr",
-            "create",
-            "-l",
-            str(piece_size),
-            "-s",
-            source_for_announce(announce_url),
-            "-t",
-            announce_url,
-            "-v",
-            "-o",
-            temp_path,
-            target,
-        ]
-    sanitized = sanitize_announce_url(announce_url)
-    logger.debug(f"Executing: {' '.join(cmd).replace(announce_url, sanitized)}")
-
-    process = subprocess.run(cmd, stdout=subprocess.PIPE, text=False)
-    output = process.stdout.decode("utf-8") # decoding bytes vs setting text=True preserves carriage returns
-    if config.get("backend", "sanitize_logs", False):
-        output = output.replace(announce_url, sanitized)
-    logger.debug(f"mktorrent output:\n{output}")
-    if process.returncode != 0:
-        tempdir.cleanup()
-        logger.error("mktorrent failed, command: " + " ".join(cmd), "Couldn't generate torrent")
+    job = current_job.get()
+    last_update = 0.0
+
+    def progress(hashed: int, total: int) -> None:
+        nonlocal last_update
+        if publish is not None and (time.monotonic() - last_update > 1 or hashed == total):
+            last_update = time.monotonic()
+            publish(info(f"Hashing pieces: {hashed * 100 // total}%"))
+
+    source = source_for_announce(announce_url)
+    if source is None:
+        raise StageError(f"Unrecognized tracker for announce URL {sanitize_announce_url(announce_url)}")
+    logger.debug(f"Making torrent for {target} with announce URL {sanitize_announce_url(announce_url)}")
+    try:
+        data = make_torrent(target, announce_url, source, progress,
+                            job.cancel_event if job is not None else None, PieceHashCache())
+    except OSError as e:
+        logger.error(f"Failed to read {target}: {e}")
         return
     for path in torrent_paths:
-        shutil.copy(temp_path, path)
-    tempdir.cleanup()
-    logger.debug(f"Moved torrent to {torrent_paths}")
-    pipe.send(torrent_paths)
+        with open(path, "wb") as f:
+            f.write(data)
+        torrent_index.add(path, target)
+    logger.debug(f"Saved torrent to {torrent_paths}")
+    return torrent_paths
 
 
-def gen_media_info(pipe: Connection, path: str) -> None:
+def gen_media_info(path: str) -> str:
     cmd = [MEDIA_INFO, path]
-    pipe.send(subprocess.check_output(cmd, text=True))
+    return jobs.check_output(cmd, text=True)
 
 
-def source_for_announce(announce_url: str) -> str:
+def source_for_announce(announce_url: str) -> str | None:
     announce_url = announce_url.lower()
     if "empornium" in announce_url:
         return "Emp"
@@ -1,31 +1,39 @@
-import asyncio
 import hashlib
+import io
+import math
 import os
+import re
 import shutil
 import subprocess
 import tempfile
-import uuid
-from multiprocessing import Pool
-from multiprocessing.connection import Connection
-from typing import Any, Optional, Sequence
+import threading
+from typing import Any, Callable, Optional, Sequence
 
-import pyimgbox
 import requests
-from PIL import Image, ImageSequence
+from PIL import Image, ImageDraw, ImageFont, ImageSequence
 from loguru import logger
-from requests import JSONDecodeError
 
+from utils import jobs
+from utils.jobs import current_job
+from utils.frames import extract_frames, frame_times
 from utils.confighandler import ConfigHandler, stash_headers
 from utils.packs import prep_dir
 from utils.paths import delete_temp_file
-
-try:
-    import redis
-except ImportError:
-    redis = None
-    logger.info("Redis module not found, using local caching only")
-
-CHUNK_SIZE = 5000
+from utils.uploader import Upload, uploader
+from utils.urlcache import url_cache
+
+HOST_MAX_SIZES = {"hamster": 10_000_000, "imgbox": 5_000_000}
+PREVIEW_MAX_SIZE = 5_000_000
+# Maximum number of encodes used to find the largest preview that fits, and how close to it they must get
+PREVIEW_ATTEMPTS = 4
+PREVIEW_WIDTH_STEP = 16
+# Encoding images to fit a size limit aims slightly below it, and gives up after a few attempts
+FIT_MARGIN = 0.9
+FIT_ATTEMPTS = 8
+# JPEG qualities tried, in order, before scaling an image down
+FIT_JPEG_QUALITIES = (90, 80, 70, 60)
+# A cue of a sprite VTT file, e.g. "00:01:05.000 --> 00:01:10.000" followed by "sprite.jpg#xywh=160,0,160,90"
+SPRITE_CUE = re.compile(r"(?:(\d+):)?(\d+):(\d+(?:\.\d+)?) -->[^\n]*\n[^\n]*#xywh=(\d+),(\d+),(\d+),(\d+)")
 DEFAULT_IMAGES = {
     "pad": {
         "hamster": "https://hamster.is/images/2025/06/21/pad.png",
@@ -40,11 +48,11 @@ DEFAULT_IMAGES = {
         "imgbox": "https://images2.imgbox.com/be/38/pohu1oLT_o.png",
     }
 }
-PREFIX = "stash-empornium"
-HASH_PREFIX = f"{PREFIX}-file"
-
 conf = ConfigHandler()
 
+# The bytes per pixel of recent images encoded to fit a size limit, by format and quality
+fit_hints: dict[tuple[str, Optional[int]], float] = {}
+
 
 def save_failed_upload(path: str) -> None:
     dir_name: str | None = conf.get("images", "save_images")
@@ -59,67 +67,17 @@ def save_failed_upload(path: str) -> None:
 
 
 class ImageHandler:
-    digests: dict[str, dict[str, list[str]]] = {}
-    redis = None
-    no_cache: bool = False
-    overwrite: bool = False
-
     def __init__(self) -> None:
-        self.urls: dict[str, dict[str, str]] = {"hamster": {}, "imgbox": {}}
-        self.configure_cache()
-
-    def configure_cache(self) -> None:
-        redis_host: str = conf.get("redis", "host", "")  # type: ignore
-        redis_port: int = conf.get("redis", "port", 6379)  # type: ignore
-        user = conf.get("redis", "username", "")
-        password = conf.get("redis", "password", "")
-        use_ssl: bool = conf.get("redis", "ssl", False)  # type: ignore
-        no_cache = conf.args.no_cache
-        overwrite = conf.args.overwrite
-        flush = conf.args.flush
-
-        enable = redis is not None and not conf.get("redis", "disable", False)
-        self.overwrite = overwrite
-        self.no_cache = no_cache
-        if not no_cache and redis_host is not None and enable and self.redis is None:
-            try:
-                self.redis = redis.Redis(
-                    redis_host, redis_port, username=user, password=password, ssl=use_ssl, decode_responses=True
-                )
-                # It doesn't matter if this exists or not. An exception will be raised if not connected,
-                # so we can "check" for any arbitrary value to see if connected
-                self.redis.exists("connection_check")
-                logger.debug(
-                    f"Successfully connected to redis at {redis_host}:{redis_port}{' using ssl' if use_ssl else ''}"
-                )
-                if flush:
-                    self.clear()
-                    logger.debug("Cleared cache")
-            except redis.exceptions.AuthenticationError as e:
-                logger.error(f"Failed to authenticate with redis: {e} Check the username and password.")
-                self.redis = None
-            except redis.exceptions.ConnectionError as e:
-                logger.error(f"Failed to connect to redis: {e} Check that the host and port are correct.")
-                self.redis = None
-        else:
-            logger.debug("Not connecting to redis")
+        # Every image uploaded for a job goes into the same imgbox gallery
+        job = current_job.get()
+        self.gallery = job.id if job is not None else None
+        url_cache.configure()
 
     def exists(self, key: str, host: str) -> bool:
-        if key in self.urls[host]:
-            return True
-        return self.redis is not None and self.redis.exists(f"{PREFIX}:{host}:{key}") != 0
+        return url_cache.exists(key, host)
 
     def get(self, key: str, host: str) -> Optional[str]:
-        if self.no_cache or self.overwrite:
-            return None
-        if key in self.urls[host]:
-            return self.urls[host][key]
-        elif self.redis is not None:
-            value = self.redis.get(f"{PREFIX}:{host}:{key}")
-            if value is not None:
-                self.urls[host][key] = str(value)
-                return str(value)
-        return None
+        return url_cache.get(key, host)
 
     def get_images(self, scene_id: str, key: str, host: str) -> list[Optional[str]]:
         """
@@ -133,38 +91,23 @@ class ImageHandler:
         if host == "hamster" and key == "preview":
             key = "webp"
 
-        if self.no_cache or self.overwrite:
-            logger.debug("Skipping cache check")
-            return [None]
-        if scene_id in self.digests and key in self.digests[scene_id]:
-            urls = [self.get(digest, host) for digest in self.digests[scene_id][key]]
-            logger.debug(f"Got {len(urls)} urls of type {key} for file {scene_id} from local cache")
-            return urls
-        if self.redis is not None:
-            digests = self.redis.hget(f"{HASH_PREFIX}:{scene_id}", key)
-            if digests is not None:
-                if scene_id not in self.digests:
-                    self.digests[scene_id] = {}
-                self.digests[scene_id][key] = str(digests).split(":")
-                urls = [self.get(digest, host) for digest in str(digests).split(":")]
-
-                # Messy cleanup for bug where `None` sometimes gets cached as a URL
-                if urls != [None]:
-                    logger.debug(f"Got {len(urls)} urls of type {key} for file {scene_id} from remote cache")
-                    logger.debug(f"URLs: {urls}")
-                    return urls
-                else:
-                    self.redis.hdel(f"{HASH_PREFIX}:{scene_id}", key)
+        digests = url_cache.get_scene(scene_id, key)
+        if digests is not None:
+            urls = self.get_cached_urls(digests, host)
+            # Messy cleanup for bug where `None` sometimes gets cached as a URL
+            if urls != [None]:
+                logger.debug(f"Got {len(urls)} urls of type {key} for file {scene_id} from cache")
+                logger.debug(f"URLs: {urls}")
+                return urls
+            url_cache.delete_scene(scene_id, key)
         logger.debug(f"No images found in cache for file {scene_id}")
         return [None]
 
-    def process_preview(self, pipe: Connection, scene: dict[str, Any], host: str) -> Optional[str]:
+    def process_preview(self, scene: dict[str, Any], host: str) -> Optional[str]:
         logger.info("Getting scene preview")
         preview_url = self.get_images(scene["files"][0]["id"], "preview", host)[0]
         if preview_url:
-            pipe.send(preview_url)
-            pipe.close()
-            return
+            return preview_url
 
         if host == "hamster":
             # hamster (hamster) host supports webp, so try that first
@@ -180,50 +123,38 @@ class ImageHandler:
                         for file in scene["files"]:
                             self.set_images(file["id"], "preview", [digest], host)
                     if preview_url:
-                        pipe.send(preview_url)
-                        pipe.close()
-                        return
+                        return preview_url
         # If not using webp-compatible host, or if webp was not found, try mp4 preview
         preview = requests.get(scene["paths"]["preview"], headers=stash_headers) if scene["paths"]["preview"] else None
         if preview:
             with tempfile.TemporaryDirectory() as tempdir:
                 temppath = os.path.join(tempdir, "preview.mp4")
-                output = os.path.join(tempdir, "preview.gif")
                 with open(temppath, "wb") as temp:
                     temp.write(preview.content)
-                CMD = ["ffmpeg", "-i", temppath, "-vf",
-                       "fps=10,scale=320:-1:flags=lanczos,split[s0][s1];[s0]palettegen[p];[s1][p]paletteuse",
-                       output, "-y"]
-                proc = subprocess.run(CMD, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-                logger.debug(f"ffmpeg output:\n{proc.stdout}")
-                if proc.returncode:
-                    logger.error("Error generating preview GIF")
-                    pipe.send(None)
-                    pipe.close()
-                    return
-                width = 310
-                while os.path.getsize(output) > 5000000:
-                    CMD[4] = f"fps=10,scale={width}:-1:flags=lanczos,split[s0][s1];[s0]palettegen[p];[s1][p]paletteuse"
-                    proc = subprocess.run(CMD, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-                    logger.debug(f"ffmpeg output:\n{proc.stdout}")
-                    if proc.returncode:
-                        logger.error("Error generating preview GIF")
-                        pipe.send(None)
-                        pipe.close()
-                        return
-                    width -= 10
-                preview_url, digest = self.get_url(output, "image/gif", "gif", host, default=None)
+                # Animated WebP is much smaller than GIF for the same quality, so use it where it is accepted
+                formats = ["webp", "gif"] if host == "hamster" else ["gif"]
+                output = None
+                for extension in formats:
+                    output = os.path.join(tempdir, f"preview.{extension}")
+                    if encode_preview(temppath, output):
+                        break
+                    logger.error(f"Error generating preview {extension.upper()}")
+                    output = None
+                if output is None:
+                    return None
+                extension = os.path.splitext(output)[1][1:]
+                preview_url, digest = self.get_url(output, f"image/{extension}", extension, host, default=None)
                 if digest:
                     # TODO properly index file based on user selection
                     for file in scene["files"]:
                         self.set_images(file["id"], "preview", [digest], host)
         else:
             logger.error(f"No preview found for scene {scene['id']}")
-        pipe.send(preview_url)
-        pipe.close()
+        return preview_url
 
-    def generate_contact_sheet(self, stash_file: dict[str, Any], host: str, screens_dir: str | None = None) -> Optional[
-        str]:
+    def generate_contact_sheet(self, stash_file: dict[str, Any], host: str, screens_dir: str | None = None,
+                               frames: Optional["FrameSet"] = None,
+                               scene: Optional[dict[str, Any]] = None) -> Optional[str]:
         """
         Generates a contact sheet for a stash video file, uploads it, and returns the URL. If caching is enabled
         and the image has been uploaded before, the existing URL will be returned without re-uploading the image.
@@ -234,45 +165,65 @@ class ImageHandler:
         :type stash_file: dict
         :param screens_dir: Where to save images for inclusion in the torrent
         :type screens_dir: str
+        :param frames: Frames shared with the screenshots. Any frames that are missing will be extracted.
+        :param scene: The scene containing the file. If ``contact_sheet_sprites`` is enabled, the thumbnails will be
+            taken from the scene's sprite image instead of the video when possible.
         :return: The URL of the uploaded image, or ``None`` if uploading fails
         :rtype: str
         """
-        contact_sheet_file = tempfile.mkstemp(suffix="-contact.jpg")
-        os.chmod(contact_sheet_file[1], 0o666)  # Ensures torrent client can read the file
-
-        dimensions = conf.get("images", "contact_sheet_layout", "3x6")
-
-        cmd = ["vcsi", stash_file["path"], "-g", dimensions, "-o", contact_sheet_file[1]]
         logger.info("Generating contact sheet")
         contact_sheet_remote_url = self.get_images(stash_file["id"], "contact", host)[0]
-        if contact_sheet_remote_url is None or screens_dir is not None:
-            process = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-            logger.debug(f"vcsi output:\n{process.stdout}")
-            if process.returncode != 0:
-                logger.error("Couldn't generate contact sheet")
-                delete_temp_file(contact_sheet_file[1])
-                return None
+        if contact_sheet_remote_url is not None and screens_dir is None:
+            return contact_sheet_remote_url
+
+        columns, rows = contact_sheet_grid()
+        timestamps = frame_times(stash_file["duration"], columns * rows)
+        images: Sequence[Optional[tuple[float, bytes]]] | None = None
+        width = 1500
+        if scene is not None and conf.get("images", "contact_sheet_sprites", False):
+            images = sprite_frames(scene, timestamps)
+            if images:
+                with Image.open(io.BytesIO(images[0][1])) as thumbnail:
+                    # Sprite thumbnails are small, so don't scale them up too much
+                    width = min(width, columns * (thumbnail.width * 2 + 5) + 5)
+            else:
+                logger.info("No sprite found for scene, extracting frames from the video instead")
+        if not images:
+            if frames is None:
+                frames = FrameSet(stash_file["path"], stash_file["duration"])
+            images = frames.get(timestamps)
+        if None in images:
+            logger.error("Couldn't generate contact sheet")
+            return None
 
-            if screens_dir is not None:
-                prep_dir(screens_dir)  # Ensure directory exists
-                shutil.copy(contact_sheet_file[1], os.path.join(screens_dir, 'contact_sheet.jpg'))
+        fd, contact_sheet_file = tempfile.mkstemp(suffix="-contact.jpg")
+        os.close(fd)
+        os.chmod(contact_sheet_file, 0o666)  # Ensures torrent client can read the file
+        create_video_contact_sheet(stash_file, images, columns, contact_sheet_file, width)  # type: ignore
 
+        if screens_dir is not None:
+            prep_dir(screens_dir)  # Ensure directory exists
+            shutil.copy(contact_sheet_file, os.path.join(screens_dir, 'contact_sheet.jpg'))
+
+        if contact_sheet_remote_url is None:
             logger.info("Uploading contact sheet")
+            contact_sheet_remote_url, digest = self.get_url(contact_sheet_file, "image/jpeg", "jpg", host,
+                                                            default=None)
             if contact_sheet_remote_url is None:
-                contact_sheet_remote_url, digest = self.get_url(contact_sheet_file[1], "image/jpeg", "jpg", host,
-                                                                default=None)
-                if contact_sheet_remote_url is None:
-                    logger.error("Failed to upload contact sheet")
-                    delete_temp_file(contact_sheet_file[1])
-                    return None
-                if digest is not None:
-                    self.set_images(stash_file["id"], "contact", [digest], host)
-        delete_temp_file(contact_sheet_file[1])
+                logger.error("Failed to upload contact sheet")
+                delete_temp_file(contact_sheet_file)
+                return None
+            if digest is not None:
+                self.set_images(stash_file["id"], "contact", [digest], host)
+        delete_temp_file(contact_sheet_file)
         return contact_sheet_remote_url
 
-    def generate_screens(self, stash_file: dict[str, Any], host: str, num_frames: int = 0) -> Sequence[Optional[str]]:
+    def generate_screens(self, stash_file: dict[str, Any], host: str, num_frames: int = 0,
+                         frames: Optional["FrameSet"] = None) -> Sequence[Optional[str]]:
         if num_frames == 0:
             num_frames = conf.get("images", "num_screens", 10)
+        if frames is None:
+            frames = FrameSet(stash_file["path"], stash_file["duration"])
 
         screens = self.get_images(stash_file["id"], "screens", host)
         if len(screens) > 0 and None not in screens:
@@ -281,26 +232,22 @@ class ImageHandler:
         screens = []
         digests = []
 
-        cmds: list[tuple] = []
-
-        for seek in map(
-                lambda i: stash_file["duration"] * (0.05 + i / (num_frames - 1) * 0.9),
-                range(num_frames),
-        ):
-            cmds.append((stash_file["path"], str(seek)))
-        with Pool() as p:
-            paths = p.starmap(generate_screen, cmds)
-        logger.debug(paths)
-        cmds.clear()
-        for path in paths:
-            digests.append(getDigest(path))
-            cmds.append((path, "image/jpeg", "jpg", host))
+        paths = []
+        for frame_info in frames.get(frame_times(stash_file["duration"], num_frames)):
+            if frame_info is None:
+                continue
+            frame = frame_info[1]
+            digests.append(hashlib.md5(frame).hexdigest())
+            fd, path = tempfile.mkstemp(suffix="-screen.jpg")
+            with os.fdopen(fd, "wb") as f:
+                f.write(frame)
+            paths.append(path)
         logger.debug(f"Digests: {digests}")
-        with Pool() as p:
-            screens = p.starmap(img_host_upload, cmds)
-        for url, digest in zip(screens, digests):
+        uploaded = img_host_upload_batch([(path, "image/jpeg", "jpg") for path in paths], host, gallery=self.gallery)
+        screens = [url for url, _ in uploaded]
+        for (url, uploaded_host), digest in zip(uploaded, digests):
             if url:
-                self.add(digest, host, url)
+                self.add(digest, uploaded_host, url)
             else:
                 digests.remove(digest)
         if len(digests) > 0:
@@ -319,62 +266,330 @@ class ImageHandler:
             width: int = 0,
             default: str | None = DEFAULT_IMAGES["studio"]["hamster"],
     ) -> tuple[str | None, str | None]:
-        # Return cached url if available
-        if width > 0:
-            with Image.open(img_path) as img:
-                img.thumbnail((width, img.height))
-                img.save(img_path)
-                logger.debug(f"Resized image to {img.width}x{img.height}")
+        return self.get_renditions(img_path, img_mime_type, image_ext, host, [width], default)[0]
+
+    def get_renditions(
+            self,
+            img_path: str,
+            img_mime_type: str,
+            image_ext: str,
+            host: str,
+            widths: Sequence[int],
+            default: str | None = DEFAULT_IMAGES["studio"]["hamster"],
+    ) -> list[tuple[str | None, str | None]]:
+        """
+        Get the URLs of several renditions of an image, uploading any that are not cached. Renditions are cached
+        by the digest of the original image and their width, so the image is only decoded if a rendition needs
+        to be uploaded, and then only once for all of them.
+        :param widths: The width to scale each rendition down to, or 0 for the original image
+        :return: The URL and cache key of each rendition, in the same order as `widths`
+        """
         digest = getDigest(img_path)
-        url = self.get(digest, host)
-        if url is not None:
-            logger.debug(f"Found url {url} in cache")
-            # hamster image host has been phased out in favour of hamster:
-            if (host == "hamster" and "hamster.is" in url) or host != "hamster":
-                return url, digest
+        keys = [digest if width == 0 else f"{digest}-w{width}" for width in widths]
+        urls = [self.get_cached_url(key, host) for key in keys]
+        missing = [i for i, url in enumerate(urls) if url is None]
+        if not missing:
+            return list(zip(urls, keys))
+
+        renditions: dict[int, bytes] = {}
+        if any(widths[i] > 0 for i in missing):
+            with Image.open(img_path) as img:
+                for i in missing:
+                    if widths[i] > 0:
+                        rendition = img.copy()
+                        rendition.thumbnail((widths[i], img.height))
+                        logger.debug(f"Resized image to {rendition.width}x{rendition.height}")
+                        buffer = io.BytesIO()
+                        rendition.save(buffer, format=img.format)
+                        renditions[i] = buffer.getvalue()
+
+        paths = {}
+        for i in missing:
+            paths[i] = img_path
+            if i in renditions:
+                fd, paths[i] = tempfile.mkstemp(suffix=f"-{widths[i]}.{image_ext}")
+                with os.fdopen(fd, "wb") as f:
+                    f.write(renditions[i])
+        uploaded = img_host_upload_batch([(paths[i], img_mime_type, image_ext) for i in missing], host,
+                                         gallery=self.gallery)
+        for i, (url, uploaded_host) in zip(missing, uploaded):
+            if url is not None:
+                self.add(keys[i], uploaded_host, url)
+                urls[i] = url
             else:
-                print(f"Skipping url {url}")
-        url = img_host_upload(img_path, img_mime_type, image_ext, host)
-        if url is not None:
-            self.add(digest, host, url)
-            return url, digest
-        save_failed_upload(img_path)
-        return default, digest
+                save_failed_upload(paths[i])
+                urls[i] = default
+            if paths[i] != img_path:
+                delete_temp_file(paths[i])
+        return list(zip(urls, keys))
+
+    def get_urls(
+            self,
+            images: Sequence[tuple[str, str, str]],
+            host: str,
+            default: str | None = DEFAULT_IMAGES["studio"]["hamster"],
+    ) -> list[tuple[str | None, str | None]]:
+        """
+        Get the URLs of several images at once, each given as its path, MIME type and extension. Images that
+        are not cached are uploaded together.
+        :return: The URL and digest of each image, in the same order as `images`
+        """
+        digests = [getDigest(path) for path, _, _ in images]
+        urls = [self.get_cached_url(digest, host) for digest in digests]
+        missing = [i for i, url in enumerate(urls) if url is None]
+        uploaded = img_host_upload_batch([images[i] for i in missing], host, gallery=self.gallery)
+        for i, (url, uploaded_host) in zip(missing, uploaded):
+            if url is not None:
+                self.add(digests[i], uploaded_host, url)
+                urls[i] = url
+            else:
+                save_failed_upload(images[i][0])
+                urls[i] = default
+        return list(zip(urls, digests))
+
+    def get_cached_url(self, key: str, host: str) -> Optional[str]:
+        return self.get_cached_urls([key], host)[0]
+
+    def get_cached_urls(self, keys: Sequence[str], host: str) -> list[Optional[str]]:
+        # Images may have been uploaded to another host if `host` was failing at the time
+        hosts = [host]
+        if conf.get("images", "upload_failover", True):
+            hosts += [other for other in HOST_MAX_SIZES if other != host]
+        found = url_cache.get_many([(candidate, key) for key in keys for candidate in hosts])
+        urls: list[Optional[str]] = []
+        for i in range(len(keys)):
+            urls.append(None)
+            for candidate, url in zip(hosts, found[i * len(hosts):(i + 1) * len(hosts)]):
+                if url is None:
+                    continue
+                logger.debug(f"Found url {url} in cache")
+                # hamster image host has been phased out in favour of hamster:
+                if (candidate == "hamster" and "hamster.is" in url) or candidate != "hamster":
+                    urls[-1] = url
+                    break
+                else:
+                    logger.debug(f"Skipping url {url}")
+        return urls
 
     def set_images(self, scene_id: str, key: str, digests: list[str], host: str) -> None:
-        if self.no_cache:
-            return
-        if scene_id not in self.digests:
-            self.digests[scene_id] = {}
-        self.digests[scene_id][key] = digests
-        logger.debug(f"Added {len(digests)} image digests of type {key} to local cache")
-        if self.redis is not None:
-            self.redis.hset(f"{HASH_PREFIX}:{scene_id}", key, ":".join(digests))
-            logger.debug(f"Added {len(digests)} image digests of type {key} to remote cache")
+        url_cache.set_scene(scene_id, key, digests)
+        logger.debug(f"Added {len(digests)} image digests of type {key} to cache")
 
     def add(self, key, host, value) -> None:
-        if self.no_cache:
+        url_cache.add(key, host, value)
+
+    def clear(self) -> None:
+        url_cache.clear()
+
+
+class FrameSet:
+    """
+    Frames of a video shared by the screenshots and the contact sheet. The
+    first request extracts every planned frame in a single pass, and later
+    requests only extract the frames that are still missing.
+    """
+
+    def __init__(self, path: str, duration: float, planned: Sequence[float] = ()) -> None:
+        self.path = path
+        self.duration = duration
+        self.planned = {round(t, 3) for t in planned}
+        # The actual time and contents of the frame extracted for each requested timestamp
+        self.frames: dict[float, tuple[float, bytes]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, timestamps: Sequence[float]) -> list[Optional[tuple[float, bytes]]]:
+        timestamps = [round(t, 3) for t in timestamps]
+        with self._lock:
+            if any(t not in self.frames for t in timestamps):
+                missing = sorted(self.planned.union(timestamps).difference(self.frames))
+                self.planned.clear()
+                frames = extract_frames(self.path, missing)
+                if len(frames) != len(missing):
+                    # Frames can't be matched to their timestamps, so get them one at a time
+                    frames = [next(iter(extract_frames(self.path, [t])), None) for t in missing]
+                self.frames.update((t, f) for t, f in zip(missing, frames) if f is not None)
+            return [self.frames.get(t) for t in timestamps]
+
+
+def contact_sheet_grid() -> tuple[int, int]:
+    layout: str = conf.get("images", "contact_sheet_layout", "3x6")  # type: ignore
+    columns, rows = layout.lower().split("x")
+    return int(columns), int(rows)
+
+
+def parse_sprite_vtt(vtt: str) -> list[tuple[float, tuple[int, int, int, int]]]:
+    """
+    Reads the cues of a Stash scrubber VTT file.
+    :return: The start time of each cue and the box of its thumbnail in the sprite image
+    """
+    cues = []
+    for match in SPRITE_CUE.finditer(vtt):
+        hours, minutes, seconds = match.group(1, 2, 3)
+        start = int(hours or 0) * 3600 + int(minutes) * 60 + float(seconds)
+        x, y, w, h = (int(n) for n in match.group(4, 5, 6, 7))
+        cues.append((start, (x, y, x + w, y + h)))
+    return cues
+
+
+def sprite_frames(scene: dict[str, Any], timestamps: Sequence[float]) -> Optional[list[tuple[float, bytes]]]:
+    """
+    Crops the thumbnails closest to each timestamp out of the scene's sprite
+    image, which Stash generates for its video scrubber.
+    :return: The time and JPEG image of each thumbnail, or ``None`` if the scene has no sprite
+    """
+    sprite_url, vtt_url = scene["paths"].get("sprite"), scene["paths"].get("vtt")
+    if not sprite_url or not vtt_url:
+        return None
+    try:
+        vtt = requests.get(vtt_url, headers=stash_headers)
+        vtt.raise_for_status()
+        cues = parse_sprite_vtt(vtt.text)
+        if not cues:
             return None
-        self.urls[host][key] = value
-        if self.redis is not None:
-            self.redis.set(f"{PREFIX}:{host}:{key}", value)
+        sprite = requests.get(sprite_url, headers=stash_headers)
+        sprite.raise_for_status()
+        frames = []
+        with Image.open(io.BytesIO(sprite.content)) as img:
+            for timestamp in timestamps:
+                start, box = min(cues, key=lambda cue: abs(cue[0] - timestamp))
+                buffer = io.BytesIO()
+                img.crop(box).convert("RGB").save(buffer, "JPEG", quality=95)
+                frames.append((start, buffer.getvalue()))
+        return frames
+    except (requests.RequestException, OSError) as e:
+        logger.debug(f"Couldn't get sprite for scene {scene['id']}: {e}")
         return None
 
-    def clear(self) -> None:
-        url_count = len(self.urls)
-        self.urls = {'hamster': {}, 'imgbox': {}}
-        if self.redis is not None:
-            cursor = 0
-            ns_keys = f"{PREFIX}*"
-            count = 0
-            while True:
-                cursor, keys = self.redis.scan(cursor=cursor, match=ns_keys, count=CHUNK_SIZE)  # type: ignore
-                if keys:
-                    count += len(keys)
-                    self.redis.delete(*keys)
-                if cursor == 0:
+
+def format_timestamp(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}"
+
+
+def create_video_contact_sheet(stash_file: dict[str, Any], frames: list[tuple[float, bytes]], columns: int,
+                               output: str, width: int = 1500, padding: int = 5) -> str:
+    """
+    Tiles frames of a video in a grid below a header describing the file,
+    with the timestamp of each frame in its corner.
+    """
+    rows = math.ceil(len(frames) / columns)
+    tile_width = (width - (columns + 1) * padding) // columns
+    with Image.open(io.BytesIO(frames[0][1])) as first:
+        tile_height = round(tile_width * first.height / first.width)
+
+    font = ImageFont.load_default(size=16)
+    small_font = ImageFont.load_default(size=max(12, tile_width // 20))
+    header = [
+        f"File name: {stash_file['basename']}",
+        f"File size: {stash_file['size'] / 2 ** 20:.1f} MiB",
+        f"Duration: {format_timestamp(stash_file['duration'])}",
+        f"Video: {stash_file['video_codec']}, {stash_file['width']}x{stash_file['height']}, "
+        f"{stash_file['frame_rate']:.2f} fps",
+        f"Audio: {stash_file['audio_codec']}",
+    ]
+    line_height = 20
+    header_height = padding * 2 + line_height * len(header)
+
+    sheet = Image.new("RGB", (width, header_height + rows * (tile_height + padding) + padding), "black")
+    draw = ImageDraw.Draw(sheet)
+    for i, line in enumerate(header):
+        draw.text((padding * 2, padding + i * line_height), line, fill="white", font=font)
+
+    for i, (timestamp, frame) in enumerate(frames):
+        left = padding + (i % columns) * (tile_width + padding)
+        top = header_height + (i // columns) * (tile_height + padding)
+        with Image.open(io.BytesIO(frame)) as img:
+            sheet.paste(img.convert("RGB").resize((tile_width, tile_height), Image.LANCZOS), (left, top))
+        label = format_timestamp(timestamp)
+        # Anchors aren't supported by the bitmap font used when FreeType is unavailable, so align manually
+        _, _, label_width, label_height = draw.textbbox((0, 0), label, font=small_font, stroke_width=2)
+        position = (left + tile_width - padding - label_width, top + tile_height - padding - label_height)
+        # Outline the text so that it is readable on any background
+        draw.text(position, label, fill="white", font=small_font, stroke_width=2, stroke_fill="black")
+    sheet.save(output, quality=90)
+    sheet.close()
+    return output
+
+
+def encode_preview(source: str, output: str, max_size: int = PREVIEW_MAX_SIZE, width: int = 320, fps: int = 10,
+                   min_width: int = 160) -> bool:
+    """
+    Encodes a video as an animated GIF or WebP, depending on the extension of
+    `output`, that is no larger than `max_size` bytes. The size of the first
+    encode is used to predict the largest width that fits, and a few more
+    encodes narrow it down. The frame rate is only lowered if the output is
+    still too large at `min_width`. GIFs reuse a single palette for every
+    attempt.
+    :return: Whether an image small enough was written to `output`
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        palette = None
+        if output.endswith(".gif"):
+            palette = os.path.join(tmpdir, "palette.png")
+            cmd = ["ffmpeg", "-i", source, "-vf", f"fps={fps},scale={width}:-1:flags=lanczos,palettegen", palette, "-y"]
+            proc = jobs.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+            logger.debug(f"ffmpeg output:\n{proc.stdout}")
+            if proc.returncode:
+                return False
+
+        def encode(w: int, f: int) -> Optional[int]:
+            attempt = os.path.join(tmpdir, f"{w}-{f}{os.path.splitext(output)[1]}")
+            if palette is None:
+                cmd = ["ffmpeg", "-i", source, "-vf", f"fps={f},scale={w}:-1:flags=lanczos", "-c:v", "libwebp",
+                       "-loop", "0", "-q:v", "70", "-an", attempt, "-y"]
+            else:
+                cmd = ["ffmpeg", "-i", source, "-i", palette, "-lavfi",
+                       f"fps={f},scale={w}:-1:flags=lanczos[x];[x][1:v]paletteuse", attempt, "-y"]
+            proc = jobs.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+            logger.debug(f"ffmpeg output:\n{proc.stdout}")
+            if proc.returncode:
+                return None
+            size = os.path.getsize(attempt)
+            logger.debug(f"Preview at {w}px and {f} fps is {size} bytes")
+            if size <= max_size:
+                shutil.move(attempt, output)
+            return size
+
+        size = encode(width, fps)
+        if size is None:
+            return False
+        if size <= max_size:
+            return True
+
+        # The size grows with the number of pixels in each frame, so scale the width by the square root
+        low, high = min_width, width  # Widths known to fit are at least `low`, and `high` is known not to
+        fits = False
+        probe = int(width * math.sqrt(max_size / size) * 0.95)
+        min_size = None
+        for _ in range(PREVIEW_ATTEMPTS):
+            probe = max(low, min(probe, high - 1))
+            size = encode(probe, fps)
+            if size is None:
+                return False
+            if size <= max_size:
+                fits, low = True, probe
+            else:
+                high = probe
+                if probe == min_width:
+                    min_size = size
                     break
-            logger.debug(f"Cleared {url_count} local cache entries and {count} remote entries")
+            if high - low <= PREVIEW_WIDTH_STEP:
+                break
+            probe = (low + high) // 2
+        if fits:
+            return True
+
+        # Even the smallest width is too large, so drop frames instead
+        if min_size is None:
+            min_size = encode(min_width, fps)
+            if min_size is None:
+                return False
+            if min_size <= max_size:
+                return True
+        fps = max(1, int(fps * max_size / min_size * 0.95))
+        size = encode(min_width, fps)
+        return size is not None and size <= max_size
 
 
 def is_webp_animated(path: str):
@@ -390,134 +605,187 @@ def img_host_upload(
         img_mime_type: str,
         image_ext: str,
         host: str,
-        max_size: int = 0
+        max_size: int = 0,
+        gallery: str | None = None,
 ) -> str | None:
-    """Upload an image and return the URL, or None if there is an error. Optionally takes
-    a width, and scales the image down to that width if it is larger."""
-    logger.debug(f"Uploading image from {img_path}")
-
-    if max_size == 0:
-        match host:
-            case "hamster":
-                max_size = 10_000_000
-            case "imgbox":
-                max_size = 5_000_000
-            case _:
-                max_size = 5_000_000
+    """Upload an image and return the URL, or None if there is an error. Images larger than
+    `max_size` are scaled down until they fit."""
+    return img_host_upload_batch([(img_path, img_mime_type, image_ext)], host, max_size, gallery)[0][0]
+
+
+def img_host_upload_batch(
+        images: Sequence[tuple[str, str, str]],
+        host: str,
+        max_size: int = 0,
+        gallery: str | None = None,
+) -> list[tuple[str | None, str]]:
+    """
+    Upload several images at once, each given as its path, MIME type and extension. If
+    ``upload_failover`` is enabled, images are also uploaded to the other host when `host`
+    is slow or fails.
+    :param gallery: Images uploaded to imgbox with the same gallery key are added to the same gallery
+    :return: The URL of each image, or ``None`` if it failed to upload, and the host it was
+        uploaded to, in the same order as `images`
+    """
+    hosts = [host]
+    if conf.get("images", "upload_failover", True):
+        hosts += [other for other in HOST_MAX_SIZES if other != host]
+
+    temp_files = TempFiles()
+
+    def prepare(img_path: str, img_mime_type: str, image_ext: str, candidate: str) -> Callable[[], Upload | None]:
+        def run() -> Upload | None:
+            upload, paths = prepare_upload(img_path, img_mime_type, image_ext, candidate,
+                                           max_size or HOST_MAX_SIZES.get(candidate, 5_000_000))
+            temp_files.add(paths)
+            return upload
+        return run
+
+    # Each host's file is only prepared once that host is tried
+    candidates = [[(candidate, prepare(img_path, img_mime_type, image_ext, candidate)) for candidate in hosts]
+                  for img_path, img_mime_type, image_ext in images]
+    try:
+        results = uploader.upload(candidates, gallery)
+    finally:
+        temp_files.close()
+    return [(url, uploaded_host or host) for url, uploaded_host in results]
+
+
+class TempFiles:
+    """
+    Temporary files made while preparing uploads. Files added after it is closed, by preparation
+    that was no longer needed but still finished, are deleted straight away.
+    """
+
+    def __init__(self) -> None:
+        self.paths: list[str] = []
+        self.closed = False
+        self._lock = threading.Lock()
+
+    def add(self, paths: Sequence[str]) -> None:
+        with self._lock:
+            if not self.closed:
+                self.paths.extend(paths)
+                return
+        for path in paths:
+            delete_temp_file(path)
+
+    def close(self) -> None:
+        with self._lock:
+            self.closed = True
+            paths, self.paths = self.paths, []
+        for path in paths:
+            delete_temp_file(path)
 
+
+def prepare_upload(img_path: str, img_mime_type: str, image_ext: str, host: str,
+                   max_size: int) -> tuple[Upload | None, list[str]]:
+    """
+    Convert an image to a format and size accepted by the host.
+    :return: The image to upload, or ``None`` if it can't be uploaded, and the paths of
+        the temporary files that must be deleted after uploading
+    """
     # Return default image if unknown
     if image_ext == "unk":
-        return None
+        return None, []
 
+    temp_paths: list[str] = []
     # Convert animated webp to gif
     if img_mime_type == "image/webp" and host != "hamster":
-        if is_webp_animated(img_path):
-            with Image.open(img_path) as img:
-                img_path = img_path.strip(image_ext) + "gif"
-                img.save(img_path, save_all=True)
-            img_mime_type = "image/gif"
-            image_ext = "gif"
-        else:
-            with Image.open(img_path) as img:
-                img_path = img_path.strip(image_ext) + "png"
-                img.save(img_path)
-            img_mime_type = "image/png"
-            image_ext = "png"
+        animated = is_webp_animated(img_path)
+        img_mime_type, image_ext = ("image/gif", "gif") if animated else ("image/png", "png")
+        name = os.path.splitext(os.path.basename(img_path))[0]
+        fd, converted_path = tempfile.mkstemp(prefix=f"{name}-", suffix=f".{image_ext}")
+        temp_paths.append(converted_path)
+        with Image.open(img_path) as img, os.fdopen(fd, "wb") as f:
+            img.save(f, image_ext.upper(), save_all=animated)
+        img_path = converted_path
         logger.debug(f"Saved image as {img_path}")
 
-    # Quick and dirty resize for images above max filesize
     if os.path.getsize(img_path) > max_size:
         logger.debug("Resizing image")
-        CMD = ["ffmpeg", "-i", img_path, "-vf", "scale=iw:ih", "-y", img_path]
-        proc = subprocess.run(CMD, stderr=subprocess.PIPE, stdout=subprocess.STDOUT, text=True)
-        logger.debug(f"ffmpeg output:\n{proc.stdout}")
-        while os.path.getsize(img_path) > max_size:
-            with Image.open(img_path) as img:
-                img.thumbnail((int(img.width * 0.95), int(img.height * 0.95)), Image.LANCZOS)
-                img.save(img_path)
+        fitted = encode_to_fit(img_path, max_size)
+        if fitted is None:
+            return None, temp_paths
+        data, img_mime_type, image_ext = fitted
+        fd, fitted_path = tempfile.mkstemp(suffix=f"-fitted.{image_ext}")
+        temp_paths.append(fitted_path)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        img_path = fitted_path
         logger.debug(f"Resized {img_path}")
+    return Upload(img_path, img_mime_type, image_ext), temp_paths
 
-    match host:
-        case "hamster":
-            return hamster_upload(img_path, img_mime_type, image_ext)
-        case "imgbox":
-            return imgbox_upload(img_path)
-    return None
-
-
-def hamster_upload(
-        img_path: str,
-        img_mime_type: str,
-        image_ext: str,
-) -> str | None:
-    files = {
-        "source": (
-            str(uuid.uuid4()) + "." + image_ext,
-            open(img_path, "rb"),
-            img_mime_type,
-        )
-    }
-    request_body = {
-        "type": "file",
-        "action": "upload",
-        "nsfw": 1,
-        "format": "json",
-    }
-    headers = {
-        "accept": "application/json",
-        "X-API-Key": conf.get("hamster", "api_key", default=""),
-    }
-
-    if headers["X-API-Key"] == "":
-        logger.error("No API key provided for hamster.is Please go to https://hamster.is/settings/api to get one")
-        return None
 
-    url = "https://hamster.is/api/1/upload"
-    response = requests.post(url, files=files, data=request_body, headers=headers)
-    j = None
-    try:
-        j = response.json()
-        assert "error" not in j
-        url: str = j["image"]["url"]
-        return url
-    except AssertionError:
-        logger.error("Error uploading image: " + j["error"]["message"])
-    except JSONDecodeError:
-        logger.error("Error uploading image, invalid JSON in response")
-        logger.debug(f"Response: {response.text}")
+def encode_to_fit(img_path: str, max_size: int) -> Optional[tuple[bytes, str, str]]:
+    """
+    Encodes an image in memory so that it is no larger than `max_size` bytes.
+    Animated images are saved as GIF, images with transparency as PNG, and
+    all others as JPEG. JPEG quality is lowered step by step before the image
+    is scaled down. The bytes per pixel of recent images that fit at each
+    quality are used to pick the first quality and scale to try, and each
+    further scaling is based on the size of the previous attempt.
+    :return: The encoded image, its MIME type, and its extension, or ``None`` if it could not be made small enough
+    """
+    with Image.open(img_path) as img:
+        if getattr(img, "n_frames", 1) > 1:
+            fmt, mime_type, ext, qualities = "GIF", "image/gif", "gif", (None,)
+            frames = [frame.convert("RGBA") for frame in ImageSequence.Iterator(img)]
+            durations = [frame.info.get("duration", img.info.get("duration", 100)) for frame in
+                         ImageSequence.Iterator(img)]
+            loop = img.info.get("loop", 0)
+        else:
+            img.load()
+            if img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info:
+                fmt, mime_type, ext, qualities = "PNG", "image/png", "png", (None,)
+                frames = [img.convert("RGBA")]
+            else:
+                fmt, mime_type, ext, qualities = "JPEG", "image/jpeg", "jpg", FIT_JPEG_QUALITIES
+                frames = [img.convert("RGB")]
+
+    width, height = frames[0].size
+    pixels = width * height
+    budget = max_size * FIT_MARGIN
+    # Start at the best quality expected to fit at full size, or scale down at the lowest quality if none is
+    level, scale = len(qualities) - 1, 1.0
+    for i, quality in enumerate(qualities):
+        hint = fit_hints.get((fmt, quality))
+        if hint is None or hint * pixels <= budget:
+            level = i
+            break
+    else:
+        scale = min(1.0, math.sqrt(budget / (fit_hints[(fmt, qualities[-1])] * pixels)))
+
+    for _ in range(FIT_ATTEMPTS):
+        quality = qualities[level]
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        renditions = frames if scale >= 1 else [frame.resize(size, Image.LANCZOS) for frame in frames]
+        buffer = io.BytesIO()
+        if fmt == "GIF":
+            renditions[0].save(buffer, fmt, save_all=True, append_images=renditions[1:], duration=durations,
+                               loop=loop, disposal=2)
+        elif fmt == "PNG":
+            renditions[0].save(buffer, fmt, optimize=True)
+        else:
+            renditions[0].save(buffer, fmt, quality=quality)
+        data = buffer.getvalue()
+        logger.debug(f"Encoded image as {fmt}{f' q{quality}' if quality else ''} at {size[0]}x{size[1]} "
+                     f"in {len(data)} bytes")
+        if len(data) <= max_size:
+            # Average with earlier images so that a single unusual image doesn't throw off the next guess
+            bpp = len(data) / (size[0] * size[1])
+            previous = fit_hints.get((fmt, quality))
+            fit_hints[(fmt, quality)] = bpp if previous is None else (previous + bpp) / 2
+            return data, mime_type, ext
+        if level < len(qualities) - 1:
+            level += 1
+        else:
+            # The encoded size is roughly proportional to the number of pixels
+            scale *= min(0.95, math.sqrt(budget / len(data)))
+    logger.error(f"Unable to encode {img_path} in under {max_size} bytes")
     return None
 
 
-def imgbox_upload(
-        img_path: str):
-    async def upload(path: str):
-        async with pyimgbox.Gallery(adult=True) as gallery:
-            submission: pyimgbox.Submission = await gallery.upload(path)
-            logger.debug(f"imgbox submission: {submission}")
-            return submission["image_url"]
-
-    return asyncio.run(upload(img_path))
-
-
-def generate_screen(path: str, seek: str) -> str:
-    screen_file = tempfile.mkstemp(suffix="-screen.jpg")
-    cmd = [
-        "ffmpeg",
-        "-v",
-        "error",
-        "-y",
-        "-ss",
-        seek,
-        "-i",
-        path,
-        "-frames:v",
-        "1",
-        screen_file[1],
-    ]
-    subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-    return screen_file[1]
-
-
 def getDigest(path: str) -> str:
     with open(path, "rb") as f:
         return hashlib.file_digest(f, hashlib.md5).hexdigest()
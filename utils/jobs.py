@@ -0,0 +1,212 @@
+"""This module provides the objects used to run generation jobs in the
+background, stream their progress to any number of readers, and keep
+track of them until their results expire."""
+
+import contextvars
+import json
+import subprocess
+import threading
+import time
+import uuid
+from collections.abc import Callable, Generator
+from concurrent.futures import Future
+from typing import Any, Literal
+
+from loguru import logger
+
+JobState = Literal["queued", "running", "done", "failed", "cancelled"]
+FINISHED_STATES: tuple[JobState, ...] = ("done", "failed", "cancelled")
+
+# The job whose stage is running in the current thread, used to track child processes
+current_job: contextvars.ContextVar["Job | None"] = contextvars.ContextVar("current_job", default=None)
+
+
+class JobCancelled(Exception):
+    """Raised when a job is cancelled while it is running."""
+
+
+class Job:
+    """A single generation job. Messages published by the worker are kept until
+    the job is evicted so that readers can attach, detach and re-attach
+    without losing any progress updates."""
+
+    def __init__(self, data: dict[str, Any], job_id: str | None = None) -> None:
+        self.id: str = job_id if job_id is not None else uuid.uuid4().hex
+        self.data = data
+        self.state: JobState = "queued"
+        self.created: float = time.time()
+        self.finished: float | None = None
+        self.messages: list[str] = []
+        self.result: dict[str, Any] | None = None
+        self.future: Future | None = None
+        self.cancel_event = threading.Event()
+        self._processes: set[subprocess.Popen] = set()
+        self._condition = threading.Condition()
+
+    @property
+    def done(self) -> bool:
+        return self.state in FINISHED_STATES
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_event.is_set()
+
+    def publish(self, message: str) -> None:
+        with self._condition:
+            self.messages.append(message)
+            self._condition.notify_all()
+
+    def start(self) -> None:
+        with self._condition:
+            self.state = "running"
+
+    def finish(self, state: JobState) -> None:
+        with self._condition:
+            self.state = state
+            self.finished = time.time()
+            self._condition.notify_all()
+
+    def cancel(self) -> bool:
+        """
+        Cancel the job. A queued job never starts, and a running job stops
+        scheduling stages and has its child processes killed.
+        :return: `False` if the job had already finished
+        """
+        if self.done:
+            return False
+        self.cancel_event.set()
+        if self.future is not None and self.future.cancel():
+            self.publish(json.dumps({"status": "error", "message": "Job cancelled"}) + '\n')
+            self.finish("cancelled")
+        with self._condition:
+            processes = list(self._processes)
+        for process in processes:
+            logger.debug(f"Killing process {process.pid} for job {self.id}")
+            process.kill()
+        return True
+
+    def track(self, process: subprocess.Popen) -> None:
+        with self._condition:
+            self._processes.add(process)
+        if self.cancelled:
+            process.kill()
+
+    def untrack(self, process: subprocess.Popen) -> None:
+        with self._condition:
+            self._processes.discard(process)
+
+    def status(self) -> dict[str, Any]:
+        status = {
+            "id": self.id,
+            "state": self.state,
+            "scene_id": self.data.get("scene_id"),
+            "created": self.created,
+            "finished": self.finished,
+            "message": None,
+        }
+        if self.messages:
+            # Only report the text of the latest message since the full result is included separately
+            last = json.loads(self.messages[-1])
+            status["message"] = last["data"]["message"] if last["status"] == "success" else last["message"]
+        if self.result is not None:
+            status["result"] = self.result
+        return status
+
+    def stream(self, start: int = 0) -> Generator[str, None, None]:
+        """
+        Yield every message published by the job, starting from `start`, and
+        block until new messages arrive or the job finishes.
+        :param start: The index of the first message to return
+        """
+        index = start
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: index < len(self.messages) or self.done)
+                pending = self.messages[index:]
+                finished = self.done
+            index += len(pending)
+            yield from pending
+            if finished and index >= len(self.messages):
+                return
+
+
+class JobStore:
+    """Keeps track of jobs by ID. Finished jobs are evicted once they are older
+    than `ttl` seconds, or when more than `max_finished` have accumulated."""
+
+    def __init__(self, ttl: int = 3600, max_finished: int = 100) -> None:
+        self.ttl = ttl
+        self.max_finished = max_finished
+        self._jobs: dict[str, Job] = {}
+        self._lock = threading.Lock()
+
+    def add(self, job: Job) -> None:
+        with self._lock:
+            self._evict()
+            self._jobs[job.id] = job
+
+    def get(self, job_id: str) -> Job | None:
+        with self._lock:
+            self._evict()
+            return self._jobs.get(str(job_id))
+
+    def cancel(self, job_id: str) -> bool:
+        job = self.get(job_id)
+        return job is not None and job.cancel()
+
+    def all(self) -> list[Job]:
+        with self._lock:
+            self._evict()
+            return list(self._jobs.values())
+
+    def _evict(self) -> None:
+        now = time.time()
+        finished = sorted((j for j in self._jobs.values() if j.finished is not None), key=lambda j: j.finished)
+        excess = len(finished) - self.max_finished
+        for i, job in enumerate(finished):
+            if i < excess or now - job.finished > self.ttl:  # type: ignore
+                logger.debug(f"Evicting job {job.id}")
+                del self._jobs[job.id]
+
+    def __len__(self) -> int:
+        return len(self._jobs)
+
+
+def run(cmd: list[str], check: bool = False, **kwargs) -> subprocess.CompletedProcess:
+    """
+    Equivalent to `subprocess.run`, except that the process is killed if the
+    job that started it is cancelled.
+    """
+    job = current_job.get()
+    with subprocess.Popen(cmd, **kwargs) as process:
+        if job is not None:
+            job.track(process)
+        try:
+            stdout, stderr = process.communicate()
+        except:
+            process.kill()
+            raise
+        finally:
+            if job is not None:
+                job.untrack(process)
+        retcode = process.poll()
+    if job is not None and job.cancelled:
+        raise JobCancelled()
+    if check and retcode:
+        raise subprocess.CalledProcessError(retcode, process.args, output=stdout, stderr=stderr)
+    return subprocess.CompletedProcess(process.args, retcode, stdout, stderr)
+
+
+def check_output(cmd: list[str], **kwargs) -> Any:
+    """Equivalent to `subprocess.check_output` for processes belonging to a job."""
+    return run(cmd, check=True, stdout=subprocess.PIPE, **kwargs).stdout
+
+
+def in_context(func: Callable[..., Any]) -> Callable[..., Any]:
+    """Wrap `func` so that it runs with a copy of the caller's context in any thread."""
+    context = contextvars.copy_context()
+
+    def wrapper(*args, **kwargs) -> Any:
+        return context.copy().run(func, *args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,80 @@
+"""This module keeps the database in shape in the background. Every so often
+the least recently used piece hashes beyond a limit are deleted, the query
+planner statistics are updated, and the database file is vacuumed if enough
+of it has become unused space. The time of the last run is saved in the
+database, so restarting does not make it run any sooner."""
+
+import threading
+import time
+
+from flask import Flask
+from loguru import logger
+
+from utils.confighandler import ConfigHandler
+from utils.db import PieceHashCache, analyze, database_stats, db, get_setting, set_setting, vacuum
+
+MAINTENANCE_KEY = "last_maintenance"
+# Databases smaller than this are never vacuumed, whatever their fragmentation
+MIN_VACUUM_SIZE = 1024 * 1024
+# Maximum number of files whose piece hashes are kept for making torrents again
+MAX_PIECE_HASHES = 10_000
+
+conf = ConfigHandler()
+
+
+class DatabaseMaintenance:
+    app: Flask | None = None
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+
+    def setup(self, app: Flask) -> None:
+        """Run maintenance in the background every `database.maintenance_interval` seconds."""
+        self.app = app
+        threading.Thread(target=self._schedule, name="maintenance", daemon=True).start()
+
+    def run(self) -> bool:
+        """
+        Evict old piece hashes, update the query planner statistics, and vacuum the database if it is
+        fragmented enough.
+        Requires an app context.
+        :return: Whether the database was vacuumed
+        """
+        with self._lock:
+            evicted = PieceHashCache.evict(MAX_PIECE_HASHES)
+            db.session.commit()
+            if evicted:
+                logger.debug(f"Evicted {evicted} piece hash entries")
+            analyze()
+            size, free = database_stats()
+            threshold: int = conf.get("database", "vacuum_threshold", 20)  # type: ignore
+            vacuumed = size >= MIN_VACUUM_SIZE and free * 100 >= threshold
+            if vacuumed:
+                logger.info(f"Vacuuming database ({size / 1024 / 1024:.1f} MB, {free:.0%} unused)")
+                vacuum()
+                logger.debug(f"Database is now {database_stats()[0] / 1024 / 1024:.1f} MB")
+            set_setting(MAINTENANCE_KEY, str(time.time()))
+            db.session.commit()
+        return vacuumed
+
+    def _schedule(self) -> None:
+        assert self.app is not None
+        while True:
+            interval: int = conf.get("database", "maintenance_interval", 86400)  # type: ignore
+            with self.app.app_context():
+                last = float(get_setting(MAINTENANCE_KEY) or 0)
+            delay = last + interval - time.time()
+            if delay > 0:
+                # Check again at least hourly so that a shorter interval set in the meantime takes effect
+                time.sleep(min(delay, 3600))
+                continue
+            try:
+                with self.app.app_context():
+                    self.run()
+            except Exception as e:
+                logger.error("Database maintenance failed")
+                logger.debug(e)
+                time.sleep(interval)
+
+
+maintenance = DatabaseMaintenance()
@@ -1,7 +1,7 @@
 import re
 from typing import Optional, Literal, Annotated, TypeAlias
 
-from pydantic import BaseModel, Field, model_validator, BeforeValidator, AfterValidator, PositiveInt
+from pydantic import BaseModel, Field, model_validator, BeforeValidator, AfterValidator, PositiveFloat, PositiveInt
 
 
 def not_empty(s: str) -> str:
@@ -32,12 +32,21 @@ class BackendConfig(BaseModel):
     log_level: LogLevel = "INFO"
     save_images: Optional[str] = None
     sanitize_logs: bool = True
+    job_ttl: PositiveInt = 3600
+    max_jobs: PositiveInt = 4
+    cpu_stages: PositiveInt = 2
+    io_stages: PositiveInt = 2
+    network_stages: PositiveInt = 8
+    torrent_scan_interval: PositiveInt = 60
 
 class ImageConfig(BaseModel):
     use_preview: bool = False
     animated_cover: bool = True
     widthcontact_sheet_layout: Annotated[str, AfterValidator(validate_layout_str)] = "3x6"
     num_screens: PositiveInt
+    contact_sheet_sprites: bool = False
+    upload_failover: bool = True
+    hedge_delay: Optional[PositiveFloat] = None
 
 class HamsterConfig(BaseModel):
     api_key: ApiKey
@@ -75,6 +84,10 @@ class RedisConfig(BaseModel):
     password: Optional[str] = None
     ssl: bool = False
 
+class DatabaseConfig(BaseModel):
+    maintenance_interval: PositiveInt = 86400
+    vacuum_threshold: Annotated[int, Field(ge=0), Field(le=100)] = 20
+
 class MetadataConfig(BaseModel):
     tag_codec: bool = False
     tag_date: bool = False
@@ -99,6 +112,7 @@ class Config(BaseModel):
     deluge: Optional[DelugeConfig] = None
     transmission: Optional[TransmissionConfig] = None
     redis: Optional[RedisConfig] = None
+    database: DatabaseConfig = DatabaseConfig()
     metadata: MetadataConfig
     performers: PerformersConfig
     templates: dict[str, str]
@@ -0,0 +1,159 @@
+"""This module provides a scheduler for running the stages of a generation
+job. Each stage declares the values it needs and the values it produces,
+and is started as soon as all of its inputs are available."""
+
+import contextvars
+import inspect
+import threading
+from collections.abc import Callable
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Any, Literal
+
+from flask import Flask
+from loguru import logger
+
+from utils.jobs import JobCancelled
+
+Resource = Literal["cpu", "io", "network"]
+
+stage_pool = ThreadPoolExecutor(max_workers=32, thread_name_prefix="stage")
+
+# Limits on how many stages of each type may run at once across all jobs
+DEFAULT_LIMITS: dict[Resource, int] = {"cpu": 2, "io": 2, "network": 8}
+resource_limits: dict[Resource, threading.BoundedSemaphore] = {
+    resource: threading.BoundedSemaphore(limit) for resource, limit in DEFAULT_LIMITS.items()
+}
+
+
+def set_resource_limit(resource: Resource, limit: int) -> None:
+    resource_limits[resource] = threading.BoundedSemaphore(limit)
+
+
+class StageError(Exception):
+    """Raised by a stage to stop the pipeline and report a message to the user."""
+
+    def __init__(self, message: str, alt_message: str | None = None) -> None:
+        super().__init__(message)
+        self.message = message
+        self.alt_message = alt_message
+
+
+@dataclass
+class Stage:
+    """
+    A single step of a pipeline. The inputs of a stage are the names of the
+    parameters of `func`, and `func` must return a dict containing every name
+    listed in `outputs`. The outputs of stages marked with `persist` must be
+    JSON serializable so that they can be saved and reused if the job is resumed.
+    """
+    func: Callable[..., dict[str, Any]]
+    outputs: tuple[str, ...] = ()
+    resource: Resource = "cpu"
+    persist: bool = False
+    name: str = ""
+    inputs: tuple[str, ...] = field(init=False)
+
+    def __post_init__(self) -> None:
+        if not self.name:
+            self.name = self.func.__name__
+        self.inputs = tuple(inspect.signature(self.func).parameters)
+
+
+class Pipeline:
+    def __init__(self, stages: list[Stage], app: Flask | None = None) -> None:
+        self.stages = stages
+        self.app = app
+        producers: dict[str, str] = {}
+        for stage in stages:
+            for output in stage.outputs:
+                if output in producers:
+                    raise ValueError(f"'{output}' is produced by both {producers[output]} and {stage.name}")
+                producers[output] = stage.name
+
+    def run(self, values: dict[str, Any], cancel_event: threading.Event | None = None,
+            targets: tuple[str, ...] | None = None,
+            on_stage_done: Callable[[Stage, dict[str, Any]], None] | None = None) -> dict[str, Any]:
+        """
+        Run every stage once, starting each one as soon as its inputs are ready.
+        Stages whose outputs are all present in `values` are skipped.
+        :param values: The initial values available to all stages
+        :param cancel_event: When set, no further stages are started
+        :param targets: If given, only run the stages needed to produce these values
+        :param on_stage_done: Called with each stage and its outputs when it finishes
+        :raises StageError: If any stage fails. Stages that have not started yet are skipped, and
+            the ones that are running are waited for, so that no stage outlives the pipeline.
+        :raises JobCancelled: If `cancel_event` is set before all stages have finished
+        :return: All initial values and stage outputs
+        """
+        values = dict(values)
+        pending = [s for s in self.stages if not s.outputs or any(o not in values for o in s.outputs)]
+        if targets is not None:
+            pending = self._needed(pending, set(targets) - values.keys())
+        running: dict[Future, Stage] = {}
+        # Set when the pipeline stops early, so that stages still waiting for a resource don't start
+        stop = threading.Event()
+        try:
+            while pending or running:
+                if cancel_event is not None and cancel_event.is_set():
+                    raise JobCancelled()
+                for stage in [s for s in pending if all(i in values for i in s.inputs)]:
+                    pending.remove(stage)
+                    kwargs = {i: values[i] for i in stage.inputs}
+                    logger.debug(f"Starting stage {stage.name}")
+                    # Each stage gets its own copy of the context so it knows which job it belongs to
+                    context = contextvars.copy_context()
+                    running[stage_pool.submit(context.run, self._call, stage, kwargs, stop)] = stage
+                if not running:
+                    missing = {i for s in pending for i in s.inputs if i not in values}
+                    raise ValueError(f"Stages {[s.name for s in pending]} are waiting for {missing}")
+                done, _ = wait(running, timeout=0.5, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    outputs = future.result()
+                    missing = [o for o in stage.outputs if o not in outputs]
+                    if missing:
+                        raise ValueError(f"Stage {stage.name} did not produce {missing}")
+                    logger.debug(f"Finished stage {stage.name}")
+                    values.update(outputs)
+                    if on_stage_done is not None:
+                        on_stage_done(stage, outputs)
+        except BaseException:
+            self._stop(running, stop)
+            raise
+        return values
+
+    @staticmethod
+    def _stop(running: dict[Future, Stage], stop: threading.Event) -> None:
+        """Skip the stages that have not started, and wait for the ones that are running to finish."""
+        stop.set()
+        for future in running:
+            future.cancel()
+        if running:
+            logger.debug(f"Waiting for stages {[s.name for s in running.values()]} to finish")
+            wait(running)
+
+    @staticmethod
+    def _needed(stages: list[Stage], wanted: set[str]) -> list[Stage]:
+        """Return the stages that contribute to producing `wanted`, directly or through their inputs."""
+        needed: list[Stage] = []
+        remaining = list(stages)
+        changed = True
+        while changed:
+            changed = False
+            for stage in list(remaining):
+                if wanted.intersection(stage.outputs):
+                    remaining.remove(stage)
+                    needed.append(stage)
+                    wanted.update(stage.inputs)
+                    changed = True
+        return [s for s in stages if s in needed]
+
+    def _call(self, stage: Stage, kwargs: dict[str, Any], stop: threading.Event) -> dict[str, Any]:
+        with resource_limits[stage.resource]:
+            if stop.is_set():
+                raise JobCancelled()
+            if self.app is None:
+                return stage.func(**kwargs)
+            with self.app.app_context():
+                return stage.func(**kwargs)
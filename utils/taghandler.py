@@ -1,20 +1,25 @@
 """This module provides an object for storing and processing stash scene tags
 for uploading to empornium."""
 
+import hashlib
 import json
 from loguru import logger
 import os
 import re
+import threading
+import tomllib
+from collections import defaultdict
 from collections.abc import MutableMapping
+from dataclasses import dataclass, field
 from typing import Literal
 
-import tomlkit
 from flask import Flask
 from tomlkit.items import AbstractTable
 
 from utils.confighandler import ConfigHandler
 from utils.customtypes import CaseInsensitiveDict
-from utils.db import db, StashTag, GazelleTag, get_or_create, get_or_create_no_commit, Category
+from utils.db import (db, StashTag, GazelleTag, get_or_create_no_commit, Category, TagMapping, list_tags, TRACKERS,
+                      DEFAULT_TRACKER, TAG_SEED_KEY, get_setting, set_setting)
 
 HAIR_COLOR_MAP = CaseInsensitiveDict(
     {
@@ -43,6 +48,113 @@ ETHNICITY_MAP = CaseInsensitiveDict(
 
 DEMONYMS: dict[str, list[str]] = {}
 
+COUNTRIES_FILE = "countries.json"
+# Compact copy of the demonyms in COUNTRIES_FILE, kept in the config directory
+DEMONYMS_FILE = "demonyms.json"
+
+_country_demonyms: dict[str, dict[str, str]] | None = None
+_country_lock = threading.Lock()
+
+
+def country_demonyms() -> dict[str, dict[str, str]]:
+    """The male and female English demonym tags of each country, keyed by cca2.
+    Loaded once, from a small cached copy if `COUNTRIES_FILE` has not changed since it was made."""
+    global _country_demonyms
+    with _country_lock:
+        if _country_demonyms is None:
+            _country_demonyms = _load_demonyms()
+        return _country_demonyms
+
+
+def _load_demonyms() -> dict[str, dict[str, str]]:
+    if not os.path.exists(COUNTRIES_FILE):
+        logger.warning(f"{COUNTRIES_FILE} not found, performer nationalities will not be tagged")
+        return {}
+    stat = os.stat(COUNTRIES_FILE)
+    source = [stat.st_size, stat.st_mtime_ns]
+    cache = os.path.join(ConfigHandler().config_dir, DEMONYMS_FILE)
+    try:
+        with open(cache) as f:
+            cached = json.load(f)
+        if cached["source"] == source:
+            return cached["demonyms"]
+    except (OSError, ValueError, KeyError):
+        pass
+    with open(COUNTRIES_FILE) as f:
+        countries = json.load(f)
+    demonyms = {}
+    for country in countries:
+        eng = country.get("demonyms", {}).get("eng")
+        if eng:
+            demonyms[country["cca2"]] = {g: empify(eng[g]) for g in ("m", "f")}
+    try:
+        with open(cache, "w") as f:
+            json.dump({"source": source, "demonyms": demonyms}, f)
+    except OSError as e:
+        logger.debug(f"Unable to save {cache}: {e}")
+    logger.debug(f"Loaded demonyms of {len(demonyms)} countries from {COUNTRIES_FILE}")
+    return demonyms
+
+
+@dataclass(frozen=True)
+class TagEntry:
+    """The mapping of a single stash tag."""
+    ignored: bool = False
+    display: str | None = None
+    defaults: tuple[str, ...] = ()
+    trackers: dict[str, tuple[str, ...]] = field(default_factory=dict)
+    categories: tuple[str, ...] = ()
+
+    def gazelle_tags(self, tracker: str) -> tuple[str, ...]:
+        """The tags to use on a tracker, falling back to the default tags."""
+        return self.trackers.get(tracker) or self.defaults
+
+
+@dataclass(frozen=True)
+class TagIndex:
+    """Every tag mapping, keyed by the lowercased stash tag name. Never modified once built,
+    so that jobs can keep using the index they started with while a new one is loaded."""
+    tags: dict[str, TagEntry] = field(default_factory=dict)
+    categories: tuple[str, ...] = ()
+
+    def get(self, tag: str) -> TagEntry | None:
+        return self.tags.get(tag.lower())
+
+
+tag_index = TagIndex()
+
+
+def build_index() -> TagIndex:
+    """Load every tag mapping from the database with one query per table. Requires an app context."""
+    mappings: dict[int, dict[str, list[str]]] = defaultdict(dict)
+    for stash_id, tracker, tagname in db.session.execute(
+            db.select(TagMapping.stashtag_id, TagMapping.tracker, GazelleTag.tagname).join(TagMapping.gazelle_tag)):
+        mappings[stash_id].setdefault(tracker, []).append(tagname)
+    category_names = dict(db.session.execute(db.select(Category.id, Category.name)).all())
+    categories: dict[int, list[str]] = defaultdict(list)
+    for stash_id, category_id in db.session.execute(db.select(*list_tags.c)):
+        categories[stash_id].append(category_names[category_id])
+
+    tags = {}
+    for stash_id, tagname, display, ignored in db.session.execute(
+            db.select(StashTag.id, StashTag.tagname, StashTag.display, StashTag.ignored)).all():
+        trackers = {tracker: tuple(names) for tracker, names in mappings.get(stash_id, {}).items()}
+        tags[tagname.lower()] = TagEntry(
+            ignored=bool(ignored),
+            display=display,
+            defaults=trackers.pop(DEFAULT_TRACKER, ()),
+            trackers=trackers,
+            categories=tuple(categories.get(stash_id, ())),
+        )
+    return TagIndex(tags, tuple(category_names.values()))
+
+
+def reload_index() -> None:
+    """Rebuild the tag index after the mappings in the database have changed. Requires an app context."""
+    global tag_index
+    tag_index = build_index()
+    logger.debug(f"Loaded {len(tag_index.tags)} tag mappings")
+
 
 def empify(tag: str) -> str:
     """Return an EMP-compatible tag for a given input
@@ -62,11 +174,26 @@ def query_maps(page=1, per_page=50):
     return StashTag.query.paginate(page=page, per_page=per_page)
 
 
+def cup_size_value(measurements: str) -> tuple[str, int]:
+    """Return the cup size in a performer's measurements, and a value that
+    orders cup sizes, or -1 if the cup size is missing or invalid."""
+    cup_size = re.sub(r"[^A-Z]", "", measurements.upper())
+    if cup_size == "":
+        logger.error(f"No cup size found in {measurements}")
+        return cup_size, -1
+    if len(cup_size) > 1:
+        letter = cup_size[0]
+        if cup_size != len(cup_size) * letter or (letter != "A" and letter != "D"):
+            logger.error(f"Invalid cup size {cup_size}")
+            return cup_size, -1
+        if letter == "A":
+            return cup_size, 0
+        return cup_size, len(cup_size) + 3  # DD->5, DDD->6, etc
+    return cup_size, ord(cup_size) - 64  # A->1, B->2, C->3, etc
+
+
 class TagHandler:
     conf: ConfigHandler
-    tag_sets: dict[str, set] = {}
-    countries = []
-    cup_sizes: dict[str, tuple[int, Literal[-1, 0, 1]]] = {}
 
     def __init__(self) -> None:
         """Initialize a TagHandler object from a config object."""
@@ -76,9 +203,14 @@ class TagHandler:
         # Dict of autogenerated tag suggestions
         self.tag_suggestions: CaseInsensitiveDict[str] = CaseInsensitiveDict()
 
+        # Keep using the same mappings for the whole scene even if they are reloaded in the meantime
+        self.index: TagIndex = tag_index
+
+        # Each handler has its own lists, since several scenes can be processed at once
+        self.tag_sets: dict[str, set[str]] = {name: set() for name in self.index.categories}
+        self.cup_sizes: dict[str, tuple[int, Literal[-1, 0, 1]]] = {}
+
         self.conf: ConfigHandler = ConfigHandler()  # type: ignore
-        for key in Category.query.all():
-            self.tag_sets[key.name] = set()
 
         if "performers" in self.conf:
             t = self.conf["performers"]
@@ -94,11 +226,7 @@ class TagHandler:
                                 op = -1
                             elif '+' in size or '>' in size:
                                 op = 1
-                            size = self.process_tits(size)
-                            self.cup_sizes[tag] = (size, op)
-
-        with open("countries.json") as c:
-            self.countries = json.load(c)
+                            self.cup_sizes[tag] = (cup_size_value(size)[1], op)
 
     def sort_tag_list(self, tagset: str) -> list[str]:
         """Return a sorted list for a given
@@ -122,33 +250,21 @@ class TagHandler:
         mapping for a provided tag and add it to
         the working lists, or generate a suggested
         mapping."""
-        s_tag: StashTag
-        s_tag = get_or_create(StashTag, tagname=tag)
-        if s_tag.ignored:
+        if tracker not in TRACKERS:
+            raise ValueError(f"Tracker must be one of {list(TRACKERS)}")
+        entry = self.index.get(tag)
+        if entry is None:
+            self.tag_suggestions[tag] = empify(tag)
             return
-        tag_list: list[GazelleTag]
-        match tracker:
-            case "EMP":
-                tag_list = s_tag.emp_tags
-            case "PB":
-                tag_list = s_tag.pb_tags
-            case "FC":
-                tag_list = s_tag.fc_tags
-            case "HF":
-                tag_list = s_tag.hf_tags
-            case "ENT":
-                tag_list = s_tag.ent_tags
-            case _:
-                raise ValueError('Tracker must be one of ["EMP", "PB", "FC", "HF", "ENT"]')
-        if len(tag_list) == 0:
-            tag_list = s_tag.def_tags
+        if entry.ignored:
+            return
+        tag_list = entry.gazelle_tags(tracker)
         if len(tag_list) == 0:
             self.tag_suggestions[tag] = empify(tag)
         else:
-            for e_tag in tag_list:
-                self.tags.add(e_tag.tagname)
-        for cat in s_tag.categories:
-            self.tag_sets[cat.name].add(s_tag.display if s_tag.display else tag)
+            self.tags.update(tag_list)
+        for cat in entry.categories:
+            self.tag_sets.setdefault(cat, set()).add(entry.display if entry.display else tag)
 
     def process_performer(self, performer: dict, tracker: str) -> str:
         # also include alias tags?
@@ -158,13 +274,13 @@ class TagHandler:
         gender = performer["gender"] if performer["gender"] else "FEMALE"  # Should this default be configurable?
         for tag in performer["tags"]:
             self.process_tag(tag["name"], tracker)
-        if len(self.countries) > 0:
+        demonyms = country_demonyms()
+        if len(demonyms) > 0:
             cca2 = performer["country"]
             g = "m" if (gender == "MALE" or gender == "TRANSGENDER_MALE") else "f"
             if len(cca2) > 0:
-                for country in self.countries:
-                    if country["cca2"] == cca2:
-                        self.tags.add(empify(country["demonyms"]["eng"][g]))
+                if cca2 in demonyms:
+                    self.tags.add(demonyms[cca2][g])
                 if cca2 in DEMONYMS:
                     logger.debug(f"Found demonyms {DEMONYMS[cca2]} for performer {performer['name']}")
                     self.tags.update(DEMONYMS[cca2])
@@ -218,20 +334,10 @@ class TagHandler:
 
     def process_tits(self, measurements: str, fake_tits: str = "") -> int:
         # TODO process size/type combo tags, e.g. big.natural.tits
-        cup_size = re.sub(r"[^A-Z]", "", measurements.upper())
-        if cup_size == "":
-            logger.error(f"No cup size found in {measurements}")
-            return -1
-        self.add(f"{cup_size}.cup")
-        if len(cup_size) > 1:
-            letter = cup_size[0]
-            if cup_size != len(cup_size) * letter or (letter != "A" and letter != "D"):
-                logger.error(f"Invalid cup size {cup_size}")
-                return -1
-            if letter == "A":
-                return 0
-            return len(cup_size) + 3  # DD->5, DDD->6, etc
-        return ord(cup_size) - 64  # A->1, B->2, C->3, etc
+        cup_size, value = cup_size_value(measurements)
+        if cup_size != "":
+            self.add(f"{cup_size}.cup")
+        return value
 
     def add(self, tag: str) -> str:
         """Convert a tag to en EMP-compatible
@@ -253,39 +359,79 @@ class TagHandler:
 
 
 def db_init(app: Flask, tag_map: MutableMapping, tag_lists):
-    logger.info("Updating db")
+    """Add the mappings, categories and ignored tags from the tag config to the database,
+    unless the same config was already added before."""
+    config = {
+        "tags": {st: str(et) for st, et in tag_map.items()},
+        "lists": {lst: [str(tag) for tag in tags] for lst, tags in tag_lists.items()},
+    }
+    digest = hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()
     with app.app_context():
-        cats: dict[str, Category] = {}
-        for cat in tag_lists:
-            if cat == "ignored_tags":
-                continue
-            cats[cat] = get_or_create(Category, name=cat)
-        for st, et in tag_map.items():
-            s_tag = get_or_create(StashTag, tagname=st)
-            for tag in str(et).split():
-                e_tag = get_or_create(GazelleTag, tagname=tag)
-                if e_tag not in s_tag.def_tags:
-                    s_tag.def_tags.append(e_tag)
-            for cat, cat_obj in cats.items():
-                if st in tag_lists[cat] or st.lower() in tag_lists[cat]:
-                    if cat_obj not in s_tag.categories:
-                        s_tag.categories.append(cat_obj)
-        for st in tag_lists["ignored_tags"]:
-            s_tag = get_or_create(StashTag, tagname=st)
-            s_tag.ignored = True
-        db.session.commit()
-        logger.info("Updated db")
+        if get_setting(TAG_SEED_KEY) == digest:
+            logger.debug("Tag config unchanged, skipping db update")
+        else:
+            logger.info("Updating db")
+            seed_tags(config["tags"], config["lists"])
+            set_setting(TAG_SEED_KEY, digest)
+            db.session.commit()
+            logger.info("Updated db")
+        reload_index()
+
+
+def seed_tags(tag_map: dict[str, str], tag_lists: dict[str, list[str]]) -> None:
+    """Insert whatever is missing from the database in bulk. Existing mappings are never removed,
+    so changes made through the web UI are kept. Does not commit."""
+    ignored = tag_lists.get("ignored_tags", [])
+    lists = {lst: set(tags) for lst, tags in tag_lists.items() if lst != "ignored_tags"}
+    # Stash tags are case-insensitive in the database
+    stash_ids = _ensure_names(StashTag.tagname, [*tag_map, *ignored], str.lower)
+    gazelle_ids = _ensure_names(GazelleTag.tagname, [tag for et in tag_map.values() for tag in et.split()])
+    category_ids = _ensure_names(Category.name, list(lists))
+
+    defaults = {(stash_ids[st.lower()], DEFAULT_TRACKER, gazelle_ids[tag])
+                for st, et in tag_map.items() for tag in et.split()}
+    categories = {(stash_ids[st.lower()], category_ids[cat])
+                  for cat, tags in lists.items() for st in tag_map if st in tags or st.lower() in tags}
+    _insert_missing(TagMapping.__table__, defaults)
+    _insert_missing(list_tags, categories)
+    if ignored:
+        ignored_ids = {stash_ids[st.lower()] for st in ignored}
+        db.session.execute(db.update(StashTag).where(StashTag.id.in_(ignored_ids)).values(ignored=True))
+
+
+def _ensure_names(column, names: list[str], key=lambda name: name) -> dict[str, int]:
+    """Insert the names missing from a unique column, and return the id of every row keyed by `key` of its name."""
+    model = column.class_
+    ids = {key(name): row_id for row_id, name in db.session.execute(db.select(model.id, column)).all()}
+    missing: dict[str, str] = {}
+    for name in names:
+        if key(name) not in ids:
+            missing.setdefault(key(name), name)
+    if missing:
+        db.session.execute(db.insert(model), [{column.key: name} for name in missing.values()])
+        ids = {key(name): row_id for row_id, name in db.session.execute(db.select(model.id, column)).all()}
+    return ids
+
+
+def _insert_missing(table, rows: set[tuple]) -> None:
+    existing = {tuple(row) for row in db.session.execute(db.select(*table.c)).all()}
+    missing = rows - existing
+    if missing:
+        columns = [column.name for column in table.c]
+        db.session.execute(table.insert(), [dict(zip(columns, row)) for row in missing])
+        logger.debug(f"Added {len(missing)} rows to {table.name}")
 
 
 def setup(app: Flask):
     tags_toml = os.path.join(ConfigHandler().config_dir, "tags.toml")
 
-    with open("default-tags.toml") as f:
-        conf = tomlkit.load(f)
+    # Only read here, so use the much faster parser from the standard library
+    with open("default-tags.toml", "rb") as f:
+        conf = tomllib.load(f)
 
     if os.path.exists(tags_toml):
-        with open(tags_toml) as f:
-            conf2 = tomlkit.load(f)
+        with open(tags_toml, "rb") as f:
+            conf2 = tomllib.load(f)
         if 'empornium.tags' in conf2:
             conf2['empornium']['tags'] = conf2["empornium.tags"]  # type: ignore
         conf.update(conf2)
@@ -303,6 +449,8 @@ def setup(app: Flask):
 def accept_suggestions(tags: MutableMapping[str, str], tracker: str) -> None:
     """Adds the provided tag mappings to the db, 
     creating the tags as required"""
+    if tracker not in TRACKERS:
+        raise ValueError(f"Tracker must be one of {list(TRACKERS)}")
     logger.info("Saving tag mappings")
     logger.debug(f"Tags: {tags}")
     with db.session.begin():
@@ -311,19 +459,7 @@ def accept_suggestions(tags: MutableMapping[str, str], tracker: str) -> None:
             g_tags = []
             for tag in gt.split():
                 g_tags.append(get_or_create_no_commit(GazelleTag, tagname=tag))
-            match tracker:
-                case "EMP":
-                    s_tag.emp_tags = g_tags
-                case "PB":
-                    s_tag.pb_tags = g_tags
-                case "FC":
-                    s_tag.fc_tags = g_tags
-                case "HF":
-                    s_tag.hf_tags = g_tags
-                case "ENT":
-                    s_tag.ent_tags = g_tags
-                case _:
-                    raise ValueError('Tracker must be one of ["EMP", "PB", "FC", "HF", "ENT"]')
+            s_tag.set_gazelle_tags(tracker, g_tags)
 
 
 def reject_suggestions(tags: list[str]) -> None:
@@ -0,0 +1,161 @@
+"""This module creates .torrent files. Pieces are hashed by a pool of threads,
+each reading a large block of the payload at a time, which keeps several
+cores busy since hashlib releases the GIL while hashing."""
+
+import hashlib
+import math
+import os
+import threading
+import time
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Protocol
+
+from utils import bencoder
+from utils.jobs import JobCancelled
+
+MIN_PIECE_LENGTH = 32 * 1024
+MAX_PIECE_LENGTH = 8 * 1024 * 1024
+# Amount of data read and hashed by a thread in one go
+BLOCK_SIZE = 32 * 1024 * 1024
+
+hash_pool = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix="hash")
+
+
+@dataclass
+class TorrentFile:
+    path: str
+    parts: list[str]
+    size: int
+
+
+# Identifies the contents of a file without reading it: (device, inode, size, mtime in ns, piece length)
+PieceKey = tuple[int, int, int, int, int]
+
+
+class PieceCache(Protocol):
+    def get(self, key: PieceKey) -> bytes | None: ...
+
+    def set(self, key: PieceKey, pieces: bytes) -> None: ...
+
+
+def piece_key(files: list[TorrentFile], length: int) -> PieceKey | None:
+    """Return the cache key for the pieces of a single file torrent, or `None` for multiple files."""
+    if len(files) != 1:
+        return None
+    stat = os.stat(files[0].path)
+    return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns, length
+
+
+def piece_length(size: int) -> int:
+    """Choose a piece length of roughly 1/1024 of the total size, between 32 KiB and 8 MiB."""
+    return min(max(2 ** int(math.log(max(size, 2 ** 11) / 2 ** 10, 2)), MIN_PIECE_LENGTH), MAX_PIECE_LENGTH)
+
+
+def collect_files(target: str) -> list[TorrentFile]:
+    """List the files to include in a torrent for `target`, in the order they are hashed."""
+    if os.path.isfile(target):
+        return [TorrentFile(target, [os.path.basename(target)], os.path.getsize(target))]
+    files = []
+    for root, dirs, names in os.walk(target):
+        dirs.sort()
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            files.append(TorrentFile(path, os.path.relpath(path, target).split(os.sep), os.path.getsize(path)))
+    files.sort(key=lambda f: f.parts)
+    return files
+
+
+def hash_pieces(files: list[TorrentFile], length: int, progress: Callable[[int, int], None] | None = None,
+                cancel_event: threading.Event | None = None) -> bytes:
+    """
+    Compute the SHA-1 hash of every piece of the files, treated as one continuous stream.
+    :param progress: Called with the number of bytes hashed so far and the total number of bytes
+    :raises JobCancelled: If `cancel_event` is set before hashing finishes
+    :return: The concatenated piece hashes
+    """
+    total = sum(f.size for f in files)
+    pieces_per_block = max(1, BLOCK_SIZE // length)
+    block_length = pieces_per_block * length
+    hashed = 0
+    lock = threading.Lock()
+
+    def hash_block(start: int) -> bytes:
+        if cancel_event is not None and cancel_event.is_set():
+            raise JobCancelled()
+        buffer = memoryview(bytearray(min(block_length, total - start)))
+        read_range(files, start, buffer)
+        digests = b"".join(hashlib.sha1(buffer[i:i + length]).digest() for i in range(0, len(buffer), length))
+        if progress is not None:
+            nonlocal hashed
+            with lock:
+                hashed += len(buffer)
+                progress(hashed, total)
+        return digests
+
+    return b"".join(hash_pool.map(hash_block, range(0, total, block_length)))
+
+
+def read_range(files: list[TorrentFile], start: int, buffer: memoryview) -> None:
+    """Fill `buffer` with the data starting `start` bytes into the stream of files."""
+    offset = 0
+    filled = 0
+    for file in files:
+        if filled == len(buffer):
+            break
+        if start + filled < offset + file.size:
+            with open(file.path, "rb", buffering=0) as f:
+                f.seek(start + filled - offset)
+                while filled < len(buffer) and start + filled < offset + file.size:
+                    end = min(len(buffer), offset + file.size - start)
+                    count = f.readinto(buffer[filled:end])
+                    if not count:
+                        raise IOError(f"{file.path} is shorter than expected")
+                    filled += count
+        offset += file.size
+
+
+def make_info(name: str, files: list[TorrentFile], length: int, pieces: bytes, source: str,
+              single_file: bool) -> dict:
+    """
+    Build the info dictionary of a torrent.
+    :param single_file: Whether the torrent is for a file rather than a directory. A directory always gets
+        the multi-file layout, even if it holds a single file, so that clients create the directory.
+    """
+    info = {
+        b"name": name.encode("utf-8"),
+        b"piece length": length,
+        b"pieces": pieces,
+        b"private": 1,
+        b"source": source.encode("utf-8"),
+    }
+    if single_file:
+        info[b"length"] = files[0].size
+    else:
+        info[b"files"] = [{b"length": f.size, b"path": [p.encode("utf-8") for p in f.parts]} for f in files]
+    return info
+
+
+def make_torrent(target: str, announce_url: str, source: str, progress: Callable[[int, int], None] | None = None,
+                 cancel_event: threading.Event | None = None, cache: PieceCache | None = None) -> bytes:
+    """
+    Create a private torrent for a file or directory.
+    :param cache: Where to look up the pieces of files that were hashed before, such as for another tracker
+    :return: The bencoded torrent
+    """
+    files = collect_files(target)
+    length = piece_length(sum(f.size for f in files))
+    key = piece_key(files, length) if cache is not None else None
+    pieces = cache.get(key) if cache is not None and key is not None else None
+    if pieces is None:
+        pieces = hash_pieces(files, length, progress, cancel_event)
+        if cache is not None and key is not None:
+            cache.set(key, pieces)
+    return bencoder.encode({
+        b"announce": announce_url.encode("utf-8"),
+        b"created by": b"stash-empornium",
+        b"creation date": int(time.time()),
+        b"info": make_info(os.path.basename(os.path.normpath(target)), files, length, pieces, source,
+                            os.path.isfile(target)),
+    })
@@ -7,12 +7,12 @@ from transmission_rpc import Client as TransmissionClient, TransmissionConnectEr
 
 from utils import bencoder
 from utils.paths import remap_path
+from utils.torrentindex import TorrentInfo, torrent_index
 
 
 class TorrentClient:
     "Base torrent client class"
     pathmaps: dict[str, str] = {}
-    hashes: dict[str, str] = {}
     label: str | None = None
     name: str = "Torrent Client"
 
@@ -23,17 +23,38 @@ class TorrentClient:
             self.label = settings["label"]
 
     def add(self, torrent_path: str, file_path: str) -> None:
-        torrent_file = os.path.basename(torrent_path)
-        if torrent_file not in TorrentClient.hashes:
-            with open(torrent_path, "rb") as f:
-                TorrentClient.hashes[torrent_file] = bencoder.infohash(f.read())
+        raise NotImplementedError()
+
+    def infohash(self, torrent_path: str) -> str:
+        info = torrent_index.find(torrent_path)
+        if info is None:
+            info = torrent_index.add(torrent_path)
+        return info.infohash
+
+    def verified(self, torrent_path: str) -> bool:
+        """
+        Check whether the files of a torrent are unchanged since the backend
+        hashed them, in which case the client doesn't need to check them again.
+        """
+        info = torrent_index.find(torrent_path)
+        if info is None or info.source_path is None:
+            return False
+        try:
+            for path, file in zip(local_files(info), info.files):
+                stat = os.stat(path)
+                if stat.st_size != file["length"] or stat.st_mtime > info.mtime:
+                    logger.debug(f"{path} has changed since {torrent_path} was made")
+                    return False
+        except OSError:
+            return False
+        return True
 
     def start(self, torrent_path: str) -> None:
-        torrent_file = os.path.basename(torrent_path)
-        if torrent_file in TorrentClient.hashes:
-            self.resume(TorrentClient.hashes[torrent_file])
+        info = torrent_index.find(torrent_path)
+        if info is not None:
+            self.resume(info.infohash)
         else:
-            logger.error(f"Error starting '{torrent_file}' in {self.name}")
+            logger.error(f"Error starting '{os.path.basename(torrent_path)}' in {self.name}")
 
     def resume(self, infohash: str):
         raise NotImplementedError()
@@ -42,6 +63,32 @@ class TorrentClient:
         return True
 
 
+def local_files(info: TorrentInfo) -> list[str]:
+    """Return the paths of the files of a torrent made by the backend, in torrent order."""
+    assert info.source_path is not None
+    if os.path.isfile(info.source_path):
+        return [info.source_path]
+    return [os.path.join(info.source_path, *f["path"].split("/")) for f in info.files]
+
+
+def add_fast_resume(data: bytes, paths: list[str]) -> bytes:
+    """Add libtorrent resume data to a torrent marking every piece as complete, as rtorrent_fast_resume.pl does."""
+    torrent = bencoder.decode(data)
+    info = torrent[b"info"]
+    piece_length = info[b"piece length"]
+    lengths = [f[b"length"] for f in info[b"files"]] if b"files" in info else [info[b"length"]]
+    files = []
+    offset = 0
+    for path, length in zip(paths, lengths):
+        first = offset // piece_length
+        last = (offset + length - 1) // piece_length
+        files.append({b"priority": 1, b"mtime": int(os.path.getmtime(path)),
+                      b"completed": last - first + 1 if length else 0})
+        offset += length
+    torrent[b"libtorrent_resume"] = {b"bitfield": len(info[b"pieces"]) // 20, b"files": files}
+    return bencoder.encode(torrent)
+
+
 class RTorrent(TorrentClient):
     """Implements rtorrent's XMLRPC protocol to
     allow adding torrents"""
@@ -73,15 +120,21 @@ class RTorrent(TorrentClient):
         logger.debug(f"Connecting to rtorrent at '{uri}'")
 
     def add(self, torrent_path: str, file_path: str) -> None:
-        super().add(torrent_path, file_path)
         file_path = remap_path(file_path, self.pathmaps)
         dir = os.path.split(file_path)[0]
         dir = dir.replace(" ", "\\ ")
         dir = os.path.normpath(dir)
         logger.debug(f"Adding torrent {torrent_path} to directory {dir}")
         with open(torrent_path, "rb") as torrent:
-            self.server.load.raw_verbose("", client.Binary(torrent.read()), f"d.directory.set={dir}",
-                                         f"d.custom1.set={self.label}", "d.check_hash=", )
+            data = torrent.read()
+        commands = [f"d.directory.set={dir}", f"d.custom1.set={self.label}"]
+        if self.verified(torrent_path):
+            info = torrent_index.find(torrent_path)
+            assert info is not None
+            data = add_fast_resume(data, local_files(info))
+        else:
+            commands.append("d.check_hash=")
+        self.server.load.raw_verbose("", client.Binary(data), *commands)
         logger.info("Torrent added to rTorrent")
 
     def resume(self, infohash: str):
@@ -127,22 +180,22 @@ class Qbittorrent(TorrentClient):
             logger.error("Failed to login to qBittorrent")
 
     def add(self, torrent_path: str, file_path: str) -> None:
-        super().add(torrent_path, file_path)
         if not self.logged_in:
             return
-        with open(torrent_path, "rb") as f:
-            hash = bencoder.infohash(f.read())
+        hash = self.infohash(torrent_path)
         file_path = remap_path(file_path, self.pathmaps)
         dir = os.path.split(file_path)[0]
         torrent_name = os.path.basename(torrent_path)
-        options = {"paused": "true", "savepath": dir}
+        verified = self.verified(torrent_path)
+        options = {"paused": "true", "savepath": dir, "skip_checking": "true" if verified else "false"}
         if len(self.label) > 0:
             options["category"] = self.label
         with open(torrent_path, "rb") as f:
             files = {"torrents": (torrent_name, f, "application/x-bittorrent")}
             r = self._post("/torrents/add", options, files=files, timeout=15)
         if r.ok and r.content.decode() != "Fails.":
-            self.recheck(hash)
+            if not verified:
+                self.recheck(hash)
             logger.info("Torrent added to qBittorrent")
         else:
             logger.error("Failed to add torrent to qBittorrent")
@@ -220,10 +273,10 @@ class Deluge(TorrentClient):
         return False
 
     def add(self, torrent_path: str, file_path: str) -> None:
-        super().add(torrent_path, file_path)
         file_path = remap_path(file_path, self.pathmaps)
         dir = os.path.split(file_path)[0]
         torrent_name = os.path.basename(torrent_path)
+        verified = self.verified(torrent_path)
 
         with open(torrent_path, "rb") as f:
             r = requests.post(self.url.replace("/json", "/upload"),
@@ -234,7 +287,8 @@ class Deluge(TorrentClient):
         if "success" in j and j["success"]:
             torrent_path = j["files"][0]
             body = {"method": "web.add_torrents",
-                    "params": [[{"path": torrent_path, "options": {"download_location": dir, "add_paused": True}}]],
+                    "params": [[{"path": torrent_path, "options": {"download_location": dir, "add_paused": True,
+                                                                   "seed_mode": verified}}]],
                     "id": 1, }
             try:
                 result = requests.post(self.url, json=body, cookies=self.cookies, timeout=5)
@@ -242,7 +296,8 @@ class Deluge(TorrentClient):
                 logger.debug(f"Deluge response: {j}")
                 if "result" in j and j["result"][0][0]:
                     infohash = j["result"][0][1]
-                    self.recheck(infohash)
+                    if not verified:
+                        self.recheck(infohash)
                     logger.info("Torrent added to deluge")
                 else:
                     logger.error(
@@ -267,7 +322,6 @@ class Transmission(TorrentClient):
 
     c: TransmissionClient
     name = "Transmission"
-    torrents: dict[str, int] = {}
 
     def __init__(self, settings: dict) -> None:
         super().__init__(settings)
@@ -286,7 +340,6 @@ class Transmission(TorrentClient):
                                     path=path)
 
     def add(self, torrent_path: str, file_path: str) -> None:
-        super().add(torrent_path, file_path)
         file_path = remap_path(file_path, self.pathmaps)
         directory = os.path.split(file_path)[0]
 
@@ -294,13 +347,14 @@ class Transmission(TorrentClient):
             logger.debug(f"Adding torrent {torrent_path} to directory {directory}")
             torrent = self.c.add_torrent(f, download_dir=directory, paused=True,
                                          labels=[self.label] if self.label else None)
-            self.torrents[TorrentClient.hashes[torrent_path]] = torrent.id
         logger.info("Torrent added to Transmission")
         logger.debug(f"Torrent id: {torrent.id}")
+        # Transmission has no way to skip verification when adding a torrent
         self.c.verify_torrent(torrent.id)
 
     def resume(self, infohash: str):
-        self.c.start_torrent(self.torrents[infohash])
+        # Transmission accepts infohashes in place of its own torrent IDs
+        self.c.start_torrent(infohash)
 
     def connected(self) -> bool:
         try:
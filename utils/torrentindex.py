@@ -0,0 +1,174 @@
+"""This module keeps an index of every torrent in the torrent directories, so
+that torrents can be looked up by infohash or file name without reading
+them again. The index is saved in the database and kept up to date by
+polling the directories for changes."""
+
+import hashlib
+import os
+import threading
+import time
+import urllib.parse
+from dataclasses import asdict, dataclass
+
+from flask import Flask
+from loguru import logger
+
+from utils import bencoder
+from utils.db import TorrentRecord, db
+
+
+@dataclass
+class TorrentInfo:
+    path: str
+    infohash: str
+    name: str
+    size: int
+    files: list[dict]
+    tracker: str | None
+    source_path: str | None
+    mtime: float
+
+
+def read_torrent(path: str, mtime: float, source_path: str | None = None) -> TorrentInfo:
+    with open(path, "rb") as f:
+        data = f.read()
+    torrent = bencoder.decode(data)
+    info = torrent[b"info"]
+    name = info[b"name"].decode("utf-8", "replace")
+    if b"files" in info:
+        files = [{"path": "/".join(p.decode("utf-8", "replace") for p in f[b"path"]), "length": f[b"length"]}
+                 for f in info[b"files"]]
+    else:
+        files = [{"path": name, "length": info[b"length"]}]
+    if b"source" in info:
+        tracker = info[b"source"].decode("utf-8", "replace")
+    elif b"announce" in torrent:
+        # The full announce URL contains the passkey, so only keep the host
+        tracker = urllib.parse.urlparse(torrent[b"announce"].decode("utf-8", "replace")).hostname
+    else:
+        tracker = None
+    start, end = bencoder.info_span(data)
+    infohash = hashlib.sha1(memoryview(data)[start:end]).hexdigest()
+    return TorrentInfo(path=path, infohash=infohash, name=name, size=sum(f["length"] for f in files),
+                       files=files, tracker=tracker, source_path=source_path, mtime=mtime)
+
+
+class TorrentIndex:
+    app: Flask | None = None
+    directories: list[str] = []
+
+    def __init__(self) -> None:
+        self._by_path: dict[str, TorrentInfo] = {}
+        self._by_hash: dict[str, TorrentInfo] = {}
+        self._by_filename: dict[str, TorrentInfo] = {}
+        self._lock = threading.Lock()
+
+    def setup(self, app: Flask, directories: list[str], interval: int = 60) -> None:
+        """Load the saved index, bring it up to date, and keep polling `directories` every `interval` seconds."""
+        self.app = app
+        self.directories = directories
+        with app.app_context():
+            records = TorrentRecord.query.all()
+        with self._lock:
+            for record in records:
+                self._put(TorrentInfo(**{k: getattr(record, k) for k in TorrentInfo.__dataclass_fields__}))
+        self.scan()
+        logger.info(f"Indexed {len(self._by_path)} torrents")
+        if interval > 0:
+            threading.Thread(target=self._poll, args=(interval,), name="torrentindex", daemon=True).start()
+
+    def get(self, infohash: str) -> TorrentInfo | None:
+        with self._lock:
+            return self._by_hash.get(infohash.lower())
+
+    def find(self, torrent_path: str) -> TorrentInfo | None:
+        """Look up a torrent by its full path, or by file name alone."""
+        with self._lock:
+            if torrent_path in self._by_path:
+                return self._by_path[torrent_path]
+            return self._by_filename.get(os.path.basename(torrent_path))
+
+    def add(self, path: str, source_path: str | None = None) -> TorrentInfo:
+        """Index a torrent right away, such as one that was just created for `source_path`."""
+        info = read_torrent(path, os.path.getmtime(path), source_path)
+        self._save([info], [])
+        return info
+
+    def scan(self) -> None:
+        """Index new and modified torrents, and remove torrents that were deleted."""
+        seen = set()
+        changed = []
+        for directory in self.directories:
+            try:
+                entries = list(os.scandir(directory))
+            except OSError as e:
+                logger.warning(f"Unable to scan torrent directory {directory}: {e}")
+                continue
+            for entry in entries:
+                if not entry.name.endswith(".torrent") or not entry.is_file():
+                    continue
+                seen.add(entry.path)
+                mtime = entry.stat().st_mtime
+                with self._lock:
+                    known = self._by_path.get(entry.path)
+                if known is not None and known.mtime == mtime:
+                    continue
+                try:
+                    changed.append(read_torrent(entry.path, mtime, known.source_path if known else None))
+                except (OSError, ValueError, KeyError) as e:
+                    logger.debug(f"Unable to index {entry.path}: {e}")
+        with self._lock:
+            removed = [path for path in self._by_path if path not in seen]
+        if changed or removed:
+            logger.debug(f"Indexing {len(changed)} torrents and removing {len(removed)}")
+            self._save(changed, removed)
+
+    def _save(self, changed: list[TorrentInfo], removed: list[str]) -> None:
+        with self._lock:
+            for path in removed:
+                self._remove(path)
+            for info in changed:
+                self._remove(info.path)
+                self._put(info)
+        if self.app is None:
+            return
+        with self.app.app_context():
+            for path in removed:
+                TorrentRecord.query.filter_by(path=path).delete()
+            for info in changed:
+                db.session.merge(TorrentRecord(**asdict(info)))  # type: ignore
+            db.session.commit()
+
+    def _put(self, info: TorrentInfo) -> None:
+        self._by_path[info.path] = info
+        self._by_hash[info.infohash] = info
+        self._by_filename[os.path.basename(info.path)] = info
+
+    def _remove(self, path: str) -> None:
+        info = self._by_path.pop(path, None)
+        if info is None:
+            return
+        # Copies of a torrent in other directories share the same hash and file name
+        if self._by_hash.get(info.infohash) is info:
+            del self._by_hash[info.infohash]
+        if self._by_filename.get(os.path.basename(path)) is info:
+            del self._by_filename[os.path.basename(path)]
+        for other in self._by_path.values():
+            if other.infohash == info.infohash:
+                self._by_hash.setdefault(other.infohash, other)
+                self._by_filename.setdefault(os.path.basename(other.path), other)
+
+    def _poll(self, interval: int) -> None:
+        while True:
+            time.sleep(interval)
+            try:
+                self.scan()
+            except Exception as e:
+                logger.error("Failed to update torrent index")
+                logger.debug(e)
+
+    def __len__(self) -> int:
+        return len(self._by_path)
+
+
+torrent_index = TorrentIndex()
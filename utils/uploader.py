@@ -0,0 +1,261 @@
+"""This module uploads images to the image hosts from a single event loop
+running in the background. Uploads to each host share one connection pool
+and only a few run at once, and all images uploaded with the same gallery
+key are added to the same imgbox gallery. Each image can be given several
+hosts to try: if the first is slow or fails, the image is also uploaded to
+the next one and whichever succeeds first is used. The file for a host can
+be given as a function that prepares it, which is only called once that
+host is tried."""
+
+import asyncio
+import math
+import threading
+import time
+import uuid
+from collections import deque
+from collections.abc import Callable, Coroutine, Sequence
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+import httpx
+import pyimgbox
+from loguru import logger
+
+from utils.confighandler import ConfigHandler
+
+HAMSTER_URL = "https://hamster.is/api/1/upload"
+# Maximum number of uploads in flight to each host
+HOST_LIMITS = {"hamster": 4, "imgbox": 4}
+# Number of recent uploads used to judge the health of each host
+HEALTH_WINDOW = 50
+HEALTH_MIN_SAMPLES = 5
+# Hosts failing more often than this are only tried after healthy ones
+MAX_ERROR_RATE = 0.5
+# How long to wait before hedging an upload until a host has enough history
+DEFAULT_HEDGE_DELAY = 20.0
+
+conf = ConfigHandler()
+
+
+@dataclass
+class Upload:
+    path: str
+    mime_type: str
+    ext: str
+
+
+# The file to upload to a host, or a function preparing it that returns ``None`` if it can't be uploaded
+Candidate = Upload | Callable[[], Optional[Upload]]
+
+
+@dataclass
+class HostHealth:
+    """The duration and outcome of the most recent uploads to a host."""
+    latencies: deque[float] = field(default_factory=lambda: deque(maxlen=HEALTH_WINDOW))
+    outcomes: deque[bool] = field(default_factory=lambda: deque(maxlen=HEALTH_WINDOW))
+
+    def record(self, latency: float, success: bool) -> None:
+        self.outcomes.append(success)
+        if success:
+            self.latencies.append(latency)
+
+    def record_cancelled(self, latency: float) -> None:
+        """Record an upload that was abandoned after `latency` seconds, which it would have taken at least."""
+        self.latencies.append(latency)
+
+    def percentile(self, p: float) -> Optional[float]:
+        if len(self.latencies) < HEALTH_MIN_SAMPLES:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, math.ceil(p / 100 * len(latencies)) - 1)]
+
+    @property
+    def error_rate(self) -> float:
+        if len(self.outcomes) < HEALTH_MIN_SAMPLES:
+            return 0.0
+        return self.outcomes.count(False) / len(self.outcomes)
+
+    @property
+    def healthy(self) -> bool:
+        return self.error_rate <= MAX_ERROR_RATE
+
+
+class Uploader:
+    def __init__(self) -> None:
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.client: httpx.AsyncClient | None = None
+        self.limits: dict[str, asyncio.Semaphore] = {}
+        self.health: dict[str, HostHealth] = {}
+        self.galleries: dict[str, tuple[pyimgbox.Gallery, asyncio.Lock]] = {}
+        self._lock = threading.Lock()
+
+    def upload(self, uploads: Sequence[Sequence[tuple[str, Candidate]]],
+               gallery: str | None = None) -> list[tuple[Optional[str], Optional[str]]]:
+        """
+        Upload a batch of images concurrently.
+        :param uploads: For each image, the hosts to try and the file to upload to each, most preferred first.
+            Hosts that have been failing are tried last. Files given as functions are prepared in a worker
+            thread when their host is tried.
+        :param gallery: Images uploaded to imgbox with the same gallery key are added to the same gallery
+        :return: The URL of each image and the host it was uploaded to, or ``None`` if every host failed,
+            in the same order as `uploads`
+        """
+        if not uploads:
+            return []
+        return self._run(self._upload_all(uploads, gallery))
+
+    def close_gallery(self, gallery: str) -> None:
+        """Stop adding images to a gallery."""
+        if gallery in self.galleries:
+            self._run(self._close_gallery(gallery))
+
+    def _run(self, coro: Coroutine[Any, Any, Any]) -> Any:
+        with self._lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, name="uploader", daemon=True).start()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def _upload_all(self, uploads: Sequence[Sequence[tuple[str, Candidate]]],
+                          gallery: str | None) -> list[tuple[Optional[str], Optional[str]]]:
+        return list(await asyncio.gather(*(self._upload_hedged(candidates, gallery) for candidates in uploads)))
+
+    async def _upload_hedged(self, candidates: Sequence[tuple[str, Candidate]],
+                             gallery: str | None) -> tuple[Optional[str], Optional[str]]:
+        candidates = sorted(candidates, key=lambda candidate: not self._health(candidate[0]).healthy)
+        running: dict[asyncio.Task, str] = {}
+        try:
+            for i, (host, upload) in enumerate(candidates):
+                started = asyncio.Event()
+                task = asyncio.create_task(self._upload(upload, host, gallery, started))
+                running[task] = host
+                if i == len(candidates) - 1:
+                    break
+                # Only start timing the upload once it is no longer waiting for a free slot
+                waiter = asyncio.create_task(started.wait())
+                await asyncio.wait([task, waiter], return_when=asyncio.FIRST_COMPLETED)
+                waiter.cancel()
+                if not task.done():
+                    await asyncio.wait([task], timeout=self.hedge_delay(host))
+                for done in [t for t in running if t.done()]:
+                    if done.result() is not None:
+                        return done.result(), running[done]
+                    del running[done]
+                if not task.done():
+                    logger.debug(f"Upload to {host} is slow, also trying {candidates[i + 1][0]}")
+            while running:
+                finished, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for done in finished:
+                    host = running.pop(done)
+                    if done.result() is not None:
+                        return done.result(), host
+            return None, None
+        finally:
+            for task in running:
+                task.cancel()
+            # Let the abandoned uploads record how long they took before the result is returned
+            if running:
+                await asyncio.wait(running)
+
+    def hedge_delay(self, host: str) -> float:
+        """How long to wait for an upload to a host before also trying the next one."""
+        delay: float | None = conf.get("images", "hedge_delay", None)  # type: ignore
+        if delay is None:
+            delay = self._health(host).percentile(95)
+        return DEFAULT_HEDGE_DELAY if delay is None else delay
+
+    def _health(self, host: str) -> HostHealth:
+        if host not in self.health:
+            self.health[host] = HostHealth()
+        return self.health[host]
+
+    async def _upload(self, candidate: Candidate, host: str, gallery: str | None,
+                      started: asyncio.Event | None = None) -> Optional[str]:
+        if host not in self.limits:
+            self.limits[host] = asyncio.Semaphore(HOST_LIMITS.get(host, 4))
+        if isinstance(candidate, Upload):
+            upload = candidate
+        else:
+            try:
+                upload = await asyncio.to_thread(candidate)
+            except Exception as e:
+                # Not the host's fault, so it isn't recorded against it
+                logger.error(f"Error preparing image for {host}: {e}")
+                return None
+        if upload is None:
+            return None
+        logger.debug(f"Uploading image from {upload.path} to {host}")
+        async with self.limits[host]:
+            if started is not None:
+                started.set()
+            start = time.monotonic()
+            url = None
+            try:
+                match host:
+                    case "hamster":
+                        url = await self._hamster_upload(upload)
+                    case "imgbox":
+                        url = await self._imgbox_upload(upload, gallery)
+            except Exception as e:
+                # Any failure only loses this image, and counts against the host
+                logger.error(f"Error uploading image to {host}: {e}")
+            except asyncio.CancelledError:
+                # Uploads that lose to a hedged one are slow, so leaving them out would lower the hedge delay
+                self._health(host).record_cancelled(time.monotonic() - start)
+                raise
+            self._health(host).record(time.monotonic() - start, url is not None)
+        return url
+
+    async def _hamster_upload(self, upload: Upload) -> Optional[str]:
+        headers = {
+            "accept": "application/json",
+            "X-API-Key": conf.get("hamster", "api_key", default=""),
+        }
+        if headers["X-API-Key"] == "":
+            logger.error("No API key provided for hamster.is Please go to https://hamster.is/settings/api to get one")
+            return None
+        if self.client is None:
+            self.client = httpx.AsyncClient(timeout=300)
+
+        with open(upload.path, "rb") as f:
+            files = {"source": (f"{uuid.uuid4()}.{upload.ext}", f.read(), upload.mime_type)}
+        request_body = {
+            "type": "file",
+            "action": "upload",
+            "nsfw": 1,
+            "format": "json",
+        }
+        response = await self.client.post(HAMSTER_URL, files=files, data=request_body, headers=headers)
+        try:
+            j = response.json()
+        except ValueError:
+            logger.error("Error uploading image, invalid JSON in response")
+            logger.debug(f"Response: {response.text}")
+            return None
+        if "error" in j:
+            logger.error("Error uploading image: " + j["error"]["message"])
+            return None
+        return j["image"]["url"]
+
+    async def _imgbox_upload(self, upload: Upload, gallery: str | None) -> Optional[str]:
+        if gallery is None:
+            async with pyimgbox.Gallery(adult=True) as single:
+                submission = await single.upload(upload.path)
+        else:
+            if gallery not in self.galleries:
+                self.galleries[gallery] = (pyimgbox.Gallery(adult=True), asyncio.Lock())
+            shared, lock = self.galleries[gallery]
+            # Uploads to a gallery create it if necessary, so make sure that only the first one does
+            async with lock:
+                if not shared.created:
+                    await shared.create()
+            submission = await shared.upload(upload.path)
+        logger.debug(f"imgbox submission: {submission}")
+        return submission["image_url"]
+
+    async def _close_gallery(self, gallery: str) -> None:
+        shared, _ = self.galleries.pop(gallery)
+        await shared.close()
+
+
+uploader = Uploader()
@@ -0,0 +1,344 @@
+"""This module caches the URLs of uploaded images, and which images belong to
+each scene, for the whole process. Recently used entries are kept in a
+bounded in-memory tier in front of Redis. A scene's URLs are looked up with
+one MGET, and writes are sent to Redis in pipelined batches by a background
+thread. If Redis fails, it is skipped for a while and only the in-memory
+tier is used. If Redis is not configured, the cache is kept in the database
+instead so that it survives restarts."""
+
+import queue
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Sequence
+from typing import Any, Optional
+
+from flask import Flask
+from loguru import logger
+
+from utils.confighandler import ConfigHandler
+from utils.db import ImageUrl, SceneImages, db
+
+try:
+    import redis
+except ImportError:
+    redis = None
+    logger.info("Redis module not found, using local caching only")
+
+PREFIX = "stash-empornium"
+HASH_PREFIX = f"{PREFIX}-file"
+CHUNK_SIZE = 5000
+# Maximum number of URLs and scene entries kept in memory
+MAX_ENTRIES = 10_000
+# How long to skip Redis after it fails
+REDIS_COOLDOWN = 30.0
+# Maximum number of URLs and scene entries kept in the database, and how many writes to make between evictions
+MAX_LOCAL_ENTRIES = 200_000
+EVICT_INTERVAL = 500
+
+conf = ConfigHandler()
+
+
+class LRUCache[K, V]:
+    """A dict that discards the least recently used entries once it has more than `size` of them."""
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self._data: OrderedDict[K, V] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: K) -> Optional[V]:
+        with self._lock:
+            if key not in self._data:
+                return None
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key: K, value: V) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def pop(self, key: K) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class LocalStore:
+    """Keeps the cache in the database, evicting the oldest entries once there are more than `size`."""
+
+    def __init__(self, app: Flask, size: int = MAX_LOCAL_ENTRIES) -> None:
+        self.app = app
+        self.size = size
+        self._writes = 0
+
+    def get_many(self, keys: Sequence[tuple[str, str]]) -> list[Optional[str]]:
+        with self.app.app_context():
+            records = ImageUrl.query.filter(ImageUrl.digest.in_({digest for _, digest in keys}),
+                                            ImageUrl.host.in_({host for host, _ in keys})).all()
+        urls = {(record.host, record.digest): record.url for record in records}
+        return [urls.get(key) for key in keys]
+
+    def add(self, key: str, host: str, url: str) -> None:
+        with self.app.app_context():
+            db.session.merge(ImageUrl(host=host, digest=key, url=url, created=time.time()))  # type: ignore
+            db.session.commit()
+            self._written()
+
+    def get_scene(self, scene_id: str, key: str) -> Optional[list[str]]:
+        with self.app.app_context():
+            record = db.session.get(SceneImages, (scene_id, key))
+            return record.digests.split(":") if record is not None else None
+
+    def set_scene(self, scene_id: str, key: str, digests: list[str]) -> None:
+        with self.app.app_context():
+            db.session.merge(SceneImages(scene_id=scene_id, kind=key, digests=":".join(digests),
+                                         created=time.time()))  # type: ignore
+            db.session.commit()
+            self._written()
+
+    def delete_scene(self, scene_id: str, key: str) -> None:
+        with self.app.app_context():
+            SceneImages.query.filter_by(scene_id=scene_id, kind=key).delete()
+            db.session.commit()
+
+    def clear(self) -> int:
+        with self.app.app_context():
+            count = ImageUrl.query.delete() + SceneImages.query.delete()
+            db.session.commit()
+        return count
+
+    def _written(self) -> None:
+        self._writes += 1
+        if self._writes % EVICT_INTERVAL:
+            return
+        for model in (ImageUrl, SceneImages):
+            excess = model.query.count() - self.size
+            if excess > 0:
+                oldest = db.session.query(model.created).order_by(model.created).offset(excess - 1).limit(1).scalar()
+                model.query.filter(model.created <= oldest).delete()
+                logger.debug(f"Evicted {excess} entries from {model.__tablename__}")
+        db.session.commit()
+
+
+class UrlCache:
+    def __init__(self, size: int = MAX_ENTRIES) -> None:
+        self.urls: LRUCache[tuple[str, str], str] = LRUCache(size)
+        self.scenes: LRUCache[tuple[str, str], list[str]] = LRUCache(size)
+        self.redis: Any = None
+        self.app: Flask | None = None
+        self.store: LocalStore | None = None
+        # Reads are skipped when regenerating everything, and writes only when caching is disabled entirely
+        self.read = True
+        self.write = True
+        self.configured = False
+        self._unavailable_until = 0.0
+        self._writes: queue.Queue[tuple[str, tuple]] = queue.Queue()
+        self._lock = threading.Lock()
+
+    def setup(self, app: Flask) -> None:
+        """Connect to Redis, or use the database of `app` if Redis is not available."""
+        self.app = app
+        self.configure()
+
+    def configure(self) -> None:
+        """Connect to Redis if it is configured. Only the first call has any effect."""
+        with self._lock:
+            if self.configured:
+                return
+            self.configured = True
+            self.read = not conf.args.no_cache and not conf.args.overwrite
+            self.write = not conf.args.no_cache
+            self._connect()
+            if self.redis is None and self.app is not None and self.write:
+                logger.debug("Caching image URLs in the database")
+                self.store = LocalStore(self.app)
+        if conf.args.flush:
+            self.clear()
+            logger.debug("Cleared cache")
+
+    def _connect(self) -> None:
+        redis_host: str = conf.get("redis", "host", "")  # type: ignore
+        redis_port: int = conf.get("redis", "port", 6379)  # type: ignore
+        use_ssl: bool = conf.get("redis", "ssl", False)  # type: ignore
+        enable = redis is not None and not conf.get("redis", "disable", False)
+        if conf.args.no_cache or redis_host is None or not enable:
+            logger.debug("Not connecting to redis")
+            return
+        try:
+            client = redis.Redis(
+                redis_host, redis_port, username=conf.get("redis", "username", ""),
+                password=conf.get("redis", "password", ""), ssl=use_ssl, decode_responses=True,
+                socket_timeout=5, socket_connect_timeout=5,
+            )
+            # It doesn't matter if this exists or not. An exception will be raised if not connected,
+            # so we can "check" for any arbitrary value to see if connected
+            client.exists("connection_check")
+        except redis.exceptions.AuthenticationError as e:
+            logger.error(f"Failed to authenticate with redis: {e} Check the username and password.")
+            return
+        except redis.exceptions.ConnectionError as e:
+            logger.error(f"Failed to connect to redis: {e} Check that the host and port are correct.")
+            return
+        logger.debug(f"Successfully connected to redis at {redis_host}:{redis_port}{' using ssl' if use_ssl else ''}")
+        self.redis = client
+        threading.Thread(target=self._write_behind, name="urlcache", daemon=True).start()
+
+    def get(self, key: str, host: str) -> Optional[str]:
+        return self.get_many([(host, key)])[0]
+
+    def get_many(self, keys: Sequence[tuple[str, str]]) -> list[Optional[str]]:
+        """
+        Look up the URLs of several images at once.
+        :param keys: The host and digest of each image
+        :return: The URL of each image, or ``None`` if it is not cached
+        """
+        if not self.read:
+            return [None] * len(keys)
+        urls = [self.urls.get(key) for key in keys]
+        missing = [i for i, url in enumerate(urls) if url is None]
+        if missing and self._available():
+            try:
+                values = self.redis.mget([f"{PREFIX}:{keys[i][0]}:{keys[i][1]}" for i in missing])
+            except redis.exceptions.RedisError as e:
+                self._fail(e)
+                return urls
+        elif missing and self.store is not None:
+            values = self.store.get_many([keys[i] for i in missing])
+        else:
+            return urls
+        for i, value in zip(missing, values):
+            if value is not None:
+                urls[i] = str(value)
+                self.urls.put(keys[i], urls[i])
+        return urls
+
+    def add(self, key: str, host: str, url: str) -> None:
+        if not self.write:
+            return
+        self.urls.put((host, key), url)
+        if self.store is not None:
+            self.store.add(key, host, url)
+        self._queue("set", f"{PREFIX}:{host}:{key}", url)
+
+    def exists(self, key: str, host: str) -> bool:
+        if self.urls.get((host, key)) is not None:
+            return True
+        if self.store is not None:
+            return self.store.get_many([(host, key)])[0] is not None
+        if not self._available():
+            return False
+        try:
+            return self.redis.exists(f"{PREFIX}:{host}:{key}") != 0
+        except redis.exceptions.RedisError as e:
+            self._fail(e)
+            return False
+
+    def get_scene(self, scene_id: str, key: str) -> Optional[list[str]]:
+        """Get the digests of the images of a given type for a scene, or ``None`` if there are none."""
+        if not self.read:
+            return None
+        digests = self.scenes.get((scene_id, key))
+        if digests is None and self.store is not None:
+            digests = self.store.get_scene(scene_id, key)
+            if digests is not None:
+                self.scenes.put((scene_id, key), digests)
+        elif digests is None and self._available():
+            try:
+                value = self.redis.hget(f"{HASH_PREFIX}:{scene_id}", key)
+            except redis.exceptions.RedisError as e:
+                self._fail(e)
+                return None
+            if value is not None:
+                digests = str(value).split(":")
+                self.scenes.put((scene_id, key), digests)
+        return digests
+
+    def set_scene(self, scene_id: str, key: str, digests: list[str]) -> None:
+        if not self.write:
+            return
+        self.scenes.put((scene_id, key), digests)
+        if self.store is not None:
+            self.store.set_scene(scene_id, key, digests)
+        self._queue("hset", f"{HASH_PREFIX}:{scene_id}", key, ":".join(digests))
+
+    def delete_scene(self, scene_id: str, key: str) -> None:
+        self.scenes.pop((scene_id, key))
+        if self.store is not None:
+            self.store.delete_scene(scene_id, key)
+        self._queue("hdel", f"{HASH_PREFIX}:{scene_id}", key)
+
+    def clear(self) -> None:
+        url_count = len(self.urls)
+        self.urls.clear()
+        self.scenes.clear()
+        if self.store is not None:
+            count = self.store.clear()
+            logger.debug(f"Cleared {url_count} local cache entries and {count} database entries")
+        if not self._available():
+            return
+        self.flush()
+        try:
+            cursor = 0
+            count = 0
+            while True:
+                cursor, keys = self.redis.scan(cursor=cursor, match=f"{PREFIX}*", count=CHUNK_SIZE)
+                if keys:
+                    count += len(keys)
+                    self.redis.delete(*keys)
+                if cursor == 0:
+                    break
+        except redis.exceptions.RedisError as e:
+            self._fail(e)
+            return
+        logger.debug(f"Cleared {url_count} local cache entries and {count} remote entries")
+
+    def flush(self) -> None:
+        """Wait until every queued write has been sent to Redis."""
+        if self.redis is not None:
+            self._writes.join()
+
+    def _queue(self, command: str, *args: str) -> None:
+        if self.redis is not None:
+            self._writes.put((command, args))
+
+    def _write_behind(self) -> None:
+        while True:
+            writes = [self._writes.get()]
+            while True:
+                try:
+                    writes.append(self._writes.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                if self._available():
+                    pipeline = self.redis.pipeline(transaction=False)
+                    for command, args in writes:
+                        getattr(pipeline, command)(*args)
+                    pipeline.execute()
+                else:
+                    logger.debug(f"Dropped {len(writes)} cache writes while redis is unavailable")
+            except redis.exceptions.RedisError as e:
+                self._fail(e)
+            finally:
+                for _ in writes:
+                    self._writes.task_done()
+
+    def _available(self) -> bool:
+        return self.redis is not None and time.monotonic() >= self._unavailable_until
+
+    def _fail(self, e: Exception) -> None:
+        logger.warning(f"Redis error, using local caching only for {REDIS_COOLDOWN:.0f} seconds: {e}")
+        self._unavailable_until = time.monotonic() + REDIS_COOLDOWN
+
+
+url_cache = UrlCache()
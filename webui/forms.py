@@ -14,7 +14,7 @@ from wtforms import (
 from wtforms.validators import URL, DataRequired, Optional, NumberRange
 from wtforms.widgets import Input, PasswordInput
 
-from utils.db import StashTag, Category
+from utils.db import StashTag, Category, TRACKERS
 from webui.validators import PortRange, ConditionallyRequired, Directory, Tag
 
 
@@ -193,7 +193,7 @@ class TagMapForm(FlaskForm):
         tags = []
         if "s_tags" in kwargs:
             for stag in kwargs["s_tags"]:
-                etag = " ".join([et.tagname for et in stag.emp_tags])
+                etag = " ".join([et.tagname for et in stag.gazelle_tags("EMP")])
                 tags.append({"stash_tag": stag.tagname, "emp_tag": etag})
             kwargs["tags"] = tags
         super().__init__(*args, **kwargs)
@@ -295,12 +295,9 @@ class TagAdvancedForm(FlaskForm):
         if "tag" in kwargs:
             tag: StashTag = kwargs["tag"]
             kwargs["stash_tag"] = tag.tagname
-            kwargs["def_tags"] = " ".join([et.tagname for et in tag.def_tags])
-            kwargs["emp_tags"] = " ".join([et.tagname for et in tag.emp_tags])
-            kwargs["pb_tags"] = " ".join([et.tagname for et in tag.pb_tags])
-            kwargs["fc_tags"] = " ".join([et.tagname for et in tag.fc_tags])
-            kwargs["ent_tags"] = " ".join([et.tagname for et in tag.ent_tags])
-            kwargs["hf_tags"] = " ".join([et.tagname for et in tag.hf_tags])
+            kwargs["def_tags"] = " ".join([et.tagname for et in tag.gazelle_tags()])
+            for tracker in TRACKERS:
+                kwargs[f"{tracker.lower()}_tags"] = " ".join([et.tagname for et in tag.gazelle_tags(tracker)])
             kwargs["display"] = tag.display
             kwargs["categories"] = [cat.name for cat in tag.categories]
             kwargs["ignored"] = tag.ignored
@@ -365,7 +362,7 @@ class SearchForm(FlaskForm):
         tags = []
         if "s_tags" in kwargs:
             for stag in kwargs["s_tags"]:
-                etag = " ".join([et.tagname for et in stag.emp_tags])
+                etag = " ".join([et.tagname for et in stag.gazelle_tags("EMP")])
                 tags.append({"stash_tag": stag.tagname, "emp_tag": etag})
             kwargs["tags"] = tags
         super().__init__(*args, **kwargs)
@@ -411,3 +408,8 @@ class DBImportExport(FlaskForm):
     export_database = SubmitField()
     upload_database = FileField(validators=[FileAllowed(["txt", "json", "md"])])
     imp = SubmitField("Import")
+    database_size = StringField("Database Size", render_kw={"readonly": True})
+    maintenance_interval = IntegerField("Maintenance Interval (seconds)", validators=[NumberRange(min=1)])
+    vacuum_threshold = IntegerField("Vacuum Threshold (% unused)", validators=[NumberRange(min=0, max=100)])
+    save = SubmitField()
+    maintain = SubmitField("Run Maintenance Now")
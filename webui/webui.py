@@ -18,8 +18,10 @@ from webui.forms import (
 )
 
 from utils.confighandler import ConfigHandler
-from utils.taghandler import query_maps
-from utils.db import get_or_create, StashTag, GazelleTag, db, get_or_create_no_commit, Category, from_dict, to_dict
+from utils.maintenance import maintenance
+from utils.taghandler import query_maps, reload_index
+from utils.db import get_or_create, StashTag, GazelleTag, db, get_or_create_no_commit, Category, from_dict, to_dict, \
+    database_stats, TagMapping, TRACKERS, DEFAULT_TRACKER
 from werkzeug.exceptions import HTTPException
 
 DUMMY_CONTEXT = {
@@ -56,38 +58,21 @@ def tag(id):
         if form.data["save"]:
             stag.ignored = form.data["ignored"]
             stag.display = form.data["display"]
-            etags = []
-            for et in form.data["def_tags"].split():
-                etags.append(get_or_create_no_commit(GazelleTag, tagname=et))
-            stag.def_tags = etags
-            etags = []
-            for et in form.data["emp_tags"].split():
-                etags.append(get_or_create_no_commit(GazelleTag, tagname=et))
-            stag.emp_tags = etags
-            etags = []
-            for et in form.data["pb_tags"].split():
-                etags.append(get_or_create_no_commit(GazelleTag, tagname=et))
-            stag.pb_tags = etags
-            etags = []
-            for et in form.data["fc_tags"].split():
-                etags.append(get_or_create_no_commit(GazelleTag, tagname=et))
-            stag.fc_tags = etags
-            etags = []
-            for et in form.data["ent_tags"].split():
-                etags.append(get_or_create_no_commit(GazelleTag, tagname=et))
-            stag.ent_tags = etags
-            etags = []
-            for et in form.data["hf_tags"].split():
-                etags.append(get_or_create_no_commit(GazelleTag, tagname=et))
-            stag.hf_tags = etags
+            for tracker, field in [(DEFAULT_TRACKER, "def_tags")] + [(t, f"{t.lower()}_tags") for t in TRACKERS]:
+                etags = []
+                for et in form.data[field].split():
+                    etags.append(get_or_create_no_commit(GazelleTag, tagname=et))
+                stag.set_gazelle_tags(tracker, etags)
             cats = []
             for cat in form.data["categories"]:
                 cats.append(get_or_create_no_commit(Category, name=cat))
             stag.categories = cats
             db.session.commit()
+            reload_index()
         elif form.data["delete"]:
             db.session.delete(stag)
             db.session.commit()
+            reload_index()
     return render_template("tag-advanced.html", form=form)
 
 
@@ -101,6 +86,7 @@ def tag_settings(page):
             s_tag = get_or_create(StashTag, tagname=tag["stash_tag"])
             db.session.delete(s_tag)
             db.session.commit()
+            reload_index()
         if form.data["submit"]:
             for tag in form.data["tags"]:
                 if not tag["stash_tag"]:
@@ -109,8 +95,9 @@ def tag_settings(page):
                 e_tags = []
                 for et in tag["emp_tag"].split():
                     e_tags.append(get_or_create(GazelleTag, tagname=et))
-                s_tag.emp_tags = e_tags
+                s_tag.set_gazelle_tags("EMP", e_tags)
                 db.session.commit()
+            reload_index()
         else:
             for tag in form.data["tags"]:
                 if tag["advanced"]:
@@ -132,7 +119,8 @@ def search():
                 return redirect(url_for(".tag", id=s_tag.id))
     elif searched:
         tags = tags.filter(StashTag.tagname.like(f"%{searched}%"))
-        e_tags = StashTag.query.join(StashTag.emp_tags).filter(GazelleTag.tagname.like(f"%{searched}%"))
+        e_tags = (StashTag.query.join(StashTag.mappings).join(TagMapping.gazelle_tag)
+                  .filter(TagMapping.tracker == "EMP", GazelleTag.tagname.like(f"%{searched}%")))
         tags = tags.union(e_tags)
         pagination = tags.order_by(StashTag.tagname).paginate(page=page)
         form = SearchForm(s_tags=pagination.items)
@@ -155,9 +143,11 @@ def category_settings(page):
             cat = Category.query.filter_by(name=cat).first()
             db.session.delete(cat)
             db.session.commit()
+            reload_index()
         elif form.submit.data:
             for cat in form.categories.data:
                 cat = get_or_create(Category, name=cat["name"])
+            reload_index()
     return render_template("categories.html", form=form, pagination=pagination)
 
 
@@ -276,7 +266,10 @@ def settings(page):
             return redirect(url_for(".tag_settings", page="maps"))
         case "database":
             template_context["settings_option"] = "the tag database"
-            form = DBImportExport()
+            form = DBImportExport(
+                maintenance_interval=conf.get(page, "maintenance_interval", 86400),
+                vacuum_threshold=conf.get(page, "vacuum_threshold", 20),
+            )
             template = "dbexport.html"
         case _:
             abort(404)
@@ -395,10 +388,22 @@ def settings(page):
                 elif form.imp.data:
                     data = json.loads(form.upload_database.data.read())
                     from_dict(data)
+                    reload_index()
                     template_context["message"] = "Settings imported"
+                elif form.save.data:
+                    template_context["message"] = "Settings saved"
+                    conf.set(page, "maintenance_interval", form.data["maintenance_interval"])
+                    conf.set(page, "vacuum_threshold", form.data["vacuum_threshold"])
+                elif form.maintain.data:
+                    # Only vacuums if the database is fragmented enough, like the scheduled runs
+                    vacuumed = maintenance.run()
+                    template_context["message"] = "Database vacuumed" if vacuumed else "Database optimized"
             case _:
                 abort(404)
         conf.update_file()
+    if page == "database":
+        size, free = database_stats()
+        form.database_size.data = f"{size / 1024 / 1024:.1f} MB ({free:.0%} unused)"
     template_context["form"] = form
     return render_template(template, **template_context)
 